@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import random
+import struct
+import tempfile
+import subprocess
+from pathlib import Path
+from tas_server import Metrics, TASExecutor, Connection, decode_response, encode_request, play_level, play_levels
+
+
+# Benchmarks for parts of TASmaniac that affect how fast candidates can be evaluated.
+# Usage: python benchmark.py <benchmark> [arguments...]
+#
+# wire [recordings...]: Compare the size and client-side encoding time of JSON and binary requests, and the size and decoding time of results.
+#                       Uses the given recordings, or synthetic inputs if none are given.
+# parse <level> [recordings...]: Compare how long a server takes to parse JSON and binary requests, as reported in its timings.
+#                                Uses the given recordings, or synthetic inputs if none are given.
+# ticks <level> <recording> [repeats]: Measure how many ticks per second a server simulates when playing back a recording,
+#                                      including the time spent loading the level.
+# lean <level> <recording> [repeats]: Same as ticks, but compares a server in lean mode against one with the full UI (--no-lean).
+# play_level <level> <recording> [repeats]: Measure evaluations per second and latency of play_level on one server, for both wire formats.
+# scaling <level> <recording> [max workers] [candidates]: Measure how evaluations per second scale with the number of TASExecutor workers,
+#                                                         doubling from 1 up to max workers (default 8).
+# optimize <level> [workers] / minimize <level>: Run optimize.py or minimize.py with a small number of iterations and report throughput,
+#                                                latency and memory. Needs a recording for the level in the recordings folder.
+#
+# The benchmarks start their own servers. The TASExecutor benchmarks ignore TASMANIAC_ENDPOINTS, so that only those servers are measured.
+# Set TASMANIAC_SERVER_COMMAND="python stand_in_server.py" to run them against the stand-in server
+# instead of the game, e.g. to check the scripts for performance regressions on a machine without the game.
+# Use `python stand_in_server.py --solve=<level>` to create a recording that completes a level of the stand-in server.
+
+
+def synthetic_inputs(num_lines: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    pressed = set()
+    frame = 0
+    inputs = []
+    for _ in range(num_lines):
+        frame += rng.randint(1, 30)
+        key = rng.choice('WADULR')
+        inputs.append(f"{frame} {'-' if key in pressed else '+'}{key}")
+        pressed ^= {key}
+    return inputs
+
+def measure(fn, min_time: float = 0.2) -> float:
+    """Return the average time of one call to fn in seconds."""
+    count = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time:
+        fn()
+        count += 1
+    return elapsed / count
+
+def benchmark_wire(args: list[str]):
+    if args:
+        inputs = [Path(file).read_text().splitlines() for file in args]
+    else:
+        inputs = [synthetic_inputs(n) for n in (50, 200, 1000)]
+
+    options = {'max_ticks': 10_000, 'snapshot_interval': None, 'restart': None}
+    timings = {'parse_usec': 12, 'load_usec': 34567, 'simulate_usec': 89012, 'wall_usec': 123591, 'simulated_ticks': 1234, 'ticks_per_second': 13863.3}
+    json_result = json.dumps({'status': 'executed', 'level_completed': True, 'duration_ticks': 1234, 'resumed_from_tick': None, 'load_path': 'full_reload', 'timings': timings, 'index': 0})
+    binary_result = struct.pack('<12i', 0, 0, 1, 1234, -1, 0, -1, 12, 34567, 89012, 123591, 1234)
+
+    print(f"{'lines':>6} {'batch':>6} {'format':>7} {'bytes':>9} {'encode':>10}")
+    for candidate in inputs:
+        for batch_size in (1, 100):
+            inputs_list = [candidate] * batch_size
+            start_positions_list = [None] * batch_size
+            candidates = [{'inputs': candidate, 'start_positions': None}] * batch_size
+
+            encode_json = lambda: json.dumps({'command': 'play_levels', 'level': 1, 'candidates': candidates, **options})
+            encode_binary = lambda: encode_request('play_levels', 1, inputs_list, start_positions_list, options)
+            json_message = encode_json()
+            binary_message = encode_binary()
+
+            for name, encode, message in (('json', encode_json, json_message.encode()), ('binary', encode_binary, binary_message)):
+                print(f"{len(candidate):>6} {batch_size:>6} {name:>7} {len(message):>9} {measure(encode) * 1e6:>8.1f}us")
+
+    print()
+    print(f"result: json {len(json_result)} bytes, {measure(lambda: decode_response(json_result)) * 1e6:.2f}us to decode; "
+          f"binary {len(binary_result)} bytes, {measure(lambda: decode_response(binary_result)) * 1e6:.2f}us to decode")
+
+def benchmark_parse(args: list[str]):
+    if not args:
+        print("ERROR: Expected arguments: <level> [recordings...]")
+        sys.exit(1)
+    level = int(args[0])
+    if len(args) > 1:
+        inputs = [Path(file).read_text().splitlines() for file in args[1:]]
+    else:
+        inputs = [synthetic_inputs(n) for n in (50, 200, 1000)]
+
+    print(f"{'lines':>6} {'batch':>6} {'format':>7} {'parse':>10}")
+    with TASExecutor(max_workers=1, metrics=Metrics(), endpoints=()) as executor:
+        for candidate in inputs:
+            for batch_size in (1, 100):
+                # About the same number of runs for every batch size. The runs are aborted on their first tick and restart the level
+                # the fast way, so that they take little time, but only the parse time reported by the server is measured anyway.
+                num_requests = max(2, 200 // batch_size)
+                for name, binary in (('json', False), ('binary', True)):
+                    play = lambda connection: list(play_levels(connection, level, [candidate] * batch_size, max_ticks=0, restart='fast', binary=binary))
+                    executor.submit(play).result() # Warm up
+                    executor.metrics.reset()
+                    for _ in range(num_requests):
+                        executor.submit(play).result()
+                    parse_seconds = executor.metrics.summary()['total']['server']['parse_seconds']
+                    print(f"{len(candidate):>6} {batch_size:>6} {name:>7} {parse_seconds / num_requests * 1e6:>8.1f}us")
+
+def parse_ticks_args(args: list[str]) -> tuple[int, list[str], int]:
+    if len(args) not in (2, 3):
+        print("ERROR: Expected arguments: <level> <recording> [repeats]")
+        sys.exit(1)
+    return int(args[0]), Path(args[1]).read_text().splitlines(), int(args[2]) if len(args) == 3 else 10
+
+def measure_ticks(connection: Connection, level: int, inputs: list[str], repeats: int) -> str:
+    play_level(connection, level, inputs) # Warm up, the first load of a level is slower
+    total_ticks = 0
+    start = time.perf_counter()
+    for _ in range(repeats):
+        _, duration = play_level(connection, level, inputs)
+        total_ticks += duration
+    elapsed = time.perf_counter() - start
+    return f"{total_ticks} ticks in {elapsed:.2f}s: {total_ticks / elapsed:.0f} ticks per second, {elapsed / repeats * 1000:.1f}ms per run"
+
+def benchmark_ticks(args: list[str]):
+    level, inputs, repeats = parse_ticks_args(args)
+    with TASExecutor(max_workers=1, endpoints=()) as executor:
+        print(executor.submit(lambda connection: measure_ticks(connection, level, inputs, repeats)).result())
+
+def peak_memory(children: bool = False) -> str:
+    """Return the peak resident memory of this process, or of the largest finished child process."""
+    try:
+        import resource
+    except ImportError:
+        return 'n/a' # Not available on Windows
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    return f"{max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024):.0f}MB"
+
+def format_metrics(summary: dict) -> str:
+    total = summary['total']
+    if not total['evaluations']:
+        return "no evaluations"
+    return (
+        f"{total['evaluations_per_second']:>8.1f}/s  latency p50 {total['latency_p50'] * 1000:>7.1f}ms p95 {total['latency_p95'] * 1000:>7.1f}ms  "
+        f"utilization {total['utilization']:>4.0%}  queue wait p95 {total['queue_wait_p95'] * 1000:>8.1f}ms"
+    )
+
+def benchmark_play_level(args: list[str]):
+    level, inputs, repeats = parse_ticks_args(args)
+    for name, binary in (('json', False), ('binary', True)):
+        with TASExecutor(max_workers=1, metrics=Metrics(), endpoints=()) as executor:
+            executor.submit(lambda connection: play_level(connection, level, inputs, binary=binary)).result() # Warm up
+            executor.metrics.reset()
+            for _ in range(repeats):
+                executor.submit(lambda connection: play_level(connection, level, inputs, binary=binary)).result()
+        print(f"{name:>7}: {format_metrics(executor.metrics.summary())}")
+    print(f"peak memory: {peak_memory()}")
+
+def benchmark_scaling(args: list[str]):
+    if len(args) not in (2, 3, 4):
+        print("ERROR: Expected arguments: <level> <recording> [max workers] [candidates]")
+        sys.exit(1)
+    level = int(args[0])
+    inputs = Path(args[1]).read_text().splitlines()
+    max_workers = int(args[2]) if len(args) >= 3 else 8
+    num_candidates = int(args[3]) if len(args) == 4 else 200
+
+    workers = 1
+    while workers <= max_workers:
+        with TASExecutor(max_workers=workers, metrics=Metrics(), endpoints=()) as executor:
+            # Wait for all servers to start before measuring
+            list(executor.map(lambda connection, _: play_level(connection, level, inputs), range(workers)))
+            executor.metrics.reset()
+            list(executor.map(lambda connection, _: play_level(connection, level, inputs), range(num_candidates)))
+        summary = executor.metrics.summary()
+        print(f"{summary['num_workers']:>3} workers: {format_metrics(summary)}")
+        workers *= 2
+    print(f"peak memory: {peak_memory()}")
+
+def run_script(script: str, args: list[str], env: dict[str, str], outputs: str):
+    """
+    Run one of the scripts in this folder and report its throughput, latency and memory.
+    Recordings matching the glob pattern outputs that the run wrote are deleted afterwards.
+    """
+    recordings = set(Path('recordings').glob(outputs))
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        metrics_file = Path(metrics_dir) / 'metrics.jsonl'
+        env = os.environ | {'TASMANIAC_CACHE': 'off', 'TASMANIAC_METRICS_FILE': str(metrics_file)} | env
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, *args], env=env, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        summary = json.loads(metrics_file.read_text().splitlines()[-1])
+    # Don't leave the improved recordings from benchmark runs behind
+    for file in set(Path('recordings').glob(outputs)) - recordings:
+        file.unlink()
+
+    print(f"{script}: {elapsed:.2f}s, {summary['total']['evaluations']} evaluations, {summary['num_workers']} workers")
+    print(f"  {format_metrics(summary)}")
+    print(f"  peak memory: {peak_memory(children=True)} (largest process)")
+
+def benchmark_optimize(args: list[str]):
+    if len(args) not in (1, 2):
+        print("ERROR: Expected arguments: <level> [workers]")
+        sys.exit(1)
+    workers = args[1] if len(args) == 2 else '4'
+    run_script('optimize.py', args[:1], {'TASMANIAC_MAX_WORKERS': workers, 'TASMANIAC_NUM_ITERATIONS': '5', 'TASMANIAC_ITERATION_NUM_CANDIDATES': '40'}, f'lvl{int(args[0]):03d}_*_optimized.txt')
+
+def benchmark_minimize(args: list[str]):
+    if len(args) != 1:
+        print("ERROR: Expected arguments: <level>")
+        sys.exit(1)
+    run_script('minimize.py', args, {}, f'lvl{int(args[0]):03d}_*_minimized_*.txt')
+
+def benchmark_lean(args: list[str]):
+    level, inputs, repeats = parse_ticks_args(args)
+    for name, flag in (('lean', '--lean'), ('full UI', '--no-lean')):
+        with TASExecutor(max_workers=1, metrics=Metrics(), endpoints=(), server_args=[flag]) as executor:
+            print(f"{name:>8}: {executor.submit(lambda connection: measure_ticks(connection, level, inputs, repeats)).result()}")
+
+
+BENCHMARKS = {
+    'wire': benchmark_wire,
+    'parse': benchmark_parse,
+    'ticks': benchmark_ticks,
+    'lean': benchmark_lean,
+    'play_level': benchmark_play_level,
+    'scaling': benchmark_scaling,
+    'optimize': benchmark_optimize,
+    'minimize': benchmark_minimize,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"ERROR: Expected benchmark name as the first argument, one of: {', '.join(BENCHMARKS)}")
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
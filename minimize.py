@@ -1,12 +1,31 @@
 
 """
-Tries to minimize the number of inputs in the file by deleting pairs of inputs as long as the level passes with no time loss.
+Tries to minimize the number of inputs in the file by deleting inputs as long as the level passes with no time loss.
+
+Inputs are deleted in units: a key press together with its release, or a release together with the next press of the same key
+(which merges two presses into one). Like delta debugging (ddmin), whole chunks of units are tried first, and the chunks are
+made smaller when no chunk can be deleted. All chunks of a round are played in parallel, and the successful ones are combined.
+
+The state of the search is saved to a checkpoint at the start of every round (see Checkpoint in tas_server.py), and every improvement
+is written to the `_minimized` recording as soon as it is found. Pass --resume to continue an interrupted run from its checkpoints.
 """
 
+import os
 import sys
-import random
+import math
+import asyncio
 from pathlib import Path
-from tas_server import TASExecutor, play_level
+from typing import Callable
+from tas_server import AsyncTASPool, ResultCache, default_cache, default_checkpoint, recording_state, write_atomic
+
+
+MAX_WORKERS = int(os.getenv("TASMANIAC_MAX_WORKERS") or "10")
+# Resume candidates from snapshots of earlier runs taken every this many ticks. 0 disables snapshots.
+SNAPSHOT_INTERVAL = int(os.getenv("TASMANIAC_SNAPSHOT_INTERVAL") or "0")
+# How the server resets the level between candidates: 'full', 'fast' or 'check' (see play_level in tas_server.py).
+RESTART = os.getenv("TASMANIAC_RESTART") or "full"
+# Send requests in the compact binary format instead of JSON.
+BINARY = (os.getenv("TASMANIAC_WIRE_FORMAT") or "json") == "binary"
 
 
 def normalize(inputs: list[str]) -> list[str]:
@@ -21,75 +40,179 @@ def normalize(inputs: list[str]) -> list[str]:
     
     return out
 
-def find_input_pair(first_input: str, inputs: list[str]) -> tuple[int | None, int | None]:
-    try:
-        first_index = inputs.index(first_input)
-    except ValueError:
-        return None, None
-    
-    target = first_input.split()[1]
+def find_input_pair(first_index: int, inputs: list[str]) -> int | None:
+    """Return the index of the next input after first_index with the same key and the opposite sign, or None if there is none."""
+    target = inputs[first_index].split()[1]
     if target.startswith('+'):
         target = target.replace('+', '-')
     else:
         target = target.replace('-', '+')
     for i in range(first_index + 1, len(inputs)):
         if inputs[i].endswith(target):
-            return first_index, i
+            return i
     
-    return first_index, None
-
-def minimize_level(connection, level: int):            
-    inputs_file = sorted(Path('recordings').glob(f'lvl{level:03d}_*.txt'))[0]
-
-    with open(inputs_file, mode='r') as f:
-        base_inputs = normalize(f.read().splitlines())
+    return None
+
+def find_units(inputs: list[str], sign: str) -> list[tuple[str, ...]]:
+    """
+    Return the inputs starting with sign ('+' for presses, '-' for releases), each together with its pair (see find_input_pair).
+    The units for one sign never overlap, so any combination of them can be deleted together.
+    """
+    units = []
+    for i, line in enumerate(inputs):
+        if line.split()[1].startswith(sign):
+            pair_index = find_input_pair(i, inputs)
+            units.append((line,) if pair_index is None else (line, inputs[pair_index]))
+    return units
+
+async def ddmin(pool: AsyncTASPool, level: int, inputs: list[str], duration: int, units: list[tuple[str, ...]], cache: ResultCache | None, granularity: int | None = None, deleted_any: bool = False, on_round: Callable[[list[str], int, list[tuple[str, ...]], int, bool], None] | None = None) -> tuple[list[str], int, bool]:
+    """
+    Delete as many of the given units from inputs as possible without increasing the duration.
+    Returns the new inputs and duration, and whether anything was deleted.
+
+    on_round is called with the inputs, duration, remaining units, granularity and deleted_any at the start of every round.
+    Passing these back to ddmin continues the search from that round.
+    """
+
+    def play_without(chunks: list[list[tuple[str, ...]]]) -> asyncio.Future[tuple[bool, int]]:
+        deleted = {line for chunk in chunks for unit in chunk for line in unit}
+        new_inputs = [line for line in inputs if line not in deleted]
+        return pool.submit(level, new_inputs, max_ticks=duration, snapshot_interval=SNAPSHOT_INTERVAL, restart=RESTART, cache=cache)
+
+    if granularity is None:
+        # Start with one chunk per worker, so that every worker has something to do from the first round.
+        granularity = min(len(units), max(2, pool.num_workers))
+    while units:
+        if on_round is not None:
+            on_round(inputs, duration, units, granularity, deleted_any)
+        size = math.ceil(len(units) / granularity)
+        chunks = [units[i:i + size] for i in range(0, len(units), size)]
+        results = await asyncio.gather(*(play_without([chunk]) for chunk in chunks))
+        # Best duration first, then earliest chunk
+        successes = sorted((new_duration, i) for i, (completed, new_duration) in enumerate(results) if completed and new_duration <= duration)
+        if not successes:
+            if size == 1:
+                break
+            granularity = min(len(units), granularity * 2)
+            continue
 
-    base_completed, base_duration = play_level(connection, level, base_inputs)
-    if not base_completed:
-        raise AssertionError(f"Minimizing {inputs_file}: Base inputs in did not complete level")
-    # print(f"Minimizing {inputs_file}: {len(base_inputs)} inputs")
+        # Speculatively try deleting the 2, 3, ... best chunks together and keep the largest combination that still passes.
+        # Chunks often interact, so this is checked instead of assuming that the combination of all successful chunks passes.
+        accepted = [chunks[successes[0][1]]]
+        new_duration = successes[0][0]
+        combinations = [[chunks[i] for _, i in successes[:count]] for count in range(2, len(successes) + 1)]
+        combination_results = await asyncio.gather(*(play_without(combination) for combination in combinations))
+        for combination, (completed, combination_duration) in reversed(list(zip(combinations, combination_results))):
+            if completed and combination_duration <= duration:
+                accepted = combination
+                new_duration = combination_duration
+                break
+
+        deleted = {line for chunk in accepted for unit in chunk for line in unit}
+        inputs = [line for line in inputs if line not in deleted]
+        units = [unit for chunk in chunks if chunk not in accepted for unit in chunk]
+        duration = new_duration
+        deleted_any = True
+        granularity = min(len(units), max(2, granularity - len(accepted)))
+
+    return inputs, duration, deleted_any
+
+async def minimize_level(pool: AsyncTASPool, level: int, cache: ResultCache | None = None, resume: bool = False):
+    checkpoint = default_checkpoint(f'minimize_lvl{level:03d}')
+    if resume:
+        state = checkpoint.load(level)
+    else:
+        state = None
+        checkpoint.remove()
+
+    if state is None:
+        inputs_file = sorted(Path('recordings').glob(f'lvl{level:03d}_*.txt'))[0]
+
+        with open(inputs_file, mode='r') as f:
+            base_inputs = normalize(f.read().splitlines())
+
+        base_completed, base_duration = await pool.play_level(level, base_inputs, snapshot_interval=SNAPSHOT_INTERVAL, restart=RESTART, cache=cache)
+        if not base_completed:
+            raise AssertionError(f"Minimizing {inputs_file}: Base inputs in did not complete level")
+        # print(f"Minimizing {inputs_file}: {len(base_inputs)} inputs")
+
+        state = recording_state(level, inputs_file) | {
+            'base_inputs': base_inputs, 'base_duration': base_duration, 'best_inputs': base_inputs, 'best_duration': base_duration,
+            'best_file': None, 'finished': False,
+            # Current ddmin call: the sign of the units it deletes, whether the press phase of this pass deleted anything, and its round (see ddmin)
+            'sign': '+', 'deleted_presses': False, 'units': None, 'granularity': None, 'deleted_any': False,
+        }
+    elif state['finished']:
+        return state['inputs_file'], state['best_duration'], state['base_inputs'], state['best_inputs']
+    else:
+        print(f"Resuming {state['inputs_file']}: {len(state['best_inputs'])} inputs left of {len(state['base_inputs'])}")
 
-    best_duration = base_duration
-    best_inputs = base_inputs
+    inputs_file, base_inputs = state['inputs_file'], state['base_inputs']
 
-    rng = random.Random()
+    def on_round(inputs: list[str], duration: int, units: list[tuple[str, ...]], granularity: int, deleted_any: bool):
+        if len(inputs) < len(state['best_inputs']):
+            # Every improvement is written as soon as it is found, replacing the previous one of this run
+            best_file = inputs_file.with_stem(f'{inputs_file.stem.split('_')[0]}_{duration / 60:05.2f}_minimized_{len(base_inputs)}_{len(inputs)}')
+            write_atomic(best_file, '\n'.join(inputs))
+            if state['best_file'] is not None and state['best_file'] != best_file:
+                state['best_file'].unlink(missing_ok=True)
+            state['best_file'] = best_file
+        state.update(best_inputs=inputs, best_duration=duration, units=units, granularity=granularity, deleted_any=deleted_any)
+        checkpoint.save(state)
 
-    first_inputs = base_inputs.copy()
-    rng.shuffle(first_inputs)
+    try:
+        # Deleting inputs of one kind can make it possible to delete more of the other kind, so repeat until neither helps.
+        while True:
+            units = state['units'] if state['units'] is not None else find_units(state['best_inputs'], state['sign'])
+            best_inputs, best_duration, deleted = await ddmin(pool, level, state['best_inputs'], state['best_duration'], units, cache, state['granularity'], state['deleted_any'], on_round)
+            on_round(best_inputs, best_duration, [], 0, deleted)
+            if state['sign'] == '+':
+                state.update(sign='-', deleted_presses=deleted, units=None, granularity=None, deleted_any=False)
+            elif state['deleted_presses'] or deleted:
+                state.update(sign='+', deleted_presses=False, units=None, granularity=None, deleted_any=False)
+            else:
+                break
+    except asyncio.CancelledError:
+        checkpoint.save(state, force=True)
+        raise
 
-    for first_input in first_inputs:
-        new_inputs = best_inputs.copy()
-        first_index, second_index = find_input_pair(first_input, new_inputs)
-        if first_index is None:
-            continue
-        if second_index is not None:
-            del new_inputs[second_index]
-        del new_inputs[first_index]
-
-        new_completed, new_duration = play_level(connection, level, new_inputs)
-        if new_completed and new_duration <= best_duration:
-            best_duration = new_duration
-            best_inputs = new_inputs
-    
-    return inputs_file, best_duration, base_inputs, best_inputs
+    # The checkpoint of a finished level is kept until all levels are finished, so that resuming a run of several levels skips it
+    state['finished'] = True
+    checkpoint.save(state, force=True)
+    return inputs_file, state['best_duration'], base_inputs, state['best_inputs']
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        start = int(sys.argv[1])
+    resume = '--resume' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--resume']
+    if len(args) == 1:
+        start = int(args[0])
         end = start + 1
-    elif len(sys.argv) == 3:
-        start = int(sys.argv[1])
-        end = int(sys.argv[2]) + 1
+    elif len(args) == 2:
+        start = int(args[0])
+        end = int(args[1]) + 1
     else:
-        print("ERROR: Expected 1 or 2 arguments")
+        print("ERROR: Expected 1 or 2 arguments and optionally --resume")
         sys.exit(1)
 
-    with TASExecutor(max_workers=10) as executor:
-        for inputs_file, best_duration, base_inputs, best_inputs in executor.map(minimize_level, range(start, end)):
-            if len(best_inputs) != len(base_inputs):
-                print(f"Minimized {inputs_file} from {len(base_inputs)} inputs to {len(best_inputs)} inputs")
+    cache = default_cache()
 
-                with open(inputs_file.with_stem(f'{inputs_file.stem.split('_')[0]}_{best_duration / 60:05.2f}_minimized_{len(base_inputs)}_{len(best_inputs)}'), mode='w') as f:
-                    f.write('\n'.join(best_inputs))
-            else:
-                print(f"Minimized {inputs_file}, no change")
+    async def main():
+        async with AsyncTASPool(max_workers=MAX_WORKERS, binary=BINARY) as pool:
+            # All levels are minimized at the same time, so that their candidates share the workers.
+            tasks = [asyncio.create_task(minimize_level(pool, level, cache, resume)) for level in range(start, end)]
+            for task in tasks:
+                inputs_file, best_duration, base_inputs, best_inputs = await task
+                if len(best_inputs) != len(base_inputs):
+                    print(f"Minimized {inputs_file} from {len(base_inputs)} inputs to {len(best_inputs)} inputs")
+                else:
+                    print(f"Minimized {inputs_file}, no change")
+        print(pool.metrics.report())
+
+        # The whole run is done, so a later run with --resume starts over instead of skipping these levels
+        for level in range(start, end):
+            default_checkpoint(f'minimize_lvl{level:03d}').remove()
+
+    asyncio.run(main())
+
+    if cache is not None:
+        print(f"Result cache: {cache.hits} hits, {cache.misses} misses")
@@ -1,70 +1,209 @@
 import os
 import sys
-from typing import Sequence
+import json
+import time
+import asyncio
 from pathlib import Path
 from queue import PriorityQueue, Empty
 import random
-from tas_server import TASExecutor, play_level
-
-
-def split(inputs: list[str]) -> tuple[list[int], list[str], int]:
-    out_left = []
-    out_right = []
-    for line in inputs:
-        if not line:
-            continue
-        frame, *keys = line.split()
-        for key in keys:
-            if key[1] in {'W', 'A', 'D'}:
-                out_left.append((int(frame), key))
-            else:
-                out_right.append((int(frame), key))
-    
-    offsets = []
-    keys = []
-    split_index = len(out_left)
-    for out in (out_left, out_right):
-        last_frame = 0
-        for frame, key in out:
-            offset = frame - last_frame
-            last_frame = frame
-            offsets.append(offset)
-            keys.append(key)
-    
-    return offsets, keys, split_index
-
-def combine(offsets: Sequence[int], keys: Sequence[str], split_index: int) -> list[str] | None:
-    frame = 0
-    inputs_out = []
-    for i, (offset, key) in enumerate(zip(offsets, keys)):
-        if i == split_index:
-            frame = 0
-        frame += offset
-        inputs_out.append((frame, key))
-    inputs_out.sort()
-    if inputs_out[0][0] < 0:
+import bisect
+from recording import split, combine
+from tas_server import AsyncTASPool, Checkpoint, default_cache, default_checkpoint, recording_state, write_atomic
+from search import STRATEGIES, RandomWalk, VisitedBloomFilter, VisitedTable, load_sensitivity
+
+
+def trajectory_progress(telemetry: dict, best_telemetry: dict, best_duration: int) -> float | None:
+    """
+    Return how far a run that did not complete the level got, as a fraction of the best run. For each player, this finds the tick
+    at which the best run came closest to where the player was at the end of the run, and uses the player that got less far.
+    Both runs need telemetry (see play_level in tas_server.py).
+    """
+    if not telemetry['samples'] or not best_telemetry['samples']:
         return None
-    else:
-        return [f'{f} {k}' for f, k in inputs_out]
+    last_sample = telemetry['samples'][-1]
+    ticks = []
+    for player in range(2):
+        # Each sample is the tick followed by x, y, velocity x, velocity y and coyote time of each player
+        x, y = last_sample[1 + 5 * player], last_sample[2 + 5 * player]
+        nearest = min(best_telemetry['samples'], key=lambda sample: (sample[1 + 5 * player] - x) ** 2 + (sample[2 + 5 * player] - y) ** 2)
+        ticks.append(nearest[0])
+    return min(1.0, min(ticks) / best_duration)
+
+class FatalPrefixes:
+    """
+    Inputs of runs in which a player died by touching a hazard, up to the tick at which the run ended.
+    The game is deterministic, so every other candidate with the same inputs up to that tick dies at the same tick and does not have to be played.
+    Prefixes are stored as hashes. When more than max_entries are stored, they are all forgotten and collection starts over.
+    """
+
+    def __init__(self, max_entries: int = 100_000) -> None:
+        self.max_entries = max_entries
+        self.num_resets = 0
+        self._prefixes = set[tuple[int, int]]()
+        self._ticks = list[int]()
+
+    def __len__(self) -> int:
+        return len(self._prefixes)
+
+    def add(self, inputs: list[str], tick: int):
+        if len(self._prefixes) >= self.max_entries:
+            self._prefixes.clear()
+            self._ticks.clear()
+            self.num_resets += 1
+        frames, prefix_hashes = self._prefix_hashes(inputs)
+        self._prefixes.add((tick, prefix_hashes[bisect.bisect_right(frames, tick)]))
+        index = bisect.bisect_left(self._ticks, tick)
+        if index == len(self._ticks) or self._ticks[index] != tick:
+            self._ticks.insert(index, tick)
+
+    def find(self, inputs: list[str]) -> int | None:
+        """
+        Return the tick at which a run with the given inputs (as returned by `combine`) dies, or None if it is not known to die.
+        """
+        if not self._ticks:
+            return None
+        frames, prefix_hashes = self._prefix_hashes(inputs)
+        for tick in self._ticks:
+            if (tick, prefix_hashes[bisect.bisect_right(frames, tick)]) in self._prefixes:
+                return tick
+        return None
+
+    @staticmethod
+    def _prefix_hashes(inputs: list[str]) -> tuple[list[int], list[int]]:
+        # The i-th hash covers the first i lines. The inputs are sorted by frame, so the lines up to a tick are always a prefix.
+        frames = [int(line.split(' ', 1)[0]) for line in inputs]
+        prefix_hashes = [0]
+        for line in inputs:
+            prefix_hashes.append(hash((prefix_hashes[-1], line)))
+        return frames, prefix_hashes
+
+class PendingLimit:
+    """
+    Limits the number of pending candidates of all levels together.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.count = 0
+        self.freed = asyncio.Event()
+
+    def full(self) -> bool:
+        return self.count >= self.limit
+
+    def add(self, future: asyncio.Future):
+        self.count += 1
+        future.add_done_callback(self._release)
+
+    def _release(self, _future: asyncio.Future):
+        self.count -= 1
+        self.freed.set()
+
+    async def wait(self):
+        """Wait until a pending candidate has finished."""
+        self.freed.clear()
+        await self.freed.wait()
 
 if __name__ == '__main__':
-    if len(sys.argv) == 2:
-        start = int(sys.argv[1])
+    # With --resume, levels continue from their last checkpoint (see Checkpoint in tas_server.py) instead of starting over.
+    RESUME = '--resume' in sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if arg != '--resume']
+    if len(args) == 1:
+        start = int(args[0])
         end = start + 1
-    elif len(sys.argv) == 3:
-        start = int(sys.argv[1])
-        end = int(sys.argv[2]) + 1
+    elif len(args) == 2:
+        start = int(args[0])
+        end = int(args[1]) + 1
     else:
-        print("ERROR: Expected 1 or 2 arguments")
+        print("ERROR: Expected 1 or 2 arguments and optionally --resume")
         sys.exit(1)
     
     MAX_WORKERS = int(os.getenv("TASMANIAC_MAX_WORKERS") or "10")
     NUM_ITERATIONS = int(os.getenv("TASMANIAC_NUM_ITERATIONS") or "20")
     ITERATION_NUM_CANDIDATES = int(os.getenv("TASMANIAC_ITERATION_NUM_CANDIDATES") or "80")
+    # Search strategy, one of the names in search.STRATEGIES.
+    STRATEGY = os.getenv("TASMANIAC_STRATEGY") or "random_walk"
+    # Stop optimizing a level after this many evaluations or seconds (0 for no time limit).
+    BUDGET_EVALUATIONS = int(os.getenv("TASMANIAC_BUDGET_EVALUATIONS") or str(NUM_ITERATIONS * ITERATION_NUM_CANDIDATES))
+    BUDGET_SECONDS = float(os.getenv("TASMANIAC_BUDGET_SECONDS") or "0")
+    # Number of levels that are optimized at the same time. Their candidates share the workers, so that no worker is idle
+    # while a strategy waits for results before it can propose more candidates.
+    INTERLEAVE_LEVELS = int(os.getenv("TASMANIAC_INTERLEAVE_LEVELS") or "1")
+    # If set, progress of each level (evaluations, time and best duration) is appended to this file as JSON lines.
+    CONVERGENCE_FILE = os.getenv("TASMANIAC_CONVERGENCE_FILE") or None
+    # Candidates that are more than this many ticks slower than the best are aborted early by the server.
+    # Strategies that accept slower candidates, like 'random_walk', 'anneal' and 'evolution', raise the limit as needed (see Strategy.max_ticks).
+    CUTOFF_SLACK = int(os.getenv("TASMANIAC_CUTOFF_SLACK") or "0")
+    # Resume candidates from snapshots of earlier runs taken every this many ticks. 0 disables snapshots.
+    SNAPSHOT_INTERVAL = int(os.getenv("TASMANIAC_SNAPSHOT_INTERVAL") or "0")
+    # How the server resets the level between candidates: 'full', 'fast' or 'check' (see play_level in tas_server.py).
+    RESTART = os.getenv("TASMANIAC_RESTART") or "full"
+    # Send requests in the compact binary format instead of JSON.
+    BINARY = (os.getenv("TASMANIAC_WIRE_FORMAT") or "json") == "binary"
+    # Number of candidates per worker that are queued or running at any time, for all levels together. Enough to keep every worker busy while results are processed.
+    PENDING_PER_WORKER = 2
+    # Memory limit for the candidates that were already played, per level. Set a false positive rate to store them in a Bloom filter,
+    # which holds more candidates in the same memory, but skips that fraction of new candidates (see search.py).
+    VISITED_MAX_BYTES = int(float(os.getenv("TASMANIAC_VISITED_MAX_MB") or "64") * 1024 * 1024)
+    VISITED_FALSE_POSITIVE_RATE = float(os.getenv("TASMANIAC_VISITED_FALSE_POSITIVE_RATE") or "0")
+    # The candidates that were already played can take up to VISITED_MAX_BYTES, so they are saved to their own checkpoint
+    # this many times less often than the rest of the state.
+    VISITED_CHECKPOINT_FACTOR = 10
+    # Stop if a strategy proposes this many candidates in a row that were already played, because it has run out of new ones.
+    MAX_SKIPPED = 10_000
+    # Request telemetry sampled every this many ticks for every candidate (see play_level in tas_server.py). 0 disables telemetry.
+    # With telemetry, failed candidates are scored by how far they got (see trajectory_progress), and candidates that share the inputs
+    # of a run that died up to the tick of its death are skipped (see FatalPrefixes). Results with telemetry are not read from the cache.
+    TELEMETRY_INTERVAL = int(os.getenv("TASMANIAC_TELEMETRY_INTERVAL") or "0")
+    # Change the offsets that matter more often, according to the table written by sweep.py for the recording, if there is one.
+    USE_SWEEPS = os.getenv("TASMANIAC_USE_SWEEPS") == '1'
 
-    with TASExecutor(max_workers=MAX_WORKERS) as executor:
-        for level in range(start, end):
+    if STRATEGY not in STRATEGIES:
+        print(f"ERROR: Unknown strategy {STRATEGY}, expected one of: {', '.join(STRATEGIES)}")
+        sys.exit(1)
+
+    cache = default_cache()
+
+    def log_convergence(level: int, evaluations: int, elapsed: float, best_duration: int):
+        if CONVERGENCE_FILE is not None:
+            with open(CONVERGENCE_FILE, mode='a') as f:
+                f.write(json.dumps({'level': level, 'strategy': STRATEGY, 'evaluations': evaluations, 'elapsed': elapsed, 'best_duration': best_duration}) + '\n')
+
+    def new_visited() -> VisitedTable | VisitedBloomFilter:
+        if VISITED_FALSE_POSITIVE_RATE > 0:
+            return VisitedBloomFilter(VISITED_MAX_BYTES, VISITED_FALSE_POSITIVE_RATE)
+        return VisitedTable(VISITED_MAX_BYTES)
+
+    def visited_checkpoint(level: int) -> Checkpoint:
+        checkpoint = default_checkpoint(f'optimize_lvl{level:03d}_visited')
+        checkpoint.interval *= VISITED_CHECKPOINT_FACTOR
+        return checkpoint
+
+    def load_visited(checkpoint: Checkpoint, level: int) -> VisitedTable | VisitedBloomFilter | None:
+        """
+        Return the visited candidates saved in checkpoint, or None if there are none for the kind of table that is configured.
+        """
+        state = checkpoint.load(level)
+        if state is None:
+            return None
+        if state['kind'] == 'bloom' and VISITED_FALSE_POSITIVE_RATE > 0:
+            return VisitedBloomFilter.from_bytes(state['data'], VISITED_FALSE_POSITIVE_RATE)
+        if state['kind'] == 'table' and VISITED_FALSE_POSITIVE_RATE == 0:
+            return VisitedTable.from_bytes(state['data'], VISITED_MAX_BYTES)
+        return None
+
+    async def optimize_level(pool: AsyncTASPool, level: int, pending_limit: PendingLimit):
+        checkpoint = default_checkpoint(f'optimize_lvl{level:03d}')
+        visited_state = visited_checkpoint(level)
+        if RESUME:
+            state = checkpoint.load(level)
+        else:
+            state = None
+            checkpoint.remove()
+            visited_state.remove()
+
+        if state is None:
             inputs_file = sorted(Path('recordings').glob(f'lvl{level:03d}_*.txt'))[0]
+            recording = recording_state(level, inputs_file)
 
             with open(inputs_file, mode='r') as f:
                 base_inputs = f.read().splitlines()
@@ -72,60 +211,204 @@ if __name__ == '__main__':
             base_offsets, keys, split_index = split(base_inputs)
             base_offsets = tuple(base_offsets)
 
-            base_completed, base_duration = executor.submit(lambda conn: play_level(conn, level, base_inputs)).result()
+            base_completed, base_duration, *base_telemetry = await pool.play_level(level, base_inputs, snapshot_interval=SNAPSHOT_INTERVAL, restart=RESTART, cache=cache, telemetry_interval=TELEMETRY_INTERVAL)
             if not base_completed:
                 raise AssertionError(f"Optimizing {inputs_file}: Base inputs in did not complete level")
-            print(f"Optimizing {inputs_file}: {base_duration} frames ({base_duration / 60:.2f} seconds), {len(base_offsets)} offsets")
+            print(f"Optimizing {inputs_file}: {base_duration} frames ({base_duration / 60:.2f} seconds), {len(base_offsets)} offsets, strategy {STRATEGY}")
 
-            visited = set[tuple[int, ...]]()
+            visited = new_visited()
             visited.add(base_offsets)
 
-            last_duration = base_duration
-            last_offsets = base_offsets
+            rng = random.Random()
+            if STRATEGY == 'random_walk':
+                strategy = RandomWalk(base_offsets, base_duration, split_index, rng, iteration_candidates=ITERATION_NUM_CANDIDATES)
+            else:
+                strategy = STRATEGIES[STRATEGY](base_offsets, base_duration, split_index, rng)
 
-            best_duration = base_duration
-            best_offsets = base_offsets
+            sweep_file = Path('sweeps') / f'{inputs_file.stem}.csv'
+            if USE_SWEEPS and sweep_file.exists():
+                strategy.weights = load_sensitivity(sweep_file, base_offsets)
+                if strategy.weights is None:
+                    print(f"Optimizing {inputs_file}: Ignoring {sweep_file}, it was made for different offsets")
+                else:
+                    print(f"Optimizing {inputs_file}: Picking offsets according to {sweep_file}")
 
-            rng = random.Random()
+            finished = False
+            resubmit = list[tuple[int, ...]]()
+            best_file: Path | None = None
+            best_telemetry = base_telemetry[0] if base_telemetry else None
+            num_submitted = 0
+            num_finished = 0
+            num_skipped = 0
+            num_pruned = 0
+            elapsed = 0.0
+            log_convergence(level, 0, 0.0, base_duration)
+        else:
+            inputs_file, keys, split_index, base_duration = state['inputs_file'], state['keys'], state['split_index'], state['base_duration']
+            recording = {key: state[key] for key in ('level', 'inputs_file', 'inputs_hash')}
+            if state['strategy_name'] != STRATEGY:
+                raise AssertionError(f"Optimizing {inputs_file}: Checkpoint {checkpoint.path} uses strategy {state['strategy_name']}, not {STRATEGY}")
+            strategy, finished, best_file, best_telemetry = state['strategy'], state['finished'], state['best_file'], state['best_telemetry']
+            # Candidates that were pending when the checkpoint was saved are played again, because the strategy is still waiting for them
+            resubmit = state['pending']
+            # The visited candidates are saved less often than the rest of the state, so the ones played since then are played again
+            visited = load_visited(visited_state, level)
+            if visited is None:
+                print(f"Optimizing {inputs_file}: No saved visited candidates for this configuration, starting with none")
+                visited = new_visited()
+            visited.add(strategy.best_offsets)
+            for offsets in resubmit:
+                visited.add(offsets)
+            num_submitted, num_finished, num_skipped, num_pruned, elapsed = state['num_submitted'], state['num_finished'], state['num_skipped'], state['num_pruned'], state['elapsed']
+            if finished:
+                print(f"{inputs_file}: Already finished, best {strategy.best_duration} frames (was {base_duration})")
+                print()
+                return
+            print(f"Resuming {inputs_file} after {num_finished} evaluations: best {strategy.best_duration} frames (was {base_duration}), strategy {STRATEGY}")
 
-            for i in range(NUM_ITERATIONS):
-                random_change_chance = (9 - i % 10) * 0.04
+        # Candidates are proposed whenever a result comes in, as long as the pending limit of all levels together allows it.
+        pending = dict[asyncio.Future[tuple[bool, int]], tuple[tuple[int, ...], list[str]]]()
+        start_time = time.perf_counter() - elapsed
+        # Prefix hashes use the built-in hash, which differs between runs, so they are not saved in the checkpoint
+        fatal_prefixes = FatalPrefixes() if TELEMETRY_INTERVAL > 0 else None
 
-                all_new_offsets = []
-                for _ in range(ITERATION_NUM_CANDIDATES):
-                    new_offsets = list(last_offsets)
-                    random_index = rng.randrange(len(new_offsets))
-                    random_offset = rng.randint(-10, 10)
-                    new_offsets[random_index] += random_offset
-                    new_offsets = tuple(new_offsets)
+        def submit(new_offsets: tuple[int, ...], new_inputs: list[str]):
+            future = pool.submit(level, new_inputs, max_ticks=strategy.max_ticks(CUTOFF_SLACK), snapshot_interval=SNAPSHOT_INTERVAL, restart=RESTART, cache=cache, telemetry_interval=TELEMETRY_INTERVAL)
+            pending_limit.add(future)
+            pending[future] = new_offsets, new_inputs
+
+        def save_checkpoint(force: bool = False, with_visited: bool = True):
+            # The visited candidates are only saved together with the rest of the state, so that they never include candidates
+            # whose results the saved strategy does not know about
+            save_visited = with_visited and (force or visited_state.due())
+            checkpoint.save(recording | {
+                'keys': keys, 'split_index': split_index, 'base_duration': base_duration,
+                'strategy_name': STRATEGY, 'strategy': strategy, 'finished': finished, 'best_file': best_file, 'best_telemetry': best_telemetry,
+                'pending': [offsets for offsets, _ in pending.values()], 'num_submitted': num_submitted, 'num_finished': num_finished, 'num_skipped': num_skipped, 'num_pruned': num_pruned,
+                'elapsed': time.perf_counter() - start_time,
+            }, force=force or save_visited)
+            if save_visited:
+                kind = 'bloom' if isinstance(visited, VisitedBloomFilter) else 'table'
+                visited_state.save(recording | {'kind': kind, 'data': visited.to_bytes()}, force=True)
+
+        def write_best():
+            # Every new best is written as soon as it is found, replacing the previous best of this run
+            nonlocal best_file
+            best_inputs = combine(strategy.best_offsets, keys, split_index)
+            assert best_inputs is not None
+            new_best_file = inputs_file.with_stem(f'{inputs_file.stem.split('_')[0]}_{strategy.best_duration / 60:05.2f}_optimized')
+            write_atomic(new_best_file, '\n'.join(best_inputs))
+            if best_file is not None and best_file != new_best_file:
+                best_file.unlink(missing_ok=True)
+            best_file = new_best_file
+
+        for new_offsets in resubmit:
+            new_inputs = combine(new_offsets, keys, split_index)
+            assert new_inputs is not None
+            submit(new_offsets, new_inputs)
+
+        try:
+            while True:
+                out_of_time = BUDGET_SECONDS > 0 and time.perf_counter() - start_time > BUDGET_SECONDS
+                while num_submitted < BUDGET_EVALUATIONS and not out_of_time and not strategy.done and num_skipped < MAX_SKIPPED and not pending_limit.full():
+                    new_offsets = strategy.propose()
+                    if new_offsets is None:
+                        break
                     if new_offsets in visited:
+                        num_skipped += 1
+                        strategy.tell(new_offsets, None)
                         continue
-                    all_new_offsets.append(new_offsets)
                     visited.add(new_offsets)
-                
-                def evaluate(connection, new_offsets):
+
+                    # Offsets that move an input before the start of the level are invalid, so they are not sent to the server at all
                     new_inputs = combine(new_offsets, keys, split_index)
                     if new_inputs is None:
-                        completed, duration = False, 0
-                    else:
-                        completed, duration = play_level(connection, level, new_inputs)
-                    return completed, duration, new_offsets
-                
-                for completed, duration, new_offsets in executor.map(evaluate, all_new_offsets):
-                    if completed:
-                        if duration < best_duration:
-                            best_duration = duration
-                            best_offsets = new_offsets
-                            print(f"New best: {duration} frames ({duration / 60:.2f} seconds)")
-                        if duration < last_duration or rng.random() < random_change_chance:
-                            last_duration = duration
-                            last_offsets = new_offsets
-                
-                print(f"Visited: {len(visited)} items, Last duration: {last_duration} frames, {random_change_chance}")
-            print()
-
-            if best_duration < base_duration:
-                best_inputs = combine(best_offsets, keys, split_index)
-                assert best_inputs is not None
-                with open(inputs_file.with_stem(f'{inputs_file.stem.split('_')[0]}_{best_duration / 60:05.2f}_optimized'), mode='w') as f:
-                    f.write('\n'.join(best_inputs))
+                        num_skipped += 1
+                        strategy.tell(new_offsets, None)
+                        continue
+                    # Candidates that are known to die are reported as failed at the tick of death without being played
+                    death_tick = fatal_prefixes.find(new_inputs) if fatal_prefixes is not None else None
+                    if death_tick is not None:
+                        num_skipped += 1
+                        num_pruned += 1
+                        strategy.tell_pruned(new_offsets, death_tick)
+                        continue
+                    num_skipped = 0
+                    submit(new_offsets, new_inputs)
+                    num_submitted += 1
+
+                if out_of_time:
+                    for future in pending:
+                        future.cancel()
+                    break
+                if not pending:
+                    if num_submitted >= BUDGET_EVALUATIONS or strategy.done or num_skipped >= MAX_SKIPPED or not pending_limit.full():
+                        break
+                    # All pending candidates belong to other levels, wait until one of them is finished
+                    await pending_limit.wait()
+                    continue
+
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    new_offsets, new_inputs = pending.pop(future)
+                    best_duration = strategy.best_duration
+                    completed, duration, *telemetry = future.result()
+                    progress = None
+                    if telemetry and not completed:
+                        if best_telemetry is not None:
+                            progress = trajectory_progress(telemetry[0], best_telemetry, best_duration)
+                        # Only runs in which a player touched a hazard died. Other failed runs, e.g. the ones aborted by the cutoff,
+                        # may still complete the level with different later inputs.
+                        if telemetry[0]['hazard'] is not None:
+                            fatal_prefixes.add(new_inputs, duration)
+                    strategy.tell(new_offsets, (completed, duration), progress)
+                    num_finished += 1
+                    if strategy.best_duration < best_duration:
+                        if telemetry:
+                            best_telemetry = telemetry[0]
+                        print(f"{inputs_file}: New best: {strategy.best_duration} frames ({strategy.best_duration / 60:.2f} seconds) after {num_finished} evaluations")
+                        log_convergence(level, num_finished, time.perf_counter() - start_time, strategy.best_duration)
+                        write_best()
+                    if num_finished % ITERATION_NUM_CANDIDATES == 0:
+                        pruned = f", pruned {num_pruned} candidates that die" if fatal_prefixes is not None else ""
+                        print(f"{inputs_file}: {num_finished} evaluations in {time.perf_counter() - start_time:.0f}s, visited {len(visited)} items ({visited.nbytes / 1024 / 1024:.1f} MB){pruned}, best {strategy.best_duration} frames, {strategy.status()}")
+                save_checkpoint()
+        except asyncio.CancelledError:
+            save_checkpoint(force=True)
+            raise
+
+        elapsed = time.perf_counter() - start_time
+        print(f"{inputs_file}: Finished after {num_finished} evaluations in {elapsed:.0f}s, best {strategy.best_duration} frames (was {base_duration})")
+        print()
+        log_convergence(level, num_finished, elapsed, strategy.best_duration)
+
+        # The checkpoint of a finished level is kept until all levels are finished, so that resuming a run of several levels skips it
+        finished = True
+        pending.clear()
+        save_checkpoint(force=True, with_visited=False)
+        visited_state.remove()
+
+    async def main():
+        async with AsyncTASPool(max_workers=MAX_WORKERS, binary=BINARY) as pool:
+            # The pool may have a different number of workers than MAX_WORKERS, e.g. with servers on other machines
+            pending_limit = PendingLimit(PENDING_PER_WORKER * pool.num_workers)
+            running_levels = asyncio.Semaphore(INTERLEAVE_LEVELS)
+
+            async def run_level(level: int):
+                async with running_levels:
+                    await optimize_level(pool, level, pending_limit)
+
+            async with asyncio.TaskGroup() as tasks:
+                for level in range(start, end):
+                    tasks.create_task(run_level(level))
+        print(pool.metrics.report())
+
+        # The whole run is done, so a later run with --resume starts over instead of skipping these levels
+        for level in range(start, end):
+            default_checkpoint(f'optimize_lvl{level:03d}').remove()
+            visited_checkpoint(level).remove()
+
+    asyncio.run(main())
+
+    if cache is not None:
+        print(f"Result cache: {cache.hits} hits, {cache.misses} misses")
@@ -0,0 +1,49 @@
+"""
+Conversion between recordings and offsets. A recording is a list of lines with a frame and one or more key presses (+) or releases (-),
+e.g. `120 +D +W`. split turns it into the offset of each key event from the previous event of the same player, the keys, and the index
+at which the events of the right player start. Changing one offset shifts all later events of that player. combine turns this back into
+a recording, or returns None if an event would be before the start of the level.
+"""
+
+from typing import Sequence
+
+
+def split(inputs: list[str]) -> tuple[list[int], list[str], int]:
+    out_left = []
+    out_right = []
+    for line in inputs:
+        if not line:
+            continue
+        frame, *keys = line.split()
+        for key in keys:
+            if key[1] in {'W', 'A', 'D'}:
+                out_left.append((int(frame), key))
+            else:
+                out_right.append((int(frame), key))
+    
+    offsets = []
+    keys = []
+    split_index = len(out_left)
+    for out in (out_left, out_right):
+        last_frame = 0
+        for frame, key in out:
+            offset = frame - last_frame
+            last_frame = frame
+            offsets.append(offset)
+            keys.append(key)
+    
+    return offsets, keys, split_index
+
+def combine(offsets: Sequence[int], keys: Sequence[str], split_index: int) -> list[str] | None:
+    frame = 0
+    inputs_out = []
+    for i, (offset, key) in enumerate(zip(offsets, keys)):
+        if i == split_index:
+            frame = 0
+        frame += offset
+        inputs_out.append((frame, key))
+    inputs_out.sort()
+    if inputs_out[0][0] < 0:
+        return None
+    else:
+        return [f'{f} {k}' for f, k in inputs_out]
@@ -1,7 +1,99 @@
+"""
+Checks that the recordings of a range of levels still complete in the time in their file name, and that replaying them gives the same result every time.
+
+Each recording is replayed up to REPEATS times. The replays of all recordings are scheduled as one job on all workers: the first replay of every
+recording comes before the second replay of any, and so on, so mismatched times show up early. The replays of a recording stop at the first
+result that differs from the others.
+
+The results are written to a JSON report (TASMANIAC_RETIME_REPORT, default reports/retime.json), with the game fingerprint and for each recording
+its status ('matches', 'mismatched_time', 'no_expected_time', 'inconsistent', 'unreliable' or 'error'), the results seen and the number of replays.
+If a report from an earlier run exists, the recordings whose status or duration changed since then are listed before it is replaced.
+Use a different report file for each range of levels that you check separately.
+"""
+
+import os
 import sys
+import json
+import asyncio
 from pathlib import Path
-from tas_server import TASExecutor, play_level
+from tas_server import AsyncTASPool, game_fingerprint, write_atomic
+
+
+MAX_WORKERS = int(os.getenv("TASMANIAC_MAX_WORKERS") or "10")
+# Send requests in the compact binary format instead of JSON.
+BINARY = (os.getenv("TASMANIAC_WIRE_FORMAT") or "json") == "binary"
+REPORT_FILE = Path(os.getenv("TASMANIAC_RETIME_REPORT") or 'reports/retime.json')
+REPEATS = 20
+
+
+async def verify(pool: AsyncTASPool, level: int, inputs_file: Path) -> dict:
+    """
+    Replay a recording up to REPEATS times and return its entry in the report.
+    """
+
+    try:
+        expected_time = float(inputs_file.stem.split('_')[1])
+    except (IndexError, ValueError):
+        expected_time = None
+
+    with open(inputs_file, mode='r') as f:
+        base_inputs = f.read().splitlines()
 
+    # Later replays get a higher priority value, so they are played after the earlier replays of all other recordings
+    futures = [pool.submit(level, base_inputs, priority=i) for i in range(REPEATS)]
+    results = list[tuple[bool, int]]()
+    entry = {'level': level, 'expected_seconds': expected_time}
+    try:
+        async for future in pool.as_completed(futures):
+            results.append(future.result())
+            if len(set(results)) > 1:
+                break
+    except Exception as err:
+        print(f"{inputs_file}: Error: {err}")
+        return entry | {'status': 'error', 'message': str(err), 'results': [], 'replays': len(results)}
+    finally:
+        for future in futures:
+            future.cancel()
+
+    entry |= {'results': sorted({(completed, duration) for completed, duration in results}), 'replays': len(results)}
+    completed = [duration for is_completed, duration in results if is_completed]
+    if len(completed) < len(results):
+        print(f"{inputs_file}: Unreliable inputs: {len(completed)} of {len(results)} runs completed successfully")
+        return entry | {'status': 'unreliable'}
+
+    distinct_durations = set(completed)
+    if len(distinct_durations) != 1:
+        print(f"{inputs_file}: Inconsistent times: {min(distinct_durations) / 60:.2f} - {max(distinct_durations) / 60:.2f} seconds")
+        return entry | {'status': 'inconsistent'}
+
+    duration = completed[0]
+    entry['duration_ticks'] = duration
+    if expected_time is None:
+        print(f"{inputs_file}: No time in file name, got {duration / 60:.2f} seconds")
+        return entry | {'status': 'no_expected_time'}
+    if float(f"{duration / 60:.2f}") != expected_time:
+        print(f"{inputs_file}: Mismatched time: expected {expected_time:.2f} seconds, got {duration / 60:.2f} seconds")
+        return entry | {'status': 'mismatched_time'}
+
+    print(f"{inputs_file}: Time matches")
+    return entry | {'status': 'matches'}
+
+def compare_reports(previous: dict, report: dict):
+    """
+    Print the recordings whose status or duration differs between two reports.
+    """
+
+    if previous.get('fingerprint') != report['fingerprint']:
+        print(f"Game or TASmaniac changed since the previous report: {previous.get('fingerprint')} -> {report['fingerprint']}")
+    changes = 0
+    for name, entry in report['recordings'].items():
+        old_entry = previous.get('recordings', {}).get(name)
+        if old_entry is None:
+            continue
+        if old_entry['status'] != entry['status'] or old_entry.get('duration_ticks') != entry.get('duration_ticks'):
+            print(f"{name}: Changed from {old_entry['status']} ({old_entry.get('duration_ticks')} frames) to {entry['status']} ({entry.get('duration_ticks')} frames)")
+            changes += 1
+    print(f"{changes} changes since the previous report")
 
 if __name__ == '__main__':
     if len(sys.argv) == 2:
@@ -14,33 +106,20 @@ if __name__ == '__main__':
         print("ERROR: Expected 1 or 2 arguments")
         sys.exit(1)
 
-    with TASExecutor(max_workers=6) as executor:
-        for level in range(start, end):
-            inputs_file = sorted(Path('recordings').glob(f'lvl{level:03d}_*.txt'))[0]
-
-            expected_time = float(inputs_file.stem.split('_')[1])
-            
-            with open(inputs_file, mode='r') as f:
-                base_inputs = f.read().splitlines()
-
-            repeats = 20
-            durations = [] 
-
-            for completed, duration in executor.map(lambda conn, _: play_level(conn, level, base_inputs), range(repeats)):
-                if completed:
-                    durations.append(duration)
-            
-            if len(durations) < repeats:
-                print(f"{inputs_file}: Unreliable inputs: {len(durations) / repeats * 100:.0f}% of runs completed successfully")
-                continue
-            
-            distinct_durations = set(durations)
-            if len(distinct_durations) != 1:
-                print(f"{inputs_file}: Inconsistent times: {min(distinct_durations) / 60:.2f} - {max(distinct_durations) / 60:.2f} seconds")
-                continue
-
-            if float(f"{durations[0] / 60:.2f}") != expected_time:
-                print(f"{inputs_file}: Mismatched time: expected {expected_time:.2f} seconds, got {durations[0] / 60:.2f} seconds")
-                continue
-            
-            print(f"{inputs_file}: Time matches")
+    async def main() -> dict:
+        async with AsyncTASPool(max_workers=MAX_WORKERS, binary=BINARY) as pool:
+            inputs_files = {level: sorted(Path('recordings').glob(f'lvl{level:03d}_*.txt'))[0] for level in range(start, end)}
+            entries = await asyncio.gather(*(verify(pool, level, inputs_file) for level, inputs_file in inputs_files.items()))
+        print(pool.metrics.report())
+        return {inputs_file.as_posix(): entry for inputs_file, entry in zip(inputs_files.values(), entries)}
+
+    recordings = asyncio.run(main())
+    report = {'fingerprint': game_fingerprint(), 'repeats': REPEATS, 'recordings': recordings}
+
+    statuses = [entry['status'] for entry in recordings.values()]
+    print(f"{statuses.count('matches')} of {len(statuses)} recordings match their time")
+    if REPORT_FILE.exists():
+        with open(REPORT_FILE, mode='r') as f:
+            compare_reports(json.load(f), report)
+    write_atomic(REPORT_FILE, json.dumps(report, indent=2) + '\n')
+    print(f"Written report to {REPORT_FILE}")
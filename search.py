@@ -0,0 +1,500 @@
+import csv
+import math
+import random
+import struct
+import hashlib
+from array import array
+from pathlib import Path
+
+
+# Search strategies for optimize.py. A strategy works on the offsets of a recording (see split in recording.py) and is driven by
+# optimize_level, which repeatedly asks it for new candidates with `propose` and reports their results with `tell`.
+# Several candidates are played at the same time, so a strategy has to keep proposing before it knows the results of its earlier proposals.
+# Candidates are aborted by the server once they are slower than `max_ticks`, so a strategy that accepts slower candidates raises it.
+#
+# The candidates that were already played are kept in a VisitedTable or VisitedBloomFilter, which store a 64-bit hash per candidate
+# instead of the candidate itself, so that long runs on long levels fit in a fixed amount of memory.
+
+
+class Strategy:
+    """
+    Base class for search strategies. Subclasses implement `propose` and usually extend `tell`.
+    The best offsets and duration seen so far are kept in best_offsets and best_duration.
+    If weights are set (see load_sensitivity), offsets are picked for a change with a chance proportional to their weight.
+    """
+
+    weights: list[float] | None = None
+
+    def __init__(self, base_offsets: tuple[int, ...], base_duration: int, split_index: int, rng: random.Random) -> None:
+        self.best_offsets = base_offsets
+        self.best_duration = base_duration
+        self.split_index = split_index
+        self.rng = rng
+        # Set once the strategy has nothing left to try
+        self.done = False
+
+    def propose(self) -> tuple[int, ...] | None:
+        """
+        Return the next candidate, or None if the strategy has to wait for the results of earlier candidates first.
+        """
+        raise NotImplementedError
+
+    def tell(self, offsets: tuple[int, ...], result: tuple[bool, int] | None, progress: float | None = None):
+        """
+        Report the result of a proposed candidate. The result is None if the candidate was not played,
+        because it was played before or because it is invalid (e.g. it moves an input before the start of the level).
+        For candidates that did not complete the level, progress may give the fraction of the best run that the candidate
+        got through before it failed, between 0 and 1 (see trajectory_progress in optimize.py).
+        """
+        if result is not None:
+            completed, duration = result
+            if completed and duration < self.best_duration:
+                self.best_duration = duration
+                self.best_offsets = offsets
+
+    def tell_pruned(self, offsets: tuple[int, ...], death_tick: int):
+        """
+        Report a candidate that was not played because it is known to die at death_tick (see FatalPrefixes in optimize.py).
+        Unlike results of played candidates, this is reported right after the candidate was proposed.
+        """
+        self.tell(offsets, (False, death_tick))
+
+    def max_ticks(self, slack: int) -> int | None:
+        """
+        Return the tick after which the next candidate is aborted, or None to always play it to the end. Aborted candidates are
+        reported as failed, so this has to be high enough for every candidate that the strategy could accept.
+        By default candidates are aborted once they are more than slack ticks slower than the best one.
+        """
+        return self.best_duration + slack
+
+    def status(self) -> str:
+        """
+        Return a short description of the state of the search for progress messages.
+        """
+        return ''
+
+    def pick_index(self) -> int:
+        if self.weights is not None:
+            return self.rng.choices(range(len(self.weights)), self.weights)[0]
+        return self.rng.randrange(len(self.best_offsets))
+
+    def mutate(self, offsets: tuple[int, ...], num_moves: int, max_shift: int = 10) -> tuple[int, ...]:
+        """
+        Change num_moves random offsets by up to max_shift. Changing an offset shifts all later inputs of the same player,
+        so half of the moves also change the next offset in the opposite direction, which moves only a single input.
+        """
+        new_offsets = list(offsets)
+        for _ in range(num_moves):
+            index = self.pick_index()
+            shift = self.rng.choice([-1, 1]) * self.rng.randint(1, max_shift)
+            new_offsets[index] += shift
+            if index + 1 < len(new_offsets) and index + 1 != self.split_index and self.rng.random() < 0.5:
+                new_offsets[index + 1] -= shift
+        return tuple(new_offsets)
+
+class RandomWalk(Strategy):
+    """
+    Change one offset by up to ±10 at a time. Improvements are always accepted, and other completed candidates are accepted
+    with a chance that starts at 36% and decreases in steps of 4% every iteration of iteration_candidates candidates, cycling every 10 iterations.
+    Any slower candidate can be accepted, so candidates are only cut off in the iterations where the chance is 0.
+    """
+
+    def __init__(self, base_offsets: tuple[int, ...], base_duration: int, split_index: int, rng: random.Random, iteration_candidates: int = 80) -> None:
+        super().__init__(base_offsets, base_duration, split_index, rng)
+        self.iteration_candidates = iteration_candidates
+        self.last_offsets = base_offsets
+        self.last_duration = base_duration
+        self.num_proposed = 0
+        # The chance for each pending proposal, oldest first. The same offsets can be proposed again before the first result is known,
+        # but then the repeat is skipped and told right away.
+        self.change_chances = dict[tuple[int, ...], list[float]]()
+
+    def change_chance(self, num_proposed: int) -> float:
+        i = num_proposed // self.iteration_candidates
+        return (9 - i % 10) * 0.04
+
+    def propose(self) -> tuple[int, ...]:
+        chance = self.change_chance(self.num_proposed)
+        self.num_proposed += 1
+
+        new_offsets = list(self.last_offsets)
+        random_index = self.pick_index()
+        new_offsets[random_index] += self.rng.randint(-10, 10)
+        new_offsets = tuple(new_offsets)
+        self.change_chances.setdefault(new_offsets, []).append(chance)
+        return new_offsets
+
+    def max_ticks(self, slack: int) -> int | None:
+        # The limit is for the candidate that was proposed last
+        if self.change_chance(max(0, self.num_proposed - 1)) > 0:
+            return None
+        return max(super().max_ticks(slack), self.last_duration)
+
+    def tell(self, offsets: tuple[int, ...], result: tuple[bool, int] | None, progress: float | None = None):
+        super().tell(offsets, result, progress)
+        # Skipped proposals are told right after they are proposed, so they are the newest, while results come in for the oldest
+        chances = self.change_chances[offsets]
+        random_change_chance = chances.pop() if result is None else chances.pop(0)
+        if not chances:
+            del self.change_chances[offsets]
+        if result is not None:
+            completed, duration = result
+            if completed and (duration < self.last_duration or self.rng.random() < random_change_chance):
+                self.last_duration = duration
+                self.last_offsets = offsets
+
+    def tell_pruned(self, offsets: tuple[int, ...], death_tick: int):
+        # Failed candidates are never accepted, so this only has to remove the chance of the proposal, which is the newest like for skipped ones
+        self.tell(offsets, None)
+
+    def status(self) -> str:
+        return f"last duration {self.last_duration} frames"
+
+class MultiMove(Strategy):
+    """
+    Hill climb that changes 1 to max_moves offsets at a time (see `mutate`). Candidates that are as fast as the current one are
+    accepted too, so that the search can cross plateaus.
+    """
+
+    def __init__(self, base_offsets: tuple[int, ...], base_duration: int, split_index: int, rng: random.Random, max_moves: int = 4) -> None:
+        super().__init__(base_offsets, base_duration, split_index, rng)
+        self.max_moves = max_moves
+        self.current_offsets = base_offsets
+        self.current_duration = base_duration
+
+    def propose(self) -> tuple[int, ...]:
+        return self.mutate(self.current_offsets, self.rng.randint(1, self.max_moves))
+
+    def tell(self, offsets: tuple[int, ...], result: tuple[bool, int] | None, progress: float | None = None):
+        super().tell(offsets, result, progress)
+        if result is not None:
+            completed, duration = result
+            if completed and duration <= self.current_duration:
+                self.current_offsets = offsets
+                self.current_duration = duration
+
+    def status(self) -> str:
+        return f"current duration {self.current_duration} frames"
+
+class CoordinateSweep(Strategy):
+    """
+    Try every shift of up to ±radius for every offset, starting from the smallest shifts, always from the current offsets.
+    Candidates that are as fast as the current one replace it, because the time of a level often only improves after several
+    offsets have changed (e.g. both players have to be faster). Sweeps are repeated until a whole sweep changes nothing.
+    """
+
+    def __init__(self, base_offsets: tuple[int, ...], base_duration: int, split_index: int, rng: random.Random, radius: int = 10) -> None:
+        super().__init__(base_offsets, base_duration, split_index, rng)
+        self.radius = radius
+        self.current_offsets = base_offsets
+        self.current_duration = base_duration
+        self.num_sweeps = 0
+        self.num_pending = 0
+        self.changed = False
+        self.start_sweep()
+
+    def start_sweep(self):
+        self.num_sweeps += 1
+        self.changed = False
+        self.moves = [(index, sign * distance) for distance in range(1, self.radius + 1) for index in range(len(self.current_offsets)) for sign in (-1, 1)]
+        self.moves.reverse()
+
+    def propose(self) -> tuple[int, ...] | None:
+        if not self.moves:
+            # A new sweep starts once all results of this one are known, because it depends on whether any of them changed the current offsets.
+            if self.num_pending:
+                return None
+            if not self.changed:
+                self.done = True
+                return None
+            self.start_sweep()
+
+        index, shift = self.moves.pop()
+        new_offsets = list(self.current_offsets)
+        new_offsets[index] += shift
+        self.num_pending += 1
+        return tuple(new_offsets)
+
+    def tell(self, offsets: tuple[int, ...], result: tuple[bool, int] | None, progress: float | None = None):
+        super().tell(offsets, result, progress)
+        self.num_pending -= 1
+        if result is not None:
+            completed, duration = result
+            if completed and duration <= self.current_duration:
+                self.current_offsets = offsets
+                self.current_duration = duration
+                self.changed = True
+
+    def status(self) -> str:
+        return f"sweep {self.num_sweeps}, {len(self.moves)} moves left, current duration {self.current_duration} frames"
+
+class SimulatedAnnealing(Strategy):
+    """
+    Change 1 to 3 offsets at a time and accept candidates that are slower by d frames with a chance of exp(-d / temperature).
+    The temperature starts at initial_temperature and is multiplied by cooling after every result.
+    Candidates are played until they are slow enough that their chance to be accepted drops below min_accept_chance.
+    """
+
+    min_accept_chance = 0.01
+
+    def __init__(self, base_offsets: tuple[int, ...], base_duration: int, split_index: int, rng: random.Random, initial_temperature: float = 2.0, cooling: float = 0.998, min_temperature: float = 0.05) -> None:
+        super().__init__(base_offsets, base_duration, split_index, rng)
+        self.temperature = initial_temperature
+        self.cooling = cooling
+        self.min_temperature = min_temperature
+        self.current_offsets = base_offsets
+        self.current_duration = base_duration
+
+    def propose(self) -> tuple[int, ...]:
+        return self.mutate(self.current_offsets, self.rng.randint(1, 3))
+
+    def max_ticks(self, slack: int) -> int | None:
+        margin = math.ceil(self.temperature * -math.log(self.min_accept_chance))
+        return max(super().max_ticks(slack), self.current_duration + margin)
+
+    def tell(self, offsets: tuple[int, ...], result: tuple[bool, int] | None, progress: float | None = None):
+        super().tell(offsets, result, progress)
+        if result is None:
+            return
+        completed, duration = result
+        if completed:
+            delta = duration - self.current_duration
+            if delta <= 0 or self.rng.random() < math.exp(-delta / self.temperature):
+                self.current_offsets = offsets
+                self.current_duration = duration
+        self.temperature = max(self.min_temperature, self.temperature * self.cooling)
+
+    def status(self) -> str:
+        return f"current duration {self.current_duration} frames, temperature {self.temperature:.2f}"
+
+class Evolution(Strategy):
+    """
+    Keep the population_size fastest candidates. New candidates are either a mutation of a parent picked by a tournament
+    between two random members of the population, or (with chance crossover_chance) a crossover of two parents with a small mutation.
+
+    If progress is reported for failed candidates, the ones that got furthest are kept as near misses, and with chance
+    near_miss_chance one of them is used as a parent instead, since a crossover with a completed parent can fix the part that failed.
+    """
+
+    def __init__(self, base_offsets: tuple[int, ...], base_duration: int, split_index: int, rng: random.Random, population_size: int = 16, crossover_chance: float = 0.3, near_miss_chance: float = 0.1) -> None:
+        super().__init__(base_offsets, base_duration, split_index, rng)
+        self.population_size = population_size
+        self.crossover_chance = crossover_chance
+        self.near_miss_chance = near_miss_chance
+        self.population = [(base_duration, base_offsets)]
+        # Failed candidates as (-progress, offsets), best first
+        self.near_misses = list[tuple[float, tuple[int, ...]]]()
+
+    def pick_parent(self) -> tuple[int, ...]:
+        if self.near_misses and self.rng.random() < self.near_miss_chance:
+            return self.rng.choice(self.near_misses)[1]
+        return min(self.rng.choice(self.population), self.rng.choice(self.population))[1]
+
+    def propose(self) -> tuple[int, ...]:
+        if len(self.population) >= 2 and self.rng.random() < self.crossover_chance:
+            first, second = self.pick_parent(), self.pick_parent()
+            child = tuple(a if self.rng.random() < 0.5 else b for a, b in zip(first, second))
+            return self.mutate(child, 1)
+        return self.mutate(self.pick_parent(), self.rng.randint(1, 3))
+
+    def max_ticks(self, slack: int) -> int | None:
+        # Every completed candidate joins the population until it is full, and after that every one that beats its slowest member
+        if len(self.population) < self.population_size:
+            return None
+        return max(super().max_ticks(slack), self.population[-1][0])
+
+    def tell(self, offsets: tuple[int, ...], result: tuple[bool, int] | None, progress: float | None = None):
+        super().tell(offsets, result, progress)
+        if result is None:
+            return
+        completed, duration = result
+        if completed and all(offsets != member for _, member in self.population):
+            self.population.append((duration, offsets))
+            self.population.sort()
+            del self.population[self.population_size:]
+        elif not completed and progress is not None and all(offsets != member for _, member in self.near_misses):
+            self.near_misses.append((-progress, offsets))
+            self.near_misses.sort()
+            del self.near_misses[self.population_size // 4:]
+
+    def status(self) -> str:
+        near_misses = f", best near miss {-self.near_misses[0][0]:.0%}" if self.near_misses else ""
+        return f"population {len(self.population)}, worst {self.population[-1][0]} frames{near_misses}"
+
+
+STRATEGIES: dict[str, type[Strategy]] = {
+    'random_walk': RandomWalk,
+    'multi_move': MultiMove,
+    'sweep': CoordinateSweep,
+    'anneal': SimulatedAnnealing,
+    'evolution': Evolution,
+}
+
+
+def load_sensitivity(path: str | Path, base_offsets: tuple[int, ...]) -> list[float] | None:
+    """
+    Load a table written by sweep.py and return a weight for each offset: offsets whose shifts change the duration get more weight,
+    and offsets with shifts that make the level faster even more. Every offset keeps a small weight, because offsets that change nothing
+    on their own can still matter together with others. Returns None if the table was made for different offsets.
+    """
+    changed = [0] * len(base_offsets)
+    improved = [0] * len(base_offsets)
+    shifts = [0] * len(base_offsets)
+    with open(path, mode='r', newline='') as f:
+        for row in csv.DictReader(f):
+            index = int(row['index'])
+            if index >= len(base_offsets) or int(row['offset']) != base_offsets[index]:
+                return None
+            shifts[index] += 1
+            if row['result'] == 'completed' and int(row['delta']) != 0:
+                changed[index] += 1
+                if int(row['delta']) < 0:
+                    improved[index] += 1
+    if 0 in shifts:
+        return None
+    return [0.1 + (changed[i] + 4 * improved[i]) / shifts[i] for i in range(len(base_offsets))]
+
+def offsets_hash(offsets: tuple[int, ...]) -> int:
+    """
+    Return a 64-bit hash of offsets that is never 0 and is the same in every run (unlike `hash`), so it can be saved and loaded.
+    """
+    digest = hashlib.blake2b(struct.pack(f'<{len(offsets)}q', *offsets), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+class VisitedTable:
+    """
+    Set of offsets, stored as 64-bit hashes in an open addressing hash table. Two different offsets have the same hash with
+    negligible probability, so membership is exact for all practical purposes.
+
+    The table grows as needed, but never beyond max_bytes. When it is full at that size, it is cleared and starts over,
+    so candidates from before that may be played again (the result cache in tas_server.py still catches most of them).
+    """
+
+    MAX_LOAD = 0.7
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.num_resets = 0
+        self._table = array('Q', bytes(8 * 1024))
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, offsets: tuple[int, ...]) -> bool:
+        return self._contains_hash(offsets_hash(offsets))
+
+    def add(self, offsets: tuple[int, ...]):
+        self._add_hash(offsets_hash(offsets))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._table) * self._table.itemsize
+
+    def to_bytes(self) -> bytes:
+        return self._table.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, max_bytes: int = 64 * 1024 * 1024) -> 'VisitedTable':
+        visited = cls(max_bytes)
+        table = array('Q')
+        table.frombytes(data)
+        # The table size is always a power of two (see _grow)
+        if len(table) & (len(table) - 1):
+            raise ValueError("Invalid visited table")
+        visited._table = table
+        visited._count = len(table) - table.count(0)
+        return visited
+
+    def _contains_hash(self, h: int) -> bool:
+        table = self._table
+        mask = len(table) - 1
+        i = h & mask
+        while table[i] != 0:
+            if table[i] == h:
+                return True
+            i = (i + 1) & mask
+        return False
+
+    def _add_hash(self, h: int):
+        if self._count + 1 > self.MAX_LOAD * len(self._table):
+            self._grow()
+        table = self._table
+        mask = len(table) - 1
+        i = h & mask
+        while table[i] != 0:
+            if table[i] == h:
+                return
+            i = (i + 1) & mask
+        table[i] = h
+        self._count += 1
+
+    def _grow(self):
+        old_table = self._table
+        size = 2 * len(old_table)
+        if size * old_table.itemsize > self.max_bytes:
+            self._table = array('Q', bytes(self.nbytes))
+            self._count = 0
+            self.num_resets += 1
+            return
+        self._table = array('Q', bytes(size * old_table.itemsize))
+        self._count = 0
+        for h in old_table:
+            if h != 0:
+                self._add_hash(h)
+
+class VisitedBloomFilter:
+    """
+    Set of offsets, stored in a Bloom filter of max_bytes bytes. Membership tests of offsets that were never added return True
+    with a chance of about false_positive_rate, as long as at most `capacity` offsets have been added. Those candidates are
+    skipped without being played. When the filter exceeds its capacity, it is cleared and starts over.
+
+    This holds several times more candidates than VisitedTable in the same memory, at the cost of skipping some new candidates.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, false_positive_rate: float = 0.001) -> None:
+        self.max_bytes = max_bytes
+        self.false_positive_rate = false_positive_rate
+        self.num_resets = 0
+        num_bits = 8 * max_bytes
+        self.capacity = max(1, int(-num_bits * math.log(2) ** 2 / math.log(false_positive_rate)))
+        self.num_hashes = max(1, round(num_bits / self.capacity * math.log(2)))
+        self._bits = bytearray(max_bytes)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, offsets: tuple[int, ...]) -> bool:
+        bits = self._bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indices(offsets_hash(offsets)))
+
+    def add(self, offsets: tuple[int, ...]):
+        if self._count >= self.capacity:
+            self._bits = bytearray(self.max_bytes)
+            self._count = 0
+            self.num_resets += 1
+        bits = self._bits
+        for i in self._indices(offsets_hash(offsets)):
+            bits[i >> 3] |= 1 << (i & 7)
+        self._count += 1
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def to_bytes(self) -> bytes:
+        return self._count.to_bytes(8, 'little') + self._bits
+
+    @classmethod
+    def from_bytes(cls, data: bytes, false_positive_rate: float = 0.001) -> 'VisitedBloomFilter':
+        visited = cls(len(data) - 8, false_positive_rate)
+        visited._count = int.from_bytes(data[:8], 'little')
+        visited._bits[:] = data[8:]
+        return visited
+
+    def _indices(self, h: int) -> list[int]:
+        # Double hashing: the i-th bit index is h1 + i * h2, with h1 and h2 taken from the two halves of the 64-bit hash
+        num_bits = 8 * len(self._bits)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
@@ -1,86 +1,87 @@
 from pathlib import Path
+import os
+import re
 import sys
 import time
+import asyncio
 import traceback
 from typing import Callable
 from watchdog.events import FileModifiedEvent
 from watchdog.observers import Observer
+from recording import split, combine
+
+
+# Saves that follow each other within this many seconds are handled as one, because editors often write a file in several steps.
+DEBOUNCE_SECONDS = 0.2
 
 
 def do_split(input_file: Path, output_file: Path):
     with open(input_file, mode='r') as f:
         inputs = f.read().splitlines()
 
-    out_left = []
-    out_right = []
-    for line in inputs:
-        if not line:
-            continue
-        frame, *keys = line.split()
-        for key in keys:
-            if key[1] in {'W', 'A', 'D'}:
-                out_left.append((int(frame), key))
-            else:
-                out_right.append((int(frame), key))
-    
-    for inputs in (out_left, out_right):
-        last_frame = 0
-        for i, (frame, key) in enumerate(inputs):
-            offset = frame - last_frame
-            last_frame = frame
-            inputs[i] = f'{offset} {key}'
-    
+    offsets, keys, split_index = split(inputs)
+    lines = [f'{offset} {key}' for offset, key in zip(offsets, keys)]
+
     with open(output_file, mode='w') as f:
         f.write('# Left\n')
-        f.write('\n'.join(out_left))
+        f.write('\n'.join(lines[:split_index]))
         f.write('\n\n# Right\n')
-        f.write('\n'.join(out_right))
-    
+        f.write('\n'.join(lines[split_index:]))
+
     print(f"Written split output to {output_file}")
 
-def do_combine(input_file: Path, output_file: Path):
+def read_split(input_file: Path) -> tuple[list[int], list[str], int]:
+    """
+    Read a file written by do_split, possibly edited by hand, and return it in the format of recording.split.
+    Lines may hold several keys, which are pressed on the same frame, or only an offset, which delays the next line.
+    Lines before the first section belong to the left player.
+    """
+
     with open(input_file, mode='r') as f:
         inputs = f.read().splitlines()
-    
-    left_found, right_found = False, False
-    frame = 0
-    inputs_out = []
+
+    sections = {'Left': ([], []), 'Right': ([], [])}
+    found = set()
+    section = 'Left'
+    pending_offset = 0
     for line in inputs:
         line = line.strip()
         if not line:
             continue
         if line.startswith('#'):
             section = line.removeprefix('#').strip()
-            if section == 'Left':
-                if left_found:
-                    print("ERROR: Multiple left sections found")
-                    sys.exit(1)
-                left_found = True
-                frame = 0
-            elif section == 'Right':
-                if right_found:
-                    print("ERROR: Multiple right sections found")
-                    sys.exit(1)
-                right_found = True
-                frame = 0
-            else:
+            if section not in sections:
                 print(f"ERROR: Unknown section: {section}")
                 sys.exit(1)
+            if section in found or (section == 'Left' and sections['Left'][0]):
+                print(f"ERROR: Multiple {section.lower()} sections found")
+                sys.exit(1)
+            found.add(section)
+            pending_offset = 0
             continue
-        components = line.split(maxsplit=1)
-        if len(components) == 2:
-            offset, keys = components
-            frame += int(offset)
-            inputs_out.append((frame, keys))
-        else:
-            offset = line
-            frame += int(offset)
-    inputs_out.sort()
+        offset, *keys = line.split()
+        pending_offset += int(offset)
+        offsets, section_keys = sections[section]
+        for key in keys:
+            offsets.append(pending_offset)
+            section_keys.append(key)
+            pending_offset = 0
+
+    (left_offsets, left_keys), (right_offsets, right_keys) = sections['Left'], sections['Right']
+    return left_offsets + right_offsets, left_keys + right_keys, len(left_keys)
+
+def do_combine(input_file: Path, output_file: Path) -> list[str]:
+    offsets, keys, split_index = read_split(input_file)
+    inputs_out = combine(offsets, keys, split_index) if keys else []
+    if inputs_out is None:
+        print("ERROR: Inputs before the start of the level")
+        sys.exit(1)
 
     with open(output_file, mode='w') as f:
-        f.write('\n'.join(f'{f} {k}' for f, k in inputs_out))
-    
+        f.write('\n'.join(inputs_out))
+
     print(f"Written combined output to {output_file}")
+    return inputs_out
 
 def wrap_func(func: Callable, *args):
     def wrapped():
@@ -92,6 +93,98 @@ def wrap_func(func: Callable, *args):
             traceback.print_exception(e)
     return wrapped
 
+async def evaluate_on_save(level: int, input_file: Path, output_file: Path):
+    """
+    Combine the split file and play the combined inputs every time the split file is saved, and print how the duration changed.
+    The servers stay connected between saves. If the file is saved with different inputs while the previous version is still being played,
+    that evaluation is cancelled: it is removed from the queue, or its result is ignored if a server is already playing it.
+    Saves that do not change the inputs of the version being played or of the last played version do not start a new evaluation.
+    """
+
+    from tas_server import AsyncTASPool, default_cache
+    from watchdog.events import FileSystemEventHandler
+
+    # A second worker lets a new version start right away while a server is still busy with a version that was replaced.
+    max_workers = int(os.getenv("TASMANIAC_MAX_WORKERS") or "2")
+    snapshot_interval = int(os.getenv("TASMANIAC_SNAPSHOT_INTERVAL") or "0")
+    restart = os.getenv("TASMANIAC_RESTART") or "full"
+    binary = (os.getenv("TASMANIAC_WIRE_FORMAT") or "json") == "binary"
+    cache = default_cache()
+
+    loop = asyncio.get_running_loop()
+    saved = asyncio.Event()
+
+    class EventHandler(FileSystemEventHandler):
+        def on_modified(self, event):
+            if Path(event.src_path) == input_file:
+                loop.call_soon_threadsafe(saved.set)
+
+    # The last version that was played: its inputs and result
+    previous: tuple[list[str], bool, int] | None = None
+
+    async def evaluate(inputs: list[str]):
+        nonlocal previous
+        start_time = time.perf_counter()
+        completed, duration = await pool.play_level(level, inputs, snapshot_interval=snapshot_interval, restart=restart, cache=cache)
+        elapsed = time.perf_counter() - start_time
+        if not completed:
+            print(f"{output_file}: Did not complete level, failed after {duration} frames ({elapsed:.2f}s)")
+        elif previous is not None and previous[1]:
+            print(f"{output_file}: {duration} frames ({duration / 60:.2f} seconds), {duration - previous[2]:+d} frames ({elapsed:.2f}s)")
+        else:
+            print(f"{output_file}: {duration} frames ({duration / 60:.2f} seconds) ({elapsed:.2f}s)")
+        previous = inputs, completed, duration
+
+    def report_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            traceback.print_exception(task.exception())
+
+    observer = Observer()
+    observer.schedule(EventHandler(), str(input_file.parent), event_filter=[FileModifiedEvent])
+    observer.start()
+    try:
+        async with AsyncTASPool(max_workers=max_workers, binary=binary) as pool:
+            evaluation: asyncio.Task | None = None
+            evaluated_inputs: list[str] | None = None
+            saved.set()
+            while True:
+                await saved.wait()
+                saved.clear()
+                while True:
+                    try:
+                        await asyncio.wait_for(saved.wait(), DEBOUNCE_SECONDS)
+                    except TimeoutError:
+                        break
+                    saved.clear()
+
+                try:
+                    inputs = do_combine(input_file, output_file)
+                except SystemExit:
+                    continue
+                except Exception as e:
+                    traceback.print_exception(e)
+                    continue
+
+                if evaluation is not None and not evaluation.done():
+                    if inputs == evaluated_inputs:
+                        print(f"{output_file}: Inputs unchanged, still evaluating")
+                        continue
+                    evaluation.cancel()
+                    print(f"{output_file}: Cancelled evaluation of the previous version")
+                if previous is not None and inputs == previous[0]:
+                    _, completed, duration = previous
+                    if completed:
+                        print(f"{output_file}: Inputs unchanged from the last evaluated version, {duration} frames ({duration / 60:.2f} seconds)")
+                    else:
+                        print(f"{output_file}: Inputs unchanged from the last evaluated version, which did not complete level, failed after {duration} frames")
+                    continue
+                evaluated_inputs = inputs
+                evaluation = asyncio.create_task(evaluate(inputs))
+                evaluation.add_done_callback(report_error)
+    finally:
+        observer.stop()
+        observer.join()
+
 if __name__ == '__main__':
     args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
     flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
@@ -122,12 +215,23 @@ if __name__ == '__main__':
     elif '--watch' in flags:
         watch = True
     
-    if watch:
-        from watchdog.events import FileModifiedEvent, FileSystemEventHandler
+    # With --evaluate, the watcher also plays the combined inputs after every save (see evaluate_on_save).
+    # The level is taken from the name of the recording, e.g. lvl012_05.28.txt.
+    if '--evaluate' in flags:
+        level_match = re.match(r'lvl(\d+)', input_file.name)
+        if not watch or level_match is None:
+            print("ERROR: --evaluate needs a recording named lvl<level>_... in watch mode")
+            sys.exit(1)
+        try:
+            asyncio.run(evaluate_on_save(int(level_match[1]), input_file, output_file))
+        except KeyboardInterrupt:
+            pass
+    elif watch:
+        from watchdog.events import FileSystemEventHandler
 
         class EventHandler(FileSystemEventHandler):
             def on_modified(self, event):
-                if event.src_path == str(input_file):
+                if Path(event.src_path) == input_file:
                     func()
 
         observer = Observer()
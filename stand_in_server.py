@@ -0,0 +1,510 @@
+import re
+import sys
+import json
+import base64
+import time
+import random
+import struct
+import asyncio
+from websockets.asyncio.server import ServerConnection, serve
+
+
+# Stand-in for the TASmaniac WebSocket server, for developing and benchmarking the scripts on machines without the game.
+# It speaks the same protocol as tasmaniac/websocket_server.gd (JSON and binary requests and results, batches, ping, max_ticks,
+# restart modes and timings), but plays a simple deterministic level instead of the real one, and never resumes from snapshots.
+#
+# Usage: python stand_in_server.py --server=<port> [--tick-cost=<microseconds>] [--load-time=<milliseconds>] [--fast-load-time=<milliseconds>]
+#        python stand_in_server.py --solve=<level>
+# --tick-cost, --load-time and --fast-load-time set how much CPU time each simulated tick, full reload and fast restart takes.
+# --solve prints a recording that completes the given level, for use with optimize.py and the other scripts.
+# Other arguments (e.g. --lean) are accepted and ignored, so the stand-in can be started in place of the game by setting
+# TASMANIAC_SERVER_COMMAND="python stand_in_server.py" (see start_server in tas_server.py).
+#
+# The level: each player runs along their own lane from x = 0 (or the x coordinate of their start position) to the goal.
+# W/U jump, A/L and D/R accelerate left and right. Touching the ground inside a pit fails the level, as does standing still
+# with no keys held after the last input. The level is completed when both players have reached the goal.
+# The goal and pits are generated from the level number. Telemetry reports the height as y and a coyote time of 0,
+# and a pit as the hazard of a failed run.
+
+
+SCHEDULE_END = 0x7fffffff
+ACTIONS = 'WADULR'
+COMMANDS = ['', 'play_level', 'play_levels']
+RESTART_MODES = ['full', 'fast', 'check']
+STATUSES = ['executed', 'aborted', 'finished']
+HEADER = struct.Struct('<6i')
+RESULT = struct.Struct('<12i')
+TELEMETRY_HEADER = struct.Struct('<5i')
+TELEMETRY_SAMPLE = struct.Struct('<11f')
+
+ACCELERATION = 0.25
+MAX_SPEED = 3.0
+FRICTION = 0.85
+AIR_DRAG = 0.98
+JUMP_SPEED = 4.0
+GRAVITY = 0.25
+# Runs that have not finished by this tick fail, like a player who gives up.
+TIMEOUT_TICKS = 60 * 60 * 10
+
+
+class Level:
+    def __init__(self, number: int) -> None:
+        rng = random.Random(number)
+        self.goal = rng.randint(300, 600)
+        # Pits are far enough apart that a single jump never lands in the next one.
+        slots = range(60, self.goal - 40, 120)
+        self.pits = [
+            [(start, start + rng.randint(8, 16)) for start in sorted(rng.sample(slots, rng.randint(1, len(slots))))]
+            for _ in range(2)
+        ]
+
+    def start(self, start_positions) -> list[list[float]]:
+        """Return the initial state of both players: x, horizontal velocity, height, vertical velocity."""
+        return [[0.0 if start_positions is None else max(0.0, float(start_positions[i][0])), 0.0, 0.0, 0.0] for i in range(2)]
+
+    def step(self, players: list[list[float]], held: int) -> str | None:
+        """
+        Advance both players by one tick. Returns "completed" if the level ended on this tick,
+        or "failed <player>" if a player fell into a pit.
+        """
+        for i, player in enumerate(players):
+            if player[0] >= self.goal:
+                continue
+            x, vx, y, vy = player
+            keys = held >> (3 * i)
+            if keys & 4:
+                vx = min(vx + ACCELERATION, MAX_SPEED)
+            elif keys & 2:
+                vx = max(vx - ACCELERATION, -MAX_SPEED)
+            else:
+                vx *= FRICTION if y == 0 else AIR_DRAG
+            if keys & 1 and y == 0:
+                vy = JUMP_SPEED
+            vy -= GRAVITY
+            y = max(0.0, y + vy)
+            if y == 0:
+                vy = 0.0
+            x = max(0.0, x + vx)
+            player[:] = x, vx, y, vy
+            if y == 0 and any(start <= x < end for start, end in self.pits[i]):
+                return f'failed {i}'
+        if all(player[0] >= self.goal for player in players):
+            return 'completed'
+        return None
+
+    def at_rest(self, players: list[list[float]]) -> bool:
+        return all(player[0] >= self.goal or (abs(player[1]) < 0.01 and player[2] == 0) for player in players)
+
+def simulate(level: Level, schedule: list[int], start_positions, max_ticks: int, telemetry_interval: int = 0) -> tuple[str, int, dict | None]:
+    """
+    Play a schedule of (frame, mask) events, in the format produced by compile_inputs.
+    Returns the result ("completed", "failed" or "aborted"), the frame at which the run ended and the telemetry
+    (None unless telemetry_interval is positive, see record_telemetry in tasmaniac/manager.gd).
+    """
+    players = level.start(start_positions)
+    held = 0
+    schedule_i = 0
+    frame = 0
+    telemetry = None if telemetry_interval <= 0 else {'interval': telemetry_interval, 'samples': bytearray(), 'hazard': None, 'hazard_tick': None, 'hazard_player': None}
+    while True:
+        while schedule[schedule_i] <= frame:
+            mask = schedule[schedule_i + 1]
+            held = (held & ~(mask >> 8)) | (mask & 0x3f)
+            schedule_i += 2
+        if telemetry is not None and frame % telemetry_interval == 0:
+            telemetry['samples'] += TELEMETRY_SAMPLE.pack(frame, *(value for x, vx, y, vy in players for value in (x, y, vx, vy, 0.0)))
+        frame += 1
+        # Like the manager, the limit is checked before the level processes the tick.
+        if max_ticks >= 0 and frame > max_ticks:
+            return 'aborted', frame, telemetry
+        result = level.step(players, held)
+        if result is not None:
+            result, _, player = result.partition(' ')
+            if telemetry is not None and player:
+                telemetry |= {'hazard': 'Pit', 'hazard_tick': frame, 'hazard_player': int(player)}
+            return result, frame, telemetry
+        if frame >= TIMEOUT_TICKS or (schedule[schedule_i] == SCHEDULE_END and held == 0 and level.at_rest(players)):
+            return 'failed', frame, telemetry
+
+def solve(level: Level) -> list[str]:
+    """Return inputs that complete the level: run right and jump just before every pit."""
+    players = level.start(None)
+    inputs = ['0 +D +R']
+    held = 0b100100
+    frame = 0
+    while True:
+        jumps = [
+            i for i in range(2)
+            if players[i][2] == 0 and any(0 < start - players[i][0] <= 10 for start, _ in level.pits[i])
+        ]
+        released = [ACTIONS[3 * i] for i in range(2) if held & (1 << (3 * i))]
+        line = [f'-{key}' for key in released] + [f'+{ACTIONS[3 * i]}' for i in jumps]
+        if line:
+            inputs.append(' '.join([str(frame), *line]))
+        held = (held & 0b100100) | sum(1 << (3 * i) for i in jumps)
+        frame += 1
+        result = level.step(players, held)
+        if result == 'completed':
+            return inputs
+        if result is not None or frame >= TIMEOUT_TICKS:
+            raise AssertionError(f"Failed to solve level, {result} at frame {frame}")
+
+def compile_inputs(lines: list[str]) -> dict:
+    # Same as compile_inputs in tasmaniac/manager.gd
+    compiled = []
+    last_frame = 0
+    for line_i, line in enumerate(lines):
+        parts = line.split()
+        if not parts:
+            continue
+        if not _is_valid_int(parts[0]) or int(parts[0]) < last_frame or int(parts[0]) >= SCHEDULE_END:
+            return {'error': f"invalid frame '{parts[0]}'", 'line': line_i + 1}
+        line_frame = int(parts[0])
+        mask = 0
+        for part in parts[1:]:
+            bit = ACTIONS.find(part[1:]) if len(part) == 2 else -1
+            if bit == -1 or part[0] not in '+-':
+                return {'error': f"invalid input '{part}'", 'line': line_i + 1}
+            if mask & (0x101 << bit):
+                compiled += (line_frame, mask)
+                mask = 0
+            mask |= 1 << bit if part[0] == '+' else 0x100 << bit
+        compiled += (line_frame, mask)
+        last_frame = line_frame
+    compiled += (SCHEDULE_END, 0)
+    return {'schedule': compiled}
+
+def compile_events(events: tuple[int, ...]) -> dict:
+    # Same as compile_events in tasmaniac/manager.gd
+    all_actions = (1 << len(ACTIONS)) - 1
+    valid_bits = all_actions | (all_actions << 8)
+    last_frame = 0
+    for i in range(0, len(events), 2):
+        if events[i] < last_frame or events[i] >= SCHEDULE_END:
+            return {'error': f"invalid frame {events[i]}", 'event': i // 2}
+        if events[i + 1] & ~valid_bits:
+            return {'error': f"invalid mask {events[i + 1]}", 'event': i // 2}
+        last_frame = events[i]
+    return {'schedule': [*events, SCHEDULE_END, 0]}
+
+def _is_valid_int(value: str) -> bool:
+    return re.fullmatch(r'[+-]?[0-9]+', value) is not None
+
+def _is_int(value) -> bool:
+    # Godot parses all JSON numbers as floats, so integral floats are accepted wherever an integer is expected.
+    return (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, float) and value.is_integer())
+
+def _spin(seconds: float):
+    # Busy-wait instead of sleeping, so that the stand-in uses the CPU like the game would.
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class StandInServer:
+    def __init__(self, tick_cost: float, load_time: float, fast_load_time: float) -> None:
+        self.tick_cost = tick_cost
+        self.load_time = load_time
+        self.fast_load_time = fast_load_time
+        self.levels = dict[int, Level]()
+        self.loaded_level = None
+        self.busy = False
+        self.tasks = set[asyncio.Task]()
+
+    async def handle(self, connection: ServerConnection):
+        async for message in connection:
+            request_received = time.perf_counter()
+            # Like the game, handle each message in its own task, so that pings are answered while a request is running.
+            if isinstance(message, str):
+                task = asyncio.create_task(self.receive_message(connection, message, request_received))
+            else:
+                task = asyncio.create_task(self.receive_binary_message(connection, message, request_received))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def receive_message(self, connection: ServerConnection, raw_message: str, request_received: float):
+        try:
+            message = json.loads(raw_message)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            await connection.send(json.dumps({'status': 'error', 'message': 'invalid message'}))
+            return
+        if message.get('command') == 'ping':
+            await connection.send(json.dumps({'status': 'pong', 'busy': self.busy}))
+            return
+        if self.busy:
+            await connection.send(json.dumps({'status': 'error', 'message': 'server busy'}))
+            return
+        if message.get('command') not in ('play_level', 'play_levels'):
+            await connection.send(json.dumps({'status': 'error', 'message': f"unknown command: {message.get('command')}"}))
+            return
+
+        if not _is_int(message.get('level')):
+            await connection.send(json.dumps({'status': 'error', 'message': "missing or invalid parameter 'level'"}))
+            return
+        if message['command'] == 'play_level':
+            candidates = [self.parse_candidate(message)]
+            if 'status' in candidates[0]:
+                await connection.send(json.dumps(candidates[0]))
+                return
+        else:
+            if not isinstance(message.get('candidates'), list):
+                await connection.send(json.dumps({'status': 'error', 'message': "missing or invalid parameter 'candidates'"}))
+                return
+            candidates = []
+            for i, raw_candidate in enumerate(message['candidates']):
+                if not isinstance(raw_candidate, dict):
+                    await connection.send(json.dumps({'status': 'error', 'message': f"invalid candidate {i}", 'index': i}))
+                    return
+                for option in ('max_ticks', 'snapshot_interval', 'restart', 'telemetry_interval'):
+                    raw_candidate.setdefault(option, message.get(option))
+                candidate = self.parse_candidate(raw_candidate)
+                if 'status' in candidate:
+                    await connection.send(json.dumps(candidate | {'index': i}))
+                    return
+                candidates.append(candidate)
+
+        await self.play_candidates(connection, message['command'], int(message['level']), candidates, time.perf_counter() - request_received, binary=False)
+
+    async def receive_binary_message(self, connection: ServerConnection, packet: bytes, request_received: float):
+        if self.busy:
+            await connection.send(json.dumps({'status': 'error', 'message': 'server busy'}))
+            return
+        message = self.decode_binary_message(packet)
+        if 'status' in message:
+            await connection.send(json.dumps(message))
+            return
+        await self.play_candidates(connection, message['command'], message['level'], message['candidates'], time.perf_counter() - request_received, binary=True)
+
+    def decode_binary_message(self, packet: bytes) -> dict:
+        # Same as decode_binary_message in tasmaniac/websocket_server.gd
+        if len(packet) < HEADER.size:
+            return {'status': 'error', 'message': 'invalid message'}
+        command, level, max_ticks, snapshot_interval, restart, count = HEADER.unpack_from(packet)
+        if command not in (1, 2):
+            return {'status': 'error', 'message': f"unknown command: {command}"}
+        if max_ticks < -1:
+            return {'status': 'error', 'message': "invalid parameter 'max_ticks'"}
+        if snapshot_interval < 0:
+            return {'status': 'error', 'message': "invalid parameter 'snapshot_interval'"}
+        if restart < 0 or restart >= len(RESTART_MODES):
+            return {'status': 'error', 'message': "invalid parameter 'restart'"}
+        if count < 0 or (command == 1 and count != 1):
+            return {'status': 'error', 'message': "missing or invalid parameter 'candidates'"}
+
+        candidates = []
+        offset = HEADER.size
+        for i in range(count):
+            if offset + 4 > len(packet):
+                return {'status': 'error', 'message': 'truncated message'}
+            (flags,) = struct.unpack_from('<i', packet, offset)
+            offset += 4
+            start_positions = None
+            if flags & 1:
+                if offset + 32 > len(packet):
+                    return {'status': 'error', 'message': 'truncated message'}
+                x1, y1, x2, y2 = struct.unpack_from('<4d', packet, offset)
+                start_positions = [(x1, y1), (x2, y2)]
+                offset += 32
+            telemetry_interval = 0
+            if flags & 2:
+                if offset + 4 > len(packet):
+                    return {'status': 'error', 'message': 'truncated message'}
+                (telemetry_interval,) = struct.unpack_from('<i', packet, offset)
+                offset += 4
+                if telemetry_interval < 0:
+                    return {'status': 'error', 'message': "invalid parameter 'telemetry_interval'", 'index': i}
+            if offset + 4 > len(packet):
+                return {'status': 'error', 'message': 'truncated message'}
+            (event_count,) = struct.unpack_from('<i', packet, offset)
+            offset += 4
+            if event_count < 0 or offset + 8 * event_count > len(packet):
+                return {'status': 'error', 'message': 'truncated message'}
+            events = struct.unpack_from(f'<{2 * event_count}i', packet, offset)
+            offset += 8 * event_count
+
+            compiled = compile_events(events)
+            if 'error' in compiled:
+                return {'status': 'error', 'message': f"invalid events in candidate {i}: {compiled['error']}", 'index': i, 'event': compiled['event']}
+            candidates.append({'schedule': compiled['schedule'], 'start_positions': start_positions, 'max_ticks': max_ticks, 'snapshot_interval': snapshot_interval, 'restart': RESTART_MODES[restart], 'telemetry_interval': telemetry_interval})
+        if offset != len(packet):
+            return {'status': 'error', 'message': 'invalid message'}
+
+        return {'command': COMMANDS[command], 'level': level, 'candidates': candidates}
+
+    def parse_candidate(self, command: dict) -> dict:
+        # Same as parse_candidate in tasmaniac/websocket_server.gd
+        if not isinstance(command.get('inputs'), list):
+            return {'status': 'error', 'message': "missing or invalid parameter 'inputs'"}
+        if command.get('start_positions') is not None and not isinstance(command['start_positions'], list):
+            return {'status': 'error', 'message': "invalid parameter 'start_positions'"}
+        if command.get('max_ticks') is not None and (not _is_int(command['max_ticks']) or command['max_ticks'] < 0):
+            return {'status': 'error', 'message': "invalid parameter 'max_ticks'"}
+        if command.get('snapshot_interval') is not None and (not _is_int(command['snapshot_interval']) or command['snapshot_interval'] < 0):
+            return {'status': 'error', 'message': "invalid parameter 'snapshot_interval'"}
+        if command.get('telemetry_interval') is not None and (not _is_int(command['telemetry_interval']) or command['telemetry_interval'] < 0):
+            return {'status': 'error', 'message': "invalid parameter 'telemetry_interval'"}
+        if command.get('restart') is not None and command['restart'] not in RESTART_MODES:
+            return {'status': 'error', 'message': "invalid parameter 'restart'"}
+        compiled = compile_inputs([str(line) for line in command['inputs']])
+        if 'error' in compiled:
+            return {'status': 'error', 'message': f"invalid inputs on line {compiled['line']}: {compiled['error']}", 'line': compiled['line']}
+        start_positions = command.get('start_positions')
+        if start_positions is not None:
+            if len(start_positions) != 2:
+                return {'status': 'error', 'message': f"expected 2 start positions, but got {len(start_positions)}"}
+            for position in start_positions:
+                if not isinstance(position, list) or len(position) != 2 or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in position):
+                    return {'status': 'error', 'message': f"invalid start position {position}"}
+
+        return {
+            'schedule': compiled['schedule'],
+            'start_positions': start_positions,
+            'max_ticks': -1 if command.get('max_ticks') is None else int(command['max_ticks']),
+            'snapshot_interval': 0 if command.get('snapshot_interval') is None else int(command['snapshot_interval']),
+            'restart': command.get('restart') or 'full',
+            'telemetry_interval': 0 if command.get('telemetry_interval') is None else int(command['telemetry_interval']),
+        }
+
+    async def play_candidates(self, connection: ServerConnection, command: str, level: int, candidates: list[dict], parse_seconds: float, binary: bool):
+        self.busy = True
+        try:
+            for i, candidate in enumerate(candidates):
+                # Play in a thread, so that the event loop can answer pings in the meantime.
+                response = await asyncio.to_thread(self.play, level, candidate)
+                # Same as add_parse_timing in tasmaniac/websocket_server.gd
+                total_parse_usec = int(parse_seconds * 1e6)
+                parse_usec = total_parse_usec // len(candidates) + (total_parse_usec % len(candidates) if i == 0 else 0)
+                response['timings']['parse_usec'] = parse_usec
+                response['timings']['wall_usec'] += parse_usec
+                if command == 'play_levels':
+                    response['index'] = i
+                await connection.send(self.encode_response(response) if binary else json.dumps(encode_json_telemetry(response)))
+            if command == 'play_levels':
+                finished = {'status': 'finished', 'count': len(candidates)}
+                await connection.send(self.encode_response(finished) if binary else json.dumps(finished))
+        finally:
+            self.busy = False
+
+    def encode_response(self, response: dict) -> bytes:
+        # Same layout as send_response in tasmaniac/websocket_server.gd
+        if response['status'] == 'finished':
+            return RESULT.pack(response['count'], STATUSES.index('finished'), 0, 0, -1, 0, -1, 0, 0, 0, 0, 0)
+        timings = response['timings']
+        result = RESULT.pack(
+            response.get('index', -1),
+            STATUSES.index(response['status']),
+            int(response['level_completed']),
+            response['duration_ticks'],
+            -1,
+            1 if response['load_path'] == 'fast_restart' else 0,
+            -1 if 'check' not in response else int(response['check']['match']),
+            timings['parse_usec'], timings['load_usec'], timings['simulate_usec'], timings['wall_usec'], timings['simulated_ticks'],
+        )
+        if 'telemetry' not in response:
+            return result
+        telemetry = response['telemetry']
+        hazard = (telemetry['hazard'] or '').encode()
+        return result + TELEMETRY_HEADER.pack(
+            telemetry['interval'],
+            len(telemetry['samples']) // TELEMETRY_SAMPLE.size,
+            -1 if telemetry['hazard_tick'] is None else telemetry['hazard_tick'],
+            -1 if telemetry['hazard_player'] is None else telemetry['hazard_player'],
+            len(hazard),
+        ) + hazard + telemetry['samples']
+
+    def play(self, level: int, candidate: dict) -> dict:
+        if candidate['restart'] != 'check':
+            return self.play_once(level, candidate, candidate['restart'])
+
+        start = time.perf_counter()
+        fast_response = self.play_once(level, candidate, 'fast')
+        response = self.play_once(level, candidate, 'full')
+        matches = all(fast_response[key] == response[key] for key in ('status', 'level_completed', 'duration_ticks'))
+        del fast_response['status']
+        fast_response.pop('telemetry', None)
+        fast_response['match'] = matches
+        response['check'] = fast_response
+        response['timings'] = make_timings(
+            fast_response['timings']['load_usec'] + response['timings']['load_usec'],
+            fast_response['timings']['simulate_usec'] + response['timings']['simulate_usec'],
+            int((time.perf_counter() - start) * 1e6),
+            fast_response['timings']['simulated_ticks'] + response['timings']['simulated_ticks'],
+        )
+        return response
+
+    def play_once(self, level: int, candidate: dict, restart: str) -> dict:
+        start = time.perf_counter()
+        fast = restart == 'fast' and self.loaded_level == level
+        _spin(self.fast_load_time if fast else self.load_time)
+        self.loaded_level = level
+        if level not in self.levels:
+            self.levels[level] = Level(level)
+
+        loaded = time.perf_counter()
+        result, frame, telemetry = simulate(self.levels[level], candidate['schedule'], candidate['start_positions'], candidate['max_ticks'], candidate['telemetry_interval'])
+        _spin(frame * self.tick_cost - (time.perf_counter() - loaded))
+        end = time.perf_counter()
+
+        response = {
+            'status': 'aborted' if result == 'aborted' else 'executed',
+            'level_completed': result == 'completed',
+            'duration_ticks': frame,
+            'resumed_from_tick': None,
+            'load_path': 'fast_restart' if fast else 'full_reload',
+            'timings': make_timings(int((loaded - start) * 1e6), int((end - loaded) * 1e6), int((end - start) * 1e6), frame),
+        }
+        if telemetry is not None:
+            response['telemetry'] = telemetry
+        return response
+
+def encode_json_telemetry(response: dict) -> dict:
+    # Same as send_response in tasmaniac/websocket_server.gd: samples are sent as base64 in JSON results.
+    if 'telemetry' in response:
+        response['telemetry']['samples'] = base64.b64encode(response['telemetry']['samples']).decode()
+    return response
+
+def make_timings(load_usec: int, simulate_usec: int, wall_usec: int, simulated_ticks: int) -> dict:
+    return {
+        'parse_usec': 0,
+        'load_usec': load_usec,
+        'simulate_usec': simulate_usec,
+        'wall_usec': wall_usec,
+        'simulated_ticks': simulated_ticks,
+        'ticks_per_second': simulated_ticks * 1e6 / simulate_usec if simulate_usec > 0 else 0.0,
+    }
+
+async def main(port: int, server: StandInServer):
+    async with serve(server.handle, '0.0.0.0', port, max_size=None) as websocket_server:
+        print(f"Stand-in server started on port {port}")
+        await websocket_server.serve_forever()
+
+
+if __name__ == '__main__':
+    port = None
+    tick_cost = 20.0
+    load_time = 300.0
+    fast_load_time = 20.0
+    for arg in sys.argv[1:]:
+        name, _, value = arg.partition('=')
+        if name == '--server':
+            port = int(value) if value else 7111
+        elif name == '--tick-cost':
+            tick_cost = float(value)
+        elif name == '--load-time':
+            load_time = float(value)
+        elif name == '--fast-load-time':
+            fast_load_time = float(value)
+        elif name == '--solve':
+            print('\n'.join(solve(Level(int(value)))))
+            sys.exit(0)
+
+    if port is None:
+        print("ERROR: Expected --server=<port> or --solve=<level>")
+        sys.exit(1)
+
+    try:
+        asyncio.run(main(port, StandInServer(tick_cost / 1e6, load_time / 1e3, fast_load_time / 1e3)))
+    except KeyboardInterrupt:
+        pass
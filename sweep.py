@@ -0,0 +1,133 @@
+"""
+Measures how sensitive the time of a recording is to each of its offsets (see split in recording.py).
+
+Every offset is shifted by every amount from -radius to +radius on its own, and all of these candidates, for all levels together,
+are played as one job spread over all workers. The results are written to sweeps/<recording>.csv, one row per offset and shift:
+index, player, key, offset (the unshifted offset), shift, result ('completed', 'failed', 'too_slow' if the run was stopped at twice
+the base duration, or 'invalid' if the shift moves an input before the start of the level), duration and delta (the change in duration,
+for completed runs). Set TASMANIAC_USE_SWEEPS=1 to make optimize.py pick the offsets that matter more often (see load_sensitivity in search.py).
+"""
+
+import io
+import os
+import csv
+import sys
+import math
+from pathlib import Path
+from concurrent.futures import Future
+from recording import split, combine
+from tas_server import TASExecutor, default_cache, play_level, play_levels, write_atomic
+
+
+MAX_WORKERS = int(os.getenv("TASMANIAC_MAX_WORKERS") or "10")
+# Largest shift that is tried for each offset, in both directions.
+SWEEP_RADIUS = int(os.getenv("TASMANIAC_SWEEP_RADIUS") or "10")
+# Resume candidates from snapshots of earlier runs taken every this many ticks. 0 disables snapshots.
+SNAPSHOT_INTERVAL = int(os.getenv("TASMANIAC_SNAPSHOT_INTERVAL") or "0")
+# How the server resets the level between candidates: 'full', 'fast' or 'check' (see play_level in tas_server.py).
+RESTART = os.getenv("TASMANIAC_RESTART") or "full"
+# Send requests in the compact binary format instead of JSON.
+BINARY = (os.getenv("TASMANIAC_WIRE_FORMAT") or "json") == "binary"
+# Batches per worker. Smaller batches balance the work better between fast and slow workers, at the cost of more requests.
+BATCHES_PER_WORKER = 4
+MAX_BATCH_SIZE = 32
+
+FIELDS = ['index', 'player', 'key', 'offset', 'shift', 'result', 'duration', 'delta']
+
+
+def sweep_candidates(offsets: list[int], keys: list[str], split_index: int, radius: int) -> list[tuple[int, int, list[str] | None]]:
+    """
+    Return (index, shift, inputs) for every offset and every non-zero shift up to radius.
+    The inputs are None if the shift moves an input before the start of the level.
+    """
+    candidates = []
+    for index in range(len(offsets)):
+        for shift in range(-radius, radius + 1):
+            if shift == 0:
+                continue
+            new_offsets = list(offsets)
+            new_offsets[index] += shift
+            candidates.append((index, shift, combine(new_offsets, keys, split_index)))
+    return candidates
+
+def write_table(path: Path, offsets: list[int], keys: list[str], split_index: int, base_duration: int, max_ticks: int, rows: list[tuple[int, int, tuple[bool, int] | None]]):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(FIELDS)
+    for index, shift, result in rows:
+        player = 'left' if index < split_index else 'right'
+        if result is None:
+            writer.writerow([index, player, keys[index], offsets[index], shift, 'invalid', '', ''])
+            continue
+        completed, duration = result
+        if completed:
+            writer.writerow([index, player, keys[index], offsets[index], shift, 'completed', duration, duration - base_duration])
+        else:
+            writer.writerow([index, player, keys[index], offsets[index], shift, 'too_slow' if duration > max_ticks else 'failed', duration, ''])
+    write_atomic(path, out.getvalue())
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        start = int(sys.argv[1])
+        end = start + 1
+    elif len(sys.argv) == 3:
+        start = int(sys.argv[1])
+        end = int(sys.argv[2]) + 1
+    else:
+        print("ERROR: Expected 1 or 2 arguments")
+        sys.exit(1)
+
+    cache = default_cache()
+
+    with TASExecutor(max_workers=MAX_WORKERS) as executor:
+        levels = list(range(start, end))
+        inputs_files = [sorted(Path('recordings').glob(f'lvl{level:03d}_*.txt'))[0] for level in levels]
+        splits = []
+        base_futures = []
+        for level, inputs_file in zip(levels, inputs_files):
+            with open(inputs_file, mode='r') as f:
+                base_inputs = f.read().splitlines()
+            splits.append(split(base_inputs))
+            base_futures.append(executor.submit(lambda conn, level=level, base_inputs=base_inputs: play_level(conn, level, base_inputs, snapshot_interval=SNAPSHOT_INTERVAL, restart=RESTART, binary=BINARY, cache=cache)))
+
+        # The candidates of all levels are submitted before waiting for any of them, so that no worker is idle between levels
+        jobs = []
+        total = 0
+        for level, inputs_file, (offsets, keys, split_index), base_future in zip(levels, inputs_files, splits, base_futures):
+            base_completed, base_duration = base_future.result()
+            if not base_completed:
+                print(f"{inputs_file}: Base inputs did not complete level, skipping")
+                continue
+            candidates = sweep_candidates(offsets, keys, split_index, SWEEP_RADIUS)
+            jobs.append((level, inputs_file, offsets, keys, split_index, base_duration, candidates))
+            total += len(candidates)
+            print(f"{inputs_file}: {base_duration} frames, sweeping {len(offsets)} offsets by up to ±{SWEEP_RADIUS}")
+
+        batch_size = max(1, min(MAX_BATCH_SIZE, math.ceil(total / (BATCHES_PER_WORKER * executor.num_workers))))
+        batch_futures = []
+        for level, inputs_file, offsets, keys, split_index, base_duration, candidates in jobs:
+            # Runs are stopped at twice the base duration, so that candidates that stand still somewhere do not run until they time out
+            max_ticks = 2 * base_duration
+            valid = [inputs for _, _, inputs in candidates if inputs is not None]
+            futures = list[Future[list[tuple[bool, int]]]]()
+            for i in range(0, len(valid), batch_size):
+                batch = valid[i:i + batch_size]
+                futures.append(executor.submit(lambda conn, level=level, batch=batch, max_ticks=max_ticks: list(play_levels(conn, level, batch, max_ticks=max_ticks, snapshot_interval=SNAPSHOT_INTERVAL, restart=RESTART, binary=BINARY, cache=cache))))
+            batch_futures.append(futures)
+
+        for (level, inputs_file, offsets, keys, split_index, base_duration, candidates), futures in zip(jobs, batch_futures):
+            results = iter([result for future in futures for result in future.result()])
+            rows = [(index, shift, None if inputs is None else next(results)) for index, shift, inputs in candidates]
+            table_file = Path('sweeps') / f'{inputs_file.stem}.csv'
+            write_table(table_file, offsets, keys, split_index, base_duration, 2 * base_duration, rows)
+
+            improvements = sorted((result[1] - base_duration, index, shift) for index, shift, result in rows if result is not None and result[0] and result[1] < base_duration)
+            num_completed = sum(1 for _, _, result in rows if result is not None and result[0])
+            print(f"{inputs_file}: {num_completed} of {len(rows)} shifts completed, {len(improvements)} improved, written to {table_file}")
+            for delta, index, shift in improvements[:5]:
+                print(f"    offset {index} ({keys[index]}) {shift:+d}: {delta:+d} frames")
+
+        print(executor.metrics.report())
+
+    if cache is not None:
+        print(f"Result cache: {cache.hits} hits, {cache.misses} misses")
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import signal
+import asyncio
+import subprocess
+import websockets.asyncio.client as async_client
+from websockets.exceptions import WebSocketException
+from tas_server import POOL_ADDRESS, start_server, stop_servers
+
+
+# Long-running daemon that keeps a pool of headless TASmaniac servers running, so that scripts don't have to wait for the game
+# to start every time. TASExecutor and AsyncTASPool in tas_server.py lease servers from the daemon automatically if it is running.
+#
+# Usage: python tas_pool.py [number of servers]
+# The number of servers defaults to TASMANIAC_MAX_WORKERS or 10. The daemon listens on TASMANIAC_POOL (default 127.0.0.1:7110)
+# and the servers use consecutive ports starting from FIRST_PORT.
+#
+# Clients send JSON lines over a TCP connection to the daemon:
+# * {"command": "lease", "count": n}: Lease up to n servers. Waits until at least one server is available and responds with
+#   {"status": "ok", "ports": [...]}. The servers stay leased until the client closes the connection.
+# * {"command": "restart", "port": p}: Report that the leased server on port p crashed or stopped responding. The server is
+#   removed from the lease and restarted. Responds with {"status": "ok"}.
+# * {"command": "status"}: Responds with {"status": "ok", "servers": [{"port": ..., "state": ...}, ...]}.
+#
+# When a lease ends the server is health checked before it is leased again. Servers that have crashed, or that are
+# still busy with a request from the previous lease after HEALTH_CHECK_TIMEOUT seconds, are restarted.
+# Servers that hang while leased are only noticed by the client, which reports them with the restart command.
+
+
+FIRST_PORT = 7200
+HEALTH_CHECK_TIMEOUT = 30
+MONITOR_INTERVAL = 5
+
+
+class Server:
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.process: subprocess.Popen | None = None
+        # One of: "starting", "idle", "leased", "checking"
+        self.state = "starting"
+
+
+class Pool:
+    def __init__(self, size: int) -> None:
+        self.servers = [Server(FIRST_PORT + i) for i in range(size)]
+        self.available = asyncio.Condition()
+        self.background_tasks = set[asyncio.Task]()
+
+    def spawn(self, coroutine):
+        # The event loop only keeps weak references to tasks, so they must be kept alive until they are done
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def run(self):
+        host, port = POOL_ADDRESS.rsplit(':', 1)
+        listener = await asyncio.start_server(self.handle_client, host, int(port))
+        print(f"TAS pool listening on {POOL_ADDRESS}, starting {len(self.servers)} servers")
+        if sys.platform != 'win32':
+            # Stop the servers when the daemon is terminated, not only on Ctrl+C
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            async with asyncio.TaskGroup() as tasks:
+                for server in self.servers:
+                    tasks.create_task(self.start(server))
+                tasks.create_task(self.monitor())
+                tasks.create_task(listener.serve_forever())
+        finally:
+            stop_servers([server.process for server in self.servers if server.process is not None])
+
+    async def start(self, server: Server):
+        """Start or restart a server and mark it as idle once it is ready. Retries until the server starts successfully."""
+        server.state = "starting"
+        while True:
+            if server.process is not None:
+                stop_servers([server.process])
+            server.process, _ = start_server(server.port)
+            if await self.check(server):
+                break
+            print(f"Server on port {server.port} failed to start, retrying")
+            await asyncio.sleep(MONITOR_INTERVAL)
+        await self.set_idle(server)
+
+    async def check(self, server: Server) -> bool:
+        """Return True if the server is running and has finished all requests from its previous lease."""
+        if server.process is None or server.process.poll() is not None:
+            return False
+        try:
+            async with asyncio.timeout(HEALTH_CHECK_TIMEOUT):
+                while True:
+                    try:
+                        connection = await async_client.connect(f'ws://127.0.0.1:{server.port}', max_size=None)
+                        break
+                    except ConnectionRefusedError:
+                        await asyncio.sleep(0.5) # The server may still be starting up
+
+                async with connection:
+                    while True:
+                        await connection.send(json.dumps({'command': 'ping'}))
+                        # Skip any results of the previous lease's last request that arrive before the answer to the ping.
+                        while True:
+                            message = await connection.recv()
+                            if isinstance(message, str) and json.loads(message).get('status') == 'pong':
+                                break
+                        if not json.loads(message)['busy']:
+                            return True
+                        await asyncio.sleep(0.1)
+        except (OSError, TimeoutError, ValueError, WebSocketException):
+            return False
+
+    async def set_idle(self, server: Server):
+        async with self.available:
+            server.state = "idle"
+            self.available.notify_all()
+
+    async def release(self, server: Server):
+        server.state = "checking"
+        if await self.check(server):
+            await self.set_idle(server)
+        else:
+            print(f"Server on port {server.port} failed health check, restarting")
+            await self.start(server)
+
+    async def lease(self, count: int) -> list[Server]:
+        # Servers that are starting or being checked will be available soon, so wait for them instead of leasing fewer servers.
+        # Servers leased by other clients may not be available for a long time, so those are not waited for.
+        def ready() -> bool:
+            idle = sum(server.state == "idle" for server in self.servers)
+            not_leased = sum(server.state != "leased" for server in self.servers)
+            return idle > 0 and idle >= min(count, not_leased)
+
+        async with self.available:
+            await self.available.wait_for(ready)
+            leased = [server for server in self.servers if server.state == "idle"][:count]
+            for server in leased:
+                server.state = "leased"
+            return leased
+
+    async def monitor(self):
+        """Restart idle servers that have crashed, so that they are not handed out."""
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            for server in self.servers:
+                if server.state == "idle" and server.process.poll() is not None:
+                    print(f"Server on port {server.port} exited, restarting")
+                    self.spawn(self.start(server))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        leased = []
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    response = {'status': 'error', 'message': "invalid message"}
+                elif request.get('command') == 'lease':
+                    servers = await self.lease(max(1, int(request.get('count', 1))))
+                    leased += servers
+                    response = {'status': 'ok', 'ports': [server.port for server in servers]}
+                elif request.get('command') == 'restart':
+                    server = next((server for server in leased if server.port == request.get('port')), None)
+                    if server is None:
+                        response = {'status': 'error', 'message': f"server not leased: {request.get('port')}"}
+                    else:
+                        print(f"Server on port {server.port} reported unresponsive, restarting")
+                        leased.remove(server)
+                        self.spawn(self.start(server))
+                        response = {'status': 'ok'}
+                elif request.get('command') == 'status':
+                    response = {'status': 'ok', 'servers': [{'port': server.port, 'state': server.state} for server in self.servers]}
+                else:
+                    response = {'status': 'error', 'message': f"unknown command: {request.get('command')}"}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            for server in leased:
+                self.spawn(self.release(server))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        size = int(sys.argv[1])
+    elif len(sys.argv) == 1:
+        size = int(os.getenv("TASMANIAC_MAX_WORKERS") or "10")
+    else:
+        print("ERROR: Expected 0 or 1 arguments")
+        sys.exit(1)
+
+    try:
+        asyncio.run(Pool(size).run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
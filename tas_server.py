@@ -1,32 +1,97 @@
+import os
+import re
 import sys
 import json
+import base64
+import math
+import pickle
+import struct
+import shlex
+import hashlib
+import socket
+import sqlite3
+import functools
+import itertools
+import collections
+import asyncio
 import subprocess
 import time
+from pathlib import Path
 from threading import Lock
 from concurrent.futures import Future, ThreadPoolExecutor
 from contextvars import ContextVar
-from typing import Callable, Iterable
+from typing import AsyncIterator, Callable, Iterable, Iterator, Sequence
 import websockets.sync.client as client
+import websockets.asyncio.client as async_client
 from websockets.sync.connection import Connection
+from websockets.asyncio.connection import Connection as AsyncConnection
+from websockets.exceptions import WebSocketException
 
 
-# Required libraries: `pip install websockets`.
+# Required libraries: `pip install websockets` (version 13 or newer for AsyncTASPool).
 # Note: If you are using `connect` directly then you need to manually start the TASmaniac WebSocket server by running launch_tasmaniac_server.bat.
 
 
 if sys.platform == 'win32':
     _AMBIDEXTRO_EXECUTABLE = './Ambidextro.exe'
+    _AMBIDEXTRO_PCK = './Ambidextro.pck'
 elif sys.platform == 'linux':
     _AMBIDEXTRO_EXECUTABLE = './Ambidextro.x86_64'
+    _AMBIDEXTRO_PCK = './Ambidextro.pck'
 elif sys.platform == 'darwin':
     _AMBIDEXTRO_EXECUTABLE = './Ambidextro.app/Contents/MacOS/Ambidextro'
+    _AMBIDEXTRO_PCK = './Ambidextro.app/Contents/Resources/Ambidextro.pck'
 else:
     _AMBIDEXTRO_EXECUTABLE = None
+    _AMBIDEXTRO_PCK = None
 
 _lock = Lock()
+_lease_lock = Lock()
 _next_port = 7112
 
-_connection = ContextVar[Connection]('connection')
+# How long to wait for a newly started server to accept connections, in seconds.
+_SERVER_START_TIMEOUT = 10
+
+# Address of the tas_pool daemon (see tas_pool.py). If the daemon is running then executors lease servers from it
+# instead of starting their own. Set TASMANIAC_POOL to 'off' to always start new servers.
+POOL_ADDRESS = os.getenv('TASMANIAC_POOL') or '127.0.0.1:7110'
+# How long to wait for the tas_pool daemon to lease servers, in seconds. If all of its servers stay leased by other scripts
+# for longer than this, or the daemon does not answer, the executor starts its own servers instead.
+_LEASE_TIMEOUT = 10
+
+# How long to wait for each result from a server before giving up on it as hung, in seconds. 0 waits forever.
+# The connection is then handled like a lost connection, and leased servers are reported to the tas_pool daemon for a restart.
+_RESPONSE_TIMEOUT = float(os.getenv('TASMANIAC_RESPONSE_TIMEOUT') or '300') or None
+
+# Command used to start servers instead of the game, e.g. `python stand_in_server.py` to use the stand-in server from stand_in_server.py.
+# The --server=<port> argument is appended to the command.
+_SERVER_COMMAND = os.getenv('TASMANIAC_SERVER_COMMAND')
+
+# Servers on other machines (see parse_endpoints) that executors use as workers in addition to their own servers.
+_ENDPOINTS = os.getenv('TASMANIAC_ENDPOINTS') or ''
+
+# How often a worker whose server has dropped out tries to reconnect to it, in seconds.
+_RECONNECT_INTERVAL = 5
+# How many times a task is played again on another worker after the connection to its server was lost while playing it.
+# This limits the damage if the task itself crashes the servers.
+_MAX_ATTEMPTS = 3
+
+_connection = ContextVar['Connection | None']('connection')
+_endpoint = ContextVar[str]('endpoint')
+_leased_port = ContextVar['int | None']('leased_port')
+_last_connect_time = ContextVar[float]('last_connect_time')
+_worker_metrics = ContextVar['_WorkerMetrics']('worker_metrics')
+
+# Binary wire format, see decode_binary_message and send_response in tasmaniac/websocket_server.gd.
+_BINARY_ACTIONS = 'WADULR'
+_BINARY_COMMANDS = {'play_level': 1, 'play_levels': 2}
+_BINARY_RESTART_MODES = {None: 0, 'full': 0, 'fast': 1, 'check': 2}
+_BINARY_STATUSES = ('executed', 'aborted', 'finished')
+_BINARY_HEADER = struct.Struct('<6i')
+_BINARY_START_POSITIONS = struct.Struct('<4d')
+_BINARY_RESULT = struct.Struct('<12i')
+_BINARY_TELEMETRY_HEADER = struct.Struct('<5i')
+_TELEMETRY_SAMPLE = struct.Struct('<11f')
 
 class TASExecutor:
     """
@@ -34,42 +99,78 @@ class TASExecutor:
     The corresponding connection is passed as an argument to functions executed using `submit` and `map`.
     This allows you to run multiple commands in parallel on separate servers, to take better advantage of having multiple CPU cores.
 
+    If the tas_pool daemon is running then up to max_workers servers are leased from it instead of starting new ones,
+    which avoids waiting for the game to start. In that case there may be fewer workers than max_workers.
+
+    Servers that are already running, e.g. on other machines, can be added with endpoints, a list of WebSocket URLs with one worker
+    per URL. If endpoints is not given then the servers in the TASMANIAC_ENDPOINTS environment variable are used (see `parse_endpoints`).
+    Set max_workers to 0 to only use those servers. If the connection to a server is lost, the task that was running on it is played
+    again on another worker, and the worker keeps trying to reconnect. Because idle workers take the next task as soon as they are free,
+    faster servers automatically get a bigger share of the tasks.
+
+    Per-worker metrics are collected in `metrics`, see `Metrics`. If metrics is not given then `default_metrics` is used.
+
+    server_args are passed to the servers that are started for the workers, e.g. `['--no-lean']` (see bootstrap.gd for the options).
+    Servers of the tas_pool daemon run without them, so nothing is leased if server_args are given.
+
     Use this with a `with` block to automatically clean up the server processes and connections.
     """
 
-    def __init__(self, max_workers: int) -> None:
-        self._executor = ThreadPoolExecutor(max_workers=max_workers, initializer=self._create_connection)
+    def __init__(self, max_workers: int, metrics: 'Metrics | None' = None, endpoints: Sequence[str] | None = None, server_args: Sequence[str] = ()) -> None:
+        self.metrics = metrics if metrics is not None else default_metrics()
+        self._endpoints = list(endpoints if endpoints is not None else parse_endpoints(_ENDPOINTS))
+        self._server_args = list(server_args)
+        self._lease, self._leased_ports = _lease_servers(max_workers) if max_workers > 0 and not server_args else (None, [])
+        if self._leased_ports:
+            max_workers = len(self._leased_ports)
+        self._max_workers = max_workers + len(self._endpoints)
+        if self._max_workers == 0:
+            raise ValueError("TASExecutor needs at least one worker or endpoint")
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers, initializer=self._create_connection)
+        self._num_local_workers = max_workers
+        self._num_disconnected = 0
         self._processes = []
         self._connections = []
     
     def _create_connection(self):
-        if _AMBIDEXTRO_EXECUTABLE is None:
-            raise RuntimeError("Cannot start TASmaniac server, unsupported platform")
-
-        global _next_port
         with _lock:
-            port = _next_port
-            _next_port += 1
-            
-        process = subprocess.Popen(
-            [_AMBIDEXTRO_EXECUTABLE, '--script', 'tasmaniac/bootstrap.gd', '--fixed-fps', '120', '--disable-vsync', '--headless', '--disable-render-loop', '--', f'--server={port}'],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-        self._processes.append(process)
+            if self._num_local_workers > 0:
+                self._num_local_workers -= 1
+                url = None
+                port = self._leased_ports.pop() if self._leased_ports else None
+            else:
+                url = self._endpoints.pop()
+        _worker_metrics.set(self.metrics.add_worker(url))
 
-        connect_start_time = time.perf_counter()
-        while True:
-            try:
-                connection = connect(f'ws://127.0.0.1:{port}')
-                break
-            except ConnectionRefusedError as err:
-                if time.perf_counter() - connect_start_time < 10:
-                    time.sleep(0.5) # The server may take some time to start up, wait and try again
-                else:
-                    raise err
-        self._connections.append(connection)
-        
+        if url is None:
+            _leased_port.set(port)
+            if port is None:
+                process, port = start_server(extra_args=self._server_args)
+                self._processes.append(process)
+            _endpoint.set(f'ws://127.0.0.1:{port}')
+            self._set_connection(connect_when_ready(port))
+        else:
+            # A server on another machine is expected to be running already, if not the worker tries again later
+            _endpoint.set(url)
+            _connection.set(None)
+            self._reconnect()
+
+    def _set_connection(self, connection: Connection | None):
+        with _lock:
+            if _connection.get(None) is None and _last_connect_time.get(None) is not None:
+                self._num_disconnected -= 1
+            if connection is None:
+                self._num_disconnected += 1
+            else:
+                self._connections.append(connection)
         _connection.set(connection)
+        _last_connect_time.set(time.perf_counter())
+
+    def _reconnect(self):
+        try:
+            self._set_connection(client.connect(_endpoint.get(), open_timeout=_RECONNECT_INTERVAL))
+        except (OSError, TimeoutError, WebSocketException):
+            self._set_connection(None)
     
     def __enter__(self):
         return self
@@ -78,20 +179,482 @@ class TASExecutor:
         self._executor.shutdown(wait=True, cancel_futures=True)
         for connection in self._connections:
             connection.close()
-        for process in self._processes:
-            process.terminate()
-        for process in self._processes:
-            try:
-                process.wait(timeout=0.5)
-            except subprocess.TimeoutExpired:
-                pass # TODO: Add some kind of warning about potential zombie processes?
+        if self._lease is not None:
+            self._lease.close()
+        stop_servers(self._processes)
+        self.metrics.close()
     
+    @property
+    def num_workers(self) -> int:
+        """
+        The number of workers, which may be lower than max_workers if servers were leased from the tas_pool daemon,
+        and includes a worker for each endpoint.
+        """
+        return self._max_workers
+
     def submit[T](self, fn: Callable[[Connection], T]) -> Future[T]:
-        return self._executor.submit(lambda: fn(_connection.get()))
+        return self._executor.submit(self._run, fn, time.perf_counter())
 
     def map[V, T](self, fn: Callable[[Connection, V], T], iterable: Iterable[V]) -> Iterable[T]:
-        return self._executor.map(lambda v: fn(_connection.get(), v), iterable)
+        submit_time = time.perf_counter()
+        return self._executor.map(lambda v: self._run(lambda connection: fn(connection, v), submit_time), iterable)
+
+    def _run[T](self, fn: Callable[[Connection], T], submit_time: float, attempt: int = 0) -> T:
+        # Leased servers are given back to the tas_pool daemon when they drop out (see below), so they are not reconnected
+        if _connection.get() is None and _leased_port.get(None) is None and time.perf_counter() - _last_connect_time.get() >= _RECONNECT_INTERVAL:
+            self._reconnect()
+        connection = _connection.get()
+        if connection is None:
+            return self._run_elsewhere(fn, submit_time, attempt, ConnectionError(f"Lost connection to TASmaniac server at {_endpoint.get()}"))
+
+        start_time = time.perf_counter()
+        try:
+            return fn(connection)
+        except (OSError, WebSocketException) as err:
+            error = err
+        finally:
+            self.metrics.record_task(_worker_metrics.get(), time.perf_counter() - start_time, [start_time - submit_time])
+
+        # The server dropped out or hung, play the task again on another worker
+        connection.close()
+        self._set_connection(None)
+        self.metrics.record_disconnect(_worker_metrics.get())
+        if _leased_port.get(None) is not None:
+            _report_unresponsive(self._lease, _leased_port.get())
+        if attempt + 1 >= _MAX_ATTEMPTS:
+            raise error
+        return self._run_elsewhere(fn, submit_time, attempt + 1, error)
+
+    def _run_elsewhere[T](self, fn: Callable[[Connection], T], submit_time: float, attempt: int, err: BaseException) -> T:
+        # This worker has no connection, so it waits for another worker to play the task. Workers with a connection never wait
+        # for other workers, so this cannot deadlock as long as at least one worker is connected (or not started yet).
+        with _lock:
+            num_disconnected = self._num_disconnected
+        if num_disconnected >= self._max_workers:
+            raise err
+        return self._executor.submit(self._run, fn, submit_time, attempt).result()
+
+    def play_levels(self, level: int, inputs_list: Sequence[list[str]], start_positions_list: Sequence[list[tuple[float, float]] | None] | None = None, max_ticks: int | None = None, snapshot_interval: int | None = None, restart: str | None = None, binary: bool = False, cache: 'ResultCache | None' = None, batch_size: int | None = None, telemetry_interval: int | None = None) -> Iterator[tuple[bool, int]]:
+        """
+        Play a level once for each list of inputs in `inputs_list`, distributing the candidates between the workers in batches.
+        Each batch is evaluated with a single `play_levels` request. Results are returned in the same order as the inputs.
+
+        If a cache is given then only the candidates that are not in the cache are sent to the workers.
+        If batch_size is not given then the candidates are split into roughly two batches per worker.
+        """
+
+        if start_positions_list is None:
+            start_positions_list = [None] * len(inputs_list)
+
+        def play(inputs_list: Sequence[list[str]], start_positions_list: Sequence[list[tuple[float, float]] | None]) -> Iterable[tuple[bool, int]]:
+            size = batch_size or max(1, math.ceil(len(inputs_list) / (2 * self._max_workers)))
+            batches = [(inputs_list[i:i + size], start_positions_list[i:i + size]) for i in range(0, len(inputs_list), size)]
+            options = {'max_ticks': max_ticks, 'snapshot_interval': snapshot_interval, 'restart': restart, 'telemetry_interval': telemetry_interval}
+            return itertools.chain.from_iterable(self.map(lambda conn, batch: list(_play_levels(conn, level, *batch, options, binary)), batches))
+
+        return _play_cached(cache, level, inputs_list, start_positions_list, max_ticks, play, bypass=bool(telemetry_interval))
+
+
+class AsyncTASPool:
+    """
+    Asyncio counterpart of `TASExecutor` that starts a TASmaniac server for each worker and serves all workers from a shared priority queue.
+    Candidates can be submitted at any time, also while earlier ones are still running, and every worker picks up the next queued
+    candidate as soon as it is done with the previous one. Candidates with a lower priority value are played first.
+
+    When more candidates are queued than there are workers, each worker takes up to max_batch candidates for the same level and options
+    at a time and plays them with a single `play_levels` request. If binary is set then requests are sent in the binary wire format.
+
+    Servers are leased from the tas_pool daemon if it is running, servers on other machines are added with endpoints, server_args are
+    passed to started servers, and metrics are collected, in the same way as for `TASExecutor`. If the connection to a server is lost, the candidates it was playing are queued again.
+    Workers take smaller batches from the queue if their server is slower than the others, so that the candidates are spread over the
+    servers according to their measured throughput.
+
+    Use this with an `async with` block to automatically clean up the server processes and connections.
+    """
+
+    def __init__(self, max_workers: int, binary: bool = False, max_batch: int = 8, metrics: 'Metrics | None' = None, endpoints: Sequence[str] | None = None, server_args: Sequence[str] = ()) -> None:
+        self.metrics = metrics if metrics is not None else default_metrics()
+        self._max_workers = max_workers
+        self._endpoints = list(endpoints if endpoints is not None else parse_endpoints(_ENDPOINTS))
+        self._server_args = list(server_args)
+        if max_workers == 0 and not self._endpoints:
+            raise ValueError("AsyncTASPool needs at least one worker or endpoint")
+        self._binary = binary
+        self._max_batch = max_batch
+        self._queue = asyncio.PriorityQueue[tuple[int, int, dict, asyncio.Future[tuple[bool, int]]]]()
+        self._counter = itertools.count()
+        self._lease = None
+        self._leased_ports = []
+        self._processes = []
+        self._connections = list[AsyncConnection | None]()
+        # The port of each worker's server if it was leased from the tas_pool daemon, otherwise None
+        self._worker_leased_ports = list[int | None]()
+        # Candidates played per second of busy time by each worker, None until the worker has played a batch
+        self._throughputs = list[float | None]()
+        self._workers = []
+
+    async def __aenter__(self):
+        try:
+            if self._max_workers > 0 and not self._server_args:
+                self._lease, self._leased_ports = await asyncio.to_thread(_lease_servers, self._max_workers)
+                if self._leased_ports:
+                    self._max_workers = len(self._leased_ports)
+            local_connections = await asyncio.gather(*(self._create_connection() for _ in range(self._max_workers)))
+            remote_connections = await asyncio.gather(*(self._connect(url) for url in self._endpoints))
+            if not local_connections and not any(remote_connections):
+                raise ConnectionError(f"Could not connect to any TASmaniac server, tried {', '.join(self._endpoints) or 'none'}")
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
+        urls = [None] * len(local_connections) + self._endpoints
+        self._connections = [connection for connection, _ in local_connections] + remote_connections
+        self._worker_leased_ports = [leased_port for _, leased_port in local_connections] + [None] * len(remote_connections)
+        self._throughputs = [None] * len(self._connections)
+        self._workers = [asyncio.create_task(self._worker(i, url)) for i, url in enumerate(urls)]
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for connection in self._connections:
+            if connection is not None:
+                await connection.close()
+        if self._lease is not None:
+            self._lease.close()
+        stop_servers(self._processes)
+        self.metrics.close()
+
+    @property
+    def num_workers(self) -> int:
+        """
+        The number of workers, which may be lower than max_workers if servers were leased from the tas_pool daemon,
+        and includes a worker for each endpoint.
+        """
+        return len(self._workers)
+
+    async def _connect(self, url: str) -> AsyncConnection | None:
+        # A server on another machine is expected to be running already, if not the worker tries again later
+        try:
+            return await async_client.connect(url, max_size=None, open_timeout=_RECONNECT_INTERVAL)
+        except (OSError, TimeoutError, WebSocketException):
+            return None
+
+    async def _create_connection(self) -> tuple[AsyncConnection, int | None]:
+        # Returns the connection and the port of the server if it was leased
+        leased_port = port = self._leased_ports.pop() if self._leased_ports else None
+        if port is None:
+            process, port = start_server(extra_args=self._server_args)
+            self._processes.append(process)
+
+        connect_start_time = time.perf_counter()
+        while True:
+            try:
+                return await async_client.connect(f'ws://127.0.0.1:{port}', max_size=None), leased_port
+            except ConnectionRefusedError as err:
+                if time.perf_counter() - connect_start_time < _SERVER_START_TIMEOUT:
+                    await asyncio.sleep(0.5) # The server may take some time to start up, wait and try again
+                else:
+                    raise err
+
+    def submit(self, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None = None, max_ticks: int | None = None, snapshot_interval: int | None = None, restart: str | None = None, cache: 'ResultCache | None' = None, priority: int = 0, telemetry_interval: int | None = None) -> asyncio.Future[tuple[bool, int]]:
+        """
+        Queue a candidate and return a future for its result. The parameters have the same meaning as for `play_level`.
+        Cancelling the future before a worker has picked up the candidate removes it from the queue.
+        """
+
+        if self._binary:
+            encode_inputs(inputs) # Raise invalid inputs here instead of failing the whole batch that the candidate ends up in
+        future = asyncio.get_running_loop().create_future()
+        if not any(self._connections):
+            future.set_exception(ConnectionError("Lost connection to all TASmaniac servers"))
+            return future
+        if cache is not None:
+            result = cache.get(level, inputs, start_positions, max_ticks) if not telemetry_interval else None
+            if result is not None:
+                future.set_result(result)
+                return future
+
+            def store(future: asyncio.Future[tuple[bool, int]]):
+                if not future.cancelled() and future.exception() is None:
+                    cache.put(level, inputs, start_positions, max_ticks, future.result())
+            future.add_done_callback(store)
 
+        request = {'level': level, 'inputs': inputs, 'start_positions': start_positions, 'options': {'max_ticks': max_ticks, 'snapshot_interval': snapshot_interval, 'restart': restart, 'telemetry_interval': telemetry_interval}, 'submit_time': time.perf_counter()}
+        self._queue.put_nowait((priority, next(self._counter), request, future))
+        return future
+
+    async def play_level(self, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None = None, max_ticks: int | None = None, snapshot_interval: int | None = None, restart: str | None = None, cache: 'ResultCache | None' = None, priority: int = 0, telemetry_interval: int | None = None) -> tuple[bool, int]:
+        """
+        Play a level on the first free worker and return the result in the same format as `play_level`.
+        """
+        return await self.submit(level, inputs, start_positions, max_ticks, snapshot_interval, restart, cache, priority, telemetry_interval)
+
+    async def as_completed(self, futures: Iterable[asyncio.Future[tuple[bool, int]]]) -> AsyncIterator[asyncio.Future[tuple[bool, int]]]:
+        """
+        Yield the given futures (as returned by `submit`) in the order in which they complete.
+        """
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future
+
+    async def _worker(self, index: int, url: str | None):
+        worker = self.metrics.add_worker(url)
+        while True:
+            connection = self._connections[index]
+            if connection is None:
+                if url is None:
+                    # A server started by this pool is not restarted, so its worker stops
+                    return
+                await asyncio.sleep(_RECONNECT_INTERVAL)
+                self._connections[index] = await self._connect(url)
+                continue
+
+            batch = [await self._queue.get()]
+
+            # Take more candidates for the same level and options, but leave enough in the queue for the other workers,
+            # in proportion to how fast each worker has played its candidates so far.
+            limit = min(self._max_batch, math.ceil((self._queue.qsize() + 1) * self._throughput_share(index)))
+            skipped = []
+            while len(batch) < limit and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item[2]['level'] == batch[0][2]['level'] and item[2]['options'] == batch[0][2]['options']:
+                    batch.append(item)
+                else:
+                    skipped.append(item)
+            for item in skipped:
+                self._queue.put_nowait(item)
+
+            batch = [item for item in batch if not item[3].cancelled()]
+            if batch:
+                start_time = time.perf_counter()
+                try:
+                    await self._play_batch(connection, batch, worker)
+                except (OSError, WebSocketException) as err:
+                    # The server dropped out or hung. _play_batch has queued the unfinished candidates again.
+                    self._connections[index] = None
+                    self.metrics.record_disconnect(worker)
+                    await connection.close()
+                    if self._worker_leased_ports[index] is not None:
+                        await asyncio.to_thread(_report_unresponsive, self._lease, self._worker_leased_ports[index])
+                    if not any(self._connections):
+                        self._fail_queued(err)
+                else:
+                    elapsed = time.perf_counter() - start_time
+                    previous = self._throughputs[index]
+                    throughput = len(batch) / elapsed if elapsed > 0 else 0.0
+                    self._throughputs[index] = throughput if previous is None else 0.8 * previous + 0.2 * throughput
+                finally:
+                    self.metrics.record_task(worker, time.perf_counter() - start_time, [start_time - request['submit_time'] for _, _, request, _ in batch])
+
+    def _throughput_share(self, index: int) -> float:
+        """
+        Return the fraction of the throughput of all connected workers that the given worker provides.
+        Workers that have not played anything yet count as average.
+        """
+
+        measured = [throughput for connection, throughput in zip(self._connections, self._throughputs) if connection is not None and throughput is not None]
+        num_connected = sum(connection is not None for connection in self._connections)
+        if not measured or not sum(measured):
+            return 1 / max(1, num_connected)
+        average = sum(measured) / len(measured)
+        own = self._throughputs[index]
+        return (own if own is not None else average) / (sum(measured) + average * (num_connected - len(measured)))
+
+    def _requeue(self, items: Iterable[tuple[int, int, dict, asyncio.Future[tuple[bool, int]]]], err: BaseException):
+        for item in items:
+            priority, counter, request, future = item
+            if future.done():
+                continue
+            request['attempts'] = request.get('attempts', 0) + 1
+            if request['attempts'] >= _MAX_ATTEMPTS:
+                future.set_exception(err)
+            else:
+                self._queue.put_nowait(item)
+
+    def _fail_queued(self, err: BaseException):
+        while not self._queue.empty():
+            _set_exception([self._queue.get_nowait()[3]], err)
+
+    async def _play_batch(self, connection: AsyncConnection, batch: list[tuple[int, int, dict, asyncio.Future[tuple[bool, int]]]], worker: '_WorkerMetrics'):
+        level = batch[0][2]['level']
+        options = batch[0][2]['options']
+        inputs_list = [request['inputs'] for _, _, request, _ in batch]
+        start_positions_list = [request['start_positions'] for _, _, request, _ in batch]
+        futures = [future for _, _, _, future in batch]
+
+        last_time = time.perf_counter()
+        try:
+            if self._binary:
+                await connection.send(encode_request('play_levels', level, inputs_list, start_positions_list, options))
+            else:
+                candidates = [{'inputs': inputs, 'start_positions': start_positions} for inputs, start_positions in zip(inputs_list, start_positions_list)]
+                await connection.send(json.dumps({'command': 'play_levels', 'level': level, 'candidates': candidates, **options}))
+        except (OSError, WebSocketException) as err:
+            self._requeue(batch, err)
+            raise
+        except Exception as err:
+            _set_exception(futures, err)
+            return
+
+        for i in range(len(batch)):
+            try:
+                async with asyncio.timeout(_RESPONSE_TIMEOUT):
+                    response = decode_response(await connection.recv())
+                if response.get('index') != i:
+                    raise AssertionError(f"TAS returned unexpected response: {response}")
+            except (OSError, WebSocketException) as err:
+                self._requeue(batch[i:], err)
+                raise
+            except Exception as err:
+                _set_exception(futures[i:], err)
+                return
+            now = time.perf_counter()
+            self.metrics.record_result(worker, now - last_time, response)
+            last_time = now
+
+            if response['status'] == 'error':
+                # The server stops at the first invalid candidate without sending a "finished" message,
+                # so the candidates after it were not played and are queued again.
+                _set_exception(futures[i:i + 1], AssertionError(f"TAS returned unexpected response: {response}"))
+                for item in batch[i + 1:]:
+                    self._queue.put_nowait(item)
+                return
+
+            try:
+                result = _parse_result(response)
+            except AssertionError as err:
+                _set_exception(futures[i:i + 1], err)
+            else:
+                if not futures[i].done():
+                    futures[i].set_result(result)
+
+        async with asyncio.timeout(_RESPONSE_TIMEOUT):
+            await connection.recv() # The final "finished" message
+
+
+def _set_exception(futures: Iterable[asyncio.Future], err: BaseException):
+    for future in futures:
+        if not future.done():
+            future.set_exception(err)
+
+def start_server(port: int | None = None, extra_args: Sequence[str] = ()) -> tuple[subprocess.Popen, int]:
+    """
+    Start a headless TASmaniac server and return its process and port. The next free port from 7112 is used if no port is given.
+    The server may take a few seconds before it accepts connections. Stop it with stop_servers.
+    """
+
+    if _SERVER_COMMAND:
+        command = shlex.split(_SERVER_COMMAND, posix=sys.platform != 'win32')
+    elif _AMBIDEXTRO_EXECUTABLE is not None:
+        command = [_AMBIDEXTRO_EXECUTABLE, '--script', 'tasmaniac/bootstrap.gd', '--fixed-fps', '120', '--disable-vsync', '--headless', '--disable-render-loop', '--']
+    else:
+        raise RuntimeError("Cannot start TASmaniac server, unsupported platform")
+
+    global _next_port
+    if port is None:
+        with _lock:
+            port = _next_port
+            _next_port += 1
+
+    process = subprocess.Popen(
+        [*command, f'--server={port}', *extra_args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return process, port
+
+def connect_when_ready(port: int) -> Connection:
+    """
+    Connect to a local server started with start_server, waiting up to _SERVER_START_TIMEOUT seconds for it to accept connections.
+    """
+
+    connect_start_time = time.perf_counter()
+    while True:
+        try:
+            return connect(f'ws://127.0.0.1:{port}')
+        except ConnectionRefusedError as err:
+            if time.perf_counter() - connect_start_time < _SERVER_START_TIMEOUT:
+                time.sleep(0.5) # The server may take some time to start up, wait and try again
+            else:
+                raise err
+
+def stop_servers(processes: list[subprocess.Popen]):
+    """
+    Terminate servers started with start_server.
+    """
+
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=0.5)
+        except subprocess.TimeoutExpired:
+            pass # TODO: Add some kind of warning about potential zombie processes?
+
+def _lease_servers(count: int) -> tuple[socket.socket | None, list[int]]:
+    """
+    Lease up to count servers from the tas_pool daemon and return the lease socket and the ports of the leased servers.
+    The servers stay leased until the socket is closed. Returns (None, []) if the daemon is not running, or if no server
+    becomes available within _LEASE_TIMEOUT seconds.
+    """
+
+    if POOL_ADDRESS == 'off':
+        return None, []
+    host, port = POOL_ADDRESS.rsplit(':', 1)
+    try:
+        lease = socket.create_connection((host, int(port)), timeout=1)
+    except OSError:
+        return None, []
+
+    try:
+        lease.settimeout(_LEASE_TIMEOUT)
+        lease.sendall(json.dumps({'command': 'lease', 'count': count}).encode() + b'\n')
+        response = json.loads(lease.makefile('r').readline() or '{}')
+    except OSError:
+        # Closing the connection cancels the lease, so servers that become available later are not held for nothing
+        lease.close()
+        print(f"WARNING: No server available from TAS pool at {POOL_ADDRESS} within {_LEASE_TIMEOUT} seconds, starting new servers")
+        return None, []
+    if response.get('status') != 'ok':
+        lease.close()
+        raise AssertionError(f"TAS pool returned unexpected response: {response}")
+    lease.settimeout(_LEASE_TIMEOUT)
+    return lease, response['ports']
+
+def _report_unresponsive(lease: socket.socket, port: int):
+    """
+    Tell the tas_pool daemon that a leased server dropped out or hung, so that it is restarted. The server is no longer leased afterwards.
+    """
+
+    # The lease socket is shared by all workers, so requests and their responses must not interleave
+    with _lease_lock:
+        try:
+            lease.sendall(json.dumps({'command': 'restart', 'port': port}).encode() + b'\n')
+            lease.makefile('r').readline()
+        except OSError:
+            pass # The daemon is gone, it restarts its servers when it starts again
+
+def parse_endpoints(endpoints: str) -> list[str]:
+    """
+    Parse a comma separated list of server addresses, e.g. `ws://192.168.1.20:7112-7119,192.168.1.21:7112`, into a list of WebSocket URLs.
+    A range of ports stands for one server on each port. `ws://` is added to addresses without a scheme.
+    """
+
+    urls = []
+    for endpoint in endpoints.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        if '://' not in endpoint:
+            endpoint = f'ws://{endpoint}'
+        port_range = re.fullmatch(r'(.*):(\d+)-(\d+)', endpoint)
+        if port_range:
+            urls.extend(f'{port_range[1]}:{port}' for port in range(int(port_range[2]), int(port_range[3]) + 1))
+        else:
+            urls.append(endpoint)
+    return urls
 
 def connect(url = 'ws://127.0.0.1:7111') -> Connection:
     """
@@ -99,21 +662,650 @@ def connect(url = 'ws://127.0.0.1:7111') -> Connection:
     """
     return client.connect(url)
 
-def play_level(connection: Connection, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None = None) -> tuple[bool, int]:
+def play_level(connection: Connection, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None = None, max_ticks: int | None = None, snapshot_interval: int | None = None, restart: str | None = None, binary: bool = False, cache: 'ResultCache | None' = None, telemetry_interval: int | None = None) -> tuple[bool, int]:
     """
     Play a level with the given inputs and return a result indicating if the level was completed successfully and how many ticks it took to finish.
 
     If start_positions is given then the players will be teleported to the given positions at the start of the level.
+
+    If max_ticks is given then the server stops the run as soon as it is clear that the level will not be finished within max_ticks ticks.
+    Such runs are reported as not completed, with a duration of max_ticks + 1.
+
+    If snapshot_interval is given then the server takes a snapshot of the level state every snapshot_interval ticks and resumes
+    from the latest snapshot of an earlier run with the same prefix of inputs instead of replaying the level from the start.
+    Snapshots are kept in memory on each server, so this only helps if similar inputs are played on the same connection.
+    Snapshots do not capture the state of the physics server, so check that resumed runs give the same results for a level
+    with restart='check', or start the servers with --snapshot-verify=<n> to replay every n-th resumed run from the start.
+
+    The restart parameter selects how the server resets the level before the run:
+    - 'full' (default): unload the level and load it again through the game's menus.
+    - 'fast': if the level is already loaded then replace it with a fresh instance of the level scene, which is much faster.
+    - 'check': play the run with the fast paths (fast restart and snapshots) and again with a full reload, and raise an error
+      if the results differ. Use this to verify that the fast paths are deterministic for a level before relying on them.
+
+    If binary is set then the request and result are sent in a compact binary format instead of JSON (see `encode_request`).
+
+    If a cache is given then the result is looked up from the cache first and only played if it is not found.
+
+    If telemetry_interval is given then the result has a third element with telemetry of the run: a dict with the 'interval',
+    the 'samples' taken every telemetry_interval ticks as tuples (tick, then x, y, velocity x, velocity y and remaining coyote time
+    of the left and of the right player, with y pointing up), and for runs that failed because a player touched a hazard,
+    its node name as 'hazard', the tick at which it was touched as 'hazard_tick' and the player (0 or 1) as 'hazard_player' (None otherwise).
+    The game does not report why a level was reloaded, so the hazard is a best guess. Runs with telemetry are never resumed from snapshots,
+    and are always played, because the cache only stores results without telemetry.
+    """
+
+    if cache is not None and not telemetry_interval:
+        result = cache.get(level, inputs, start_positions, max_ticks)
+        if result is not None:
+            return result
+
+    options = {'max_ticks': max_ticks, 'snapshot_interval': snapshot_interval, 'restart': restart, 'telemetry_interval': telemetry_interval}
+    send_time = time.perf_counter()
+    if binary:
+        connection.send(encode_request('play_level', level, [inputs], [start_positions], options))
+    else:
+        connection.send(json.dumps({'command': 'play_level', 'level': level, 'inputs': inputs, 'start_positions': start_positions, **options}))
+    response = decode_response(connection.recv(timeout=_RESPONSE_TIMEOUT))
+    _record_result(time.perf_counter() - send_time, response)
+    result = _parse_result(response)
+
+    if cache is not None:
+        cache.put(level, inputs, start_positions, max_ticks, result)
+    return result
+
+def play_levels(connection: Connection, level: int, inputs_list: Sequence[list[str]], start_positions_list: Sequence[list[tuple[float, float]] | None] | None = None, max_ticks: int | None = None, snapshot_interval: int | None = None, restart: str | None = None, binary: bool = False, cache: 'ResultCache | None' = None, telemetry_interval: int | None = None) -> Iterator[tuple[bool, int]]:
+    """
+    Play a level once for each list of inputs in `inputs_list` and yield the results in the same format as `play_level`.
+
+    All candidates are sent in a single request and the server plays them back-to-back, sending each result back as soon as it is finished.
+    This avoids paying a full round-trip for every candidate. If start_positions_list is given then it must contain an entry (possibly None) for each candidate.
+    The max_ticks limit, snapshot_interval, restart mode, wire format, cache and telemetry_interval (see `play_level`) apply to all candidates.
+
+    Note: The returned iterator must be exhausted before the connection is used for anything else.
+    """
+
+    if start_positions_list is None:
+        start_positions_list = [None] * len(inputs_list)
+    if len(start_positions_list) != len(inputs_list):
+        raise ValueError(f"Expected {len(inputs_list)} start positions, but got {len(start_positions_list)}")
+
+    options = {'max_ticks': max_ticks, 'snapshot_interval': snapshot_interval, 'restart': restart, 'telemetry_interval': telemetry_interval}
+    return _play_cached(cache, level, inputs_list, start_positions_list, max_ticks, lambda inputs_list, start_positions_list: _play_levels(connection, level, inputs_list, start_positions_list, options, binary), bypass=bool(telemetry_interval))
+
+def _play_levels(connection: Connection, level: int, inputs_list: Sequence[list[str]], start_positions_list: Sequence[list[tuple[float, float]] | None], options: dict, binary: bool = False) -> Iterator[tuple[bool, int]]:
+    if not inputs_list:
+        return
+
+    last_time = time.perf_counter()
+    if binary:
+        connection.send(encode_request('play_levels', level, inputs_list, start_positions_list, options))
+    else:
+        candidates = [{'inputs': inputs, 'start_positions': start_positions} for inputs, start_positions in zip(inputs_list, start_positions_list)]
+        connection.send(json.dumps({'command': 'play_levels', 'level': level, 'candidates': candidates, **options}))
+
+    for i in range(len(inputs_list)):
+        response = decode_response(connection.recv(timeout=_RESPONSE_TIMEOUT))
+        if response.get('index') != i:
+            raise AssertionError(f"TAS returned unexpected response: {response}")
+        now = time.perf_counter()
+        _record_result(now - last_time, response)
+        last_time = now
+        result = _parse_result(response)
+
+        # Consume the final message before yielding the last result, so that the connection is ready for reuse
+        # even if the caller stops iterating as soon as it has all the results.
+        if i == len(inputs_list) - 1:
+            response = decode_response(connection.recv(timeout=_RESPONSE_TIMEOUT))
+            if response['status'] != 'finished':
+                raise AssertionError(f"TAS returned unexpected response: {response}")
+
+        yield result
+
+def encode_inputs(inputs: list[str]) -> bytes:
+    """
+    Encode input lines as packed little-endian (frame, mask) int32 pairs for the binary wire format.
+
+    Bits 0-5 of the mask press and bits 8-13 release the keys W, A, D, U, L, R. The server applies releases before presses,
+    so a line that touches the same key twice is split into multiple events for the same frame.
+    """
+
+    return b''.join(map(_encode_line, inputs))
+
+# Candidates usually share most of their lines, so caching the encoding of each line makes encoding much faster.
+@functools.lru_cache(maxsize=1 << 16)
+def _encode_line(line: str) -> bytes:
+    frame, *parts = line.split()
+    events = []
+    mask = 0
+    for part in parts:
+        key = _BINARY_ACTIONS.find(part[1:])
+        if len(part) != 2 or part[0] not in '+-' or key == -1:
+            raise ValueError(f"Invalid input {part!r} in line {line!r}")
+        if mask & (0x101 << key):
+            events += (int(frame), mask)
+            mask = 0
+        mask |= 1 << (key if part[0] == '+' else key + 8)
+    events += (int(frame), mask)
+    return struct.pack(f'<{len(events)}i', *events)
+
+def encode_request(command: str, level: int, inputs_list: Sequence[list[str]], start_positions_list: Sequence[list[tuple[float, float]] | None], options: dict) -> bytes:
+    """
+    Encode a play_level or play_levels request in the binary wire format.
+    The layout is described in decode_binary_message in tasmaniac/websocket_server.gd.
+    """
+
+    max_ticks = options.get('max_ticks')
+    telemetry_interval = options.get('telemetry_interval') or 0
+    parts = [_BINARY_HEADER.pack(
+        _BINARY_COMMANDS[command],
+        level,
+        -1 if max_ticks is None else max_ticks,
+        options.get('snapshot_interval') or 0,
+        _BINARY_RESTART_MODES[options.get('restart')],
+        len(inputs_list),
+    )]
+    for inputs, start_positions in zip(inputs_list, start_positions_list):
+        events = encode_inputs(inputs)
+        parts.append(struct.pack('<i', (start_positions is not None) | (telemetry_interval > 0) << 1))
+        if start_positions is not None:
+            parts.append(_BINARY_START_POSITIONS.pack(*start_positions[0], *start_positions[1]))
+        if telemetry_interval > 0:
+            parts.append(struct.pack('<i', telemetry_interval))
+        parts.append(struct.pack('<i', len(events) // 8))
+        parts.append(events)
+    return b''.join(parts)
+
+def decode_response(message: str | bytes) -> dict:
+    """
+    Decode a response from the server. Binary results are converted to the same form as JSON responses.
+    """
+
+    if isinstance(message, str):
+        response = json.loads(message)
+        if 'telemetry' in response:
+            response['telemetry']['samples'] = _decode_samples(base64.b64decode(response['telemetry']['samples']))
+        return response
+
+    index, status, completed, duration, resumed_from, load_path, check, parse_usec, load_usec, simulate_usec, wall_usec, simulated_ticks = _BINARY_RESULT.unpack_from(message)
+    if _BINARY_STATUSES[status] == 'finished':
+        return {'status': 'finished', 'count': index}
+    response = {
+        'status': _BINARY_STATUSES[status],
+        'level_completed': bool(completed),
+        'duration_ticks': duration,
+        'resumed_from_tick': None if resumed_from == -1 else resumed_from,
+        'load_path': 'fast_restart' if load_path else 'full_reload',
+        'timings': {
+            'parse_usec': parse_usec,
+            'load_usec': load_usec,
+            'simulate_usec': simulate_usec,
+            'wall_usec': wall_usec,
+            'simulated_ticks': simulated_ticks,
+            'ticks_per_second': simulated_ticks * 1e6 / simulate_usec if simulate_usec > 0 else 0.0,
+        },
+    }
+    if index != -1:
+        response['index'] = index
+    if check != -1:
+        response['check'] = {'match': bool(check)}
+    if len(message) > _BINARY_RESULT.size:
+        interval, num_samples, hazard_tick, hazard_player, hazard_length = _BINARY_TELEMETRY_HEADER.unpack_from(message, _BINARY_RESULT.size)
+        offset = _BINARY_RESULT.size + _BINARY_TELEMETRY_HEADER.size
+        response['telemetry'] = {
+            'interval': interval,
+            'samples': _decode_samples(message[offset + hazard_length:offset + hazard_length + num_samples * _TELEMETRY_SAMPLE.size]),
+            'hazard': None if hazard_tick == -1 else message[offset:offset + hazard_length].decode(),
+            'hazard_tick': None if hazard_tick == -1 else hazard_tick,
+            'hazard_player': None if hazard_player == -1 else hazard_player,
+        }
+    return response
+
+def _decode_samples(data: bytes) -> list[tuple[float, ...]]:
+    # The server sends the tick as a float too, so that each sample is a single array of floats
+    return [(int(tick), *values) for tick, *values in _TELEMETRY_SAMPLE.iter_unpack(data)]
+
+def _play_cached(cache: 'ResultCache | None', level: int, inputs_list: Sequence[list[str]], start_positions_list: Sequence[list[tuple[float, float]] | None], max_ticks: int | None, play: Callable[[Sequence[list[str]], Sequence[list[tuple[float, float]] | None]], Iterable[tuple[bool, int]]], bypass: bool = False) -> Iterator[tuple[bool, int]]:
+    if cache is None:
+        yield from play(inputs_list, start_positions_list)
+        return
+
+    # With bypass set, all candidates are played and only stored in the cache (e.g. because the results include telemetry)
+    cached = [None if bypass else cache.get(level, inputs, start_positions, max_ticks) for inputs, start_positions in zip(inputs_list, start_positions_list)]
+    missing = [i for i, result in enumerate(cached) if result is None]
+    results = iter(play([inputs_list[i] for i in missing], [start_positions_list[i] for i in missing]))
+
+    for i, result in enumerate(cached):
+        if result is None:
+            result = next(results)
+            cache.put(level, inputs_list[i], start_positions_list[i], max_ticks, result)
+        yield result
+
+class ResultCache:
+    """
+    Persistent cache of level results, stored in an SQLite database that can be shared between scripts and runs.
+
+    Results are keyed by level, inputs, start positions and a fingerprint of the game and TASmaniac (see `game_fingerprint`),
+    so results are never reused after the game or TASmaniac is updated. If the fingerprint cannot be determined then the cache
+    is not used at all: nothing is looked up and nothing is stored. Inputs are normalized before lookup,
+    so recordings that only differ in formatting (e.g. multiple keys on one line) share the same entry.
+    Once the cache holds more than max_entries results, the least recently used results are evicted.
+
+    If bypass is set then cached results are ignored, but new results are still stored in the cache.
+    """
+
+    def __init__(self, path: str | Path = 'cache/results.sqlite', max_entries: int = 1_000_000, bypass: bool = False) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+        self._fingerprint = game_fingerprint()
+        if self._fingerprint is None:
+            print("WARNING: Cannot identify the game and TASmaniac version, the result cache is not used")
+        self._lock = Lock()
+        self._puts_since_eviction = 0
+
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # max_ticks is only set for aborted runs. For those runs we only know that they take longer than max_ticks ticks.
+        self._db.execute('CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, completed INTEGER NOT NULL, duration_ticks INTEGER NOT NULL, max_ticks INTEGER, last_used INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None = None, max_ticks: int | None = None) -> tuple[bool, int] | None:
+        """
+        Return the cached result in the same format as `play_level` would return it, or None if the result is not known.
+        """
+
+        key = self._key(level, inputs, start_positions)
+        with self._lock:
+            row = None if self.bypass or self._fingerprint is None else self._db.execute('SELECT completed, duration_ticks, max_ticks FROM results WHERE key = ?', (key,)).fetchone()
+            result = None if row is None else _cached_result(*row, max_ticks)
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._db.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time_ns(), key))
+            return result
+
+    def put(self, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None, max_ticks: int | None, result: tuple[bool, int]):
+        if self._fingerprint is None:
+            return
+        completed, duration = result[:2]
+        aborted = not completed and max_ticks is not None and duration > max_ticks
+
+        key = self._key(level, inputs, start_positions)
+        with self._lock:
+            # Never replace a full result with an aborted one, and only replace an aborted result if the new one got further.
+            self._db.execute(
+                'INSERT INTO results VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET completed = excluded.completed, duration_ticks = excluded.duration_ticks, max_ticks = excluded.max_ticks, last_used = excluded.last_used '
+                'WHERE results.max_ticks IS NOT NULL AND (excluded.max_ticks IS NULL OR excluded.max_ticks > results.max_ticks)',
+                (key, completed, duration, max_ticks if aborted else None, time.time_ns())
+            )
+
+            self._puts_since_eviction += 1
+            if self._puts_since_eviction >= 1000:
+                self._puts_since_eviction = 0
+                (count,) = self._db.execute('SELECT COUNT(*) FROM results').fetchone()
+                if count > self.max_entries:
+                    self._db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+
+    def _key(self, level: int, inputs: list[str], start_positions: list[tuple[float, float]] | None) -> bytes:
+        normalized_inputs = [f'{int(frame)} {key}' for frame, *keys in (line.split() for line in inputs if line.strip()) for key in keys]
+        normalized_start_positions = None if start_positions is None else [[float(x), float(y)] for x, y in start_positions]
+        return hashlib.sha256(json.dumps([self._fingerprint, level, normalized_inputs, normalized_start_positions]).encode()).digest()
+
+def _cached_result(completed: int, duration: int, cached_max_ticks: int | None, max_ticks: int | None) -> tuple[bool, int] | None:
+    if cached_max_ticks is not None:
+        # The cached run was aborted, so it can only answer requests with the same or a lower limit.
+        if max_ticks is None or max_ticks > cached_max_ticks:
+            return None
+        return False, max_ticks + 1
+    if max_ticks is not None and duration > max_ticks:
+        return False, max_ticks + 1
+    return bool(completed), duration
+
+def default_cache() -> ResultCache | None:
+    """
+    Open the result cache used by the scripts in this folder, configured through environment variables:
+
+    * TASMANIAC_CACHE: Path of the cache file (default `cache/results.sqlite`), or `off` to disable the cache.
+    * TASMANIAC_CACHE_MAX_ENTRIES: Maximum number of results to keep (default 1000000).
+    * TASMANIAC_CACHE_BYPASS: Set to 1 to ignore cached results. New results are still stored.
+    """
+
+    path = os.getenv("TASMANIAC_CACHE") or 'cache/results.sqlite'
+    if path == 'off':
+        return None
+    max_entries = int(os.getenv("TASMANIAC_CACHE_MAX_ENTRIES") or "1000000")
+    bypass = os.getenv("TASMANIAC_CACHE_BYPASS") == '1'
+    return ResultCache(path, max_entries=max_entries, bypass=bypass)
+
+@functools.cache
+def game_fingerprint() -> str | None:
+    """
+    Return a string that identifies the installed game and TASmaniac version, or None if either cannot be read.
+
+    TASmaniac is identified by its version together with a hash of its scripts, because changes to the scripts can change results
+    without a new version. If servers are started with TASMANIAC_SERVER_COMMAND then the command, and the files it names
+    (e.g. stand_in_server.py), take the place of the game. Servers on other machines are assumed to run the same version.
+    """
+
+    bootstrap_file = Path('tasmaniac/bootstrap.gd')
+    version_match = re.search(r'const _VERSION = "(.*)"', bootstrap_file.read_text()) if bootstrap_file.exists() else None
+    if version_match is None:
+        return None
+    scripts_hash = hashlib.sha256()
+    for script_file in sorted(Path('tasmaniac').glob('*.gd')):
+        scripts_hash.update(script_file.name.encode() + b'\0' + script_file.read_bytes() + b'\0')
+
+    if _SERVER_COMMAND:
+        game_hash = hashlib.sha256(_SERVER_COMMAND.encode())
+        for part in shlex.split(_SERVER_COMMAND, posix=sys.platform != 'win32')[1:]:
+            if os.path.isfile(part):
+                game_hash.update(b'\0' + Path(part).read_bytes())
+    elif _AMBIDEXTRO_PCK is not None and os.path.exists(_AMBIDEXTRO_PCK):
+        with open(_AMBIDEXTRO_PCK, mode='rb') as f:
+            game_hash = hashlib.file_digest(f, 'sha256')
+    else:
+        return None
+
+    return f'{version_match[1]}/{scripts_hash.hexdigest()[:16]}/{game_hash.hexdigest()}'
+
+_SERVER_TIMINGS = ('parse_usec', 'load_usec', 'simulate_usec', 'wall_usec', 'simulated_ticks')
+
+class _WorkerMetrics:
+    def __init__(self, metrics: 'Metrics', index: int, endpoint: str | None, window: int) -> None:
+        self.metrics = metrics
+        self.index = index
+        self.endpoint = endpoint
+        self.reset(window)
+
+    def reset(self, window: int):
+        self.start_time = time.perf_counter()
+        self.busy_seconds = 0.0
+        self.tasks = 0
+        self.evaluations = 0
+        self.disconnects = 0
+        self.queue_waits = collections.deque[float](maxlen=window)
+        self.latencies = collections.deque[float](maxlen=window)
+        self.server_timings = dict.fromkeys(_SERVER_TIMINGS, 0)
+
+class Metrics:
+    """
+    Client-side metrics for the workers of a `TASExecutor` or `AsyncTASPool`: utilization, queue wait, latency and evaluations per second,
+    together with the time the servers report spending on each phase of a request (see make_timings in tasmaniac/websocket_server.gd).
+
+    Queue wait is measured from submitting a task (or candidate, for `AsyncTASPool`) until a worker starts on it. Latency is measured
+    from sending a request until its result arrives, or from the previous result for candidates played in the same batch.
+    Percentiles are computed over the latest window samples of each worker.
+
+    If path is given then a summary (see `summary`) is appended to it as a JSON line every interval seconds while results come in,
+    and once more when the executor is closed.
+    """
+
+    def __init__(self, path: str | Path | None = None, interval: float = 10.0, window: int = 10_000) -> None:
+        self.path = None if path is None else Path(path)
+        self.interval = interval
+        self._window = window
+        self._lock = Lock()
+        self._workers = list[_WorkerMetrics]()
+        self._start_time = time.perf_counter()
+        self._last_dump_time = self._start_time
+
+    def add_worker(self, endpoint: str | None = None) -> _WorkerMetrics:
+        """
+        Add a worker. endpoint is the URL of its server if the server was not started by the executor.
+        """
+
+        with self._lock:
+            worker = _WorkerMetrics(self, len(self._workers), endpoint, self._window)
+            self._workers.append(worker)
+            return worker
+
+    def reset(self):
+        """
+        Forget everything recorded so far, e.g. after the servers have warmed up.
+        """
+
+        with self._lock:
+            self._start_time = time.perf_counter()
+            for worker in self._workers:
+                worker.reset(self._window)
+
+    def record_task(self, worker: _WorkerMetrics, busy_seconds: float, queue_waits: Iterable[float]):
+        with self._lock:
+            worker.busy_seconds += busy_seconds
+            worker.tasks += 1
+            worker.queue_waits.extend(queue_waits)
+
+    def record_disconnect(self, worker: _WorkerMetrics):
+        with self._lock:
+            worker.disconnects += 1
+
+    def record_result(self, worker: _WorkerMetrics, latency: float, response: dict):
+        if response.get('status') not in ('executed', 'aborted'):
+            return
+        with self._lock:
+            worker.evaluations += 1
+            worker.latencies.append(latency)
+            timings = response.get('timings')
+            if timings is not None:
+                for key in _SERVER_TIMINGS:
+                    worker.server_timings[key] += timings[key]
+
+            dump = self.path is not None and time.perf_counter() - self._last_dump_time >= self.interval
+            if dump:
+                self._last_dump_time = time.perf_counter()
+        if dump:
+            self.dump()
+
+    def summary(self) -> dict:
+        """
+        Return the metrics of each worker and of all workers together. Times are in seconds.
+        """
+
+        with self._lock:
+            now = time.perf_counter()
+            workers = [_summarize(
+                now - worker.start_time, worker.busy_seconds, worker.tasks, worker.evaluations,
+                worker.queue_waits, worker.latencies, worker.server_timings,
+            ) | {'worker': worker.index, 'endpoint': worker.endpoint, 'disconnects': worker.disconnects} for worker in self._workers]
+            total = _summarize(
+                sum(now - worker.start_time for worker in self._workers), sum(worker.busy_seconds for worker in self._workers),
+                sum(worker.tasks for worker in self._workers), sum(worker.evaluations for worker in self._workers),
+                [wait for worker in self._workers for wait in worker.queue_waits], [latency for worker in self._workers for latency in worker.latencies],
+                {key: sum(worker.server_timings[key] for worker in self._workers) for key in _SERVER_TIMINGS},
+            )
+            # Evaluations per second of all workers together are relative to the time since the metrics were created, not the sum of the worker times.
+            total['evaluations_per_second'] = total['evaluations'] / (now - self._start_time)
+            total['disconnects'] = sum(worker.disconnects for worker in self._workers)
+            return {'time': time.time(), 'elapsed': now - self._start_time, 'num_workers': len(self._workers), 'total': total, 'workers': workers}
+
+    def report(self) -> str:
+        """
+        Return a one-line summary of the metrics of all workers together.
+        """
+
+        summary = self.summary()
+        total = summary['total']
+        if not total['evaluations']:
+            return f"Workers: {summary['num_workers']}, no evaluations"
+        report = (
+            f"Workers: {summary['num_workers']}, {total['evaluations']} evaluations ({total['evaluations_per_second']:.1f}/s), "
+            f"utilization {total['utilization']:.0%}, latency p50 {total['latency_p50'] * 1000:.1f}ms p95 {total['latency_p95'] * 1000:.1f}ms, "
+            f"server time: load {total['server']['load_seconds']:.1f}s, simulate {total['server']['simulate_seconds']:.1f}s ({total['server']['ticks_per_second']:.0f} ticks/s)"
+        )
+        if total['disconnects']:
+            report += f", {total['disconnects']} disconnects"
+        return report
+
+    def dump(self):
+        """
+        Append the current summary to the metrics file as a JSON line. Does nothing if there is no metrics file.
+        """
+
+        if self.path is None:
+            return
+        line = json.dumps(self.summary())
+        with self._lock:
+            self._last_dump_time = time.perf_counter()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, mode='a') as f:
+                f.write(line + '\n')
+
+    def close(self):
+        self.dump()
+
+def _summarize(elapsed: float, busy_seconds: float, tasks: int, evaluations: int, queue_waits: Iterable[float], latencies: Iterable[float], server_timings: dict) -> dict:
+    queue_waits = sorted(queue_waits)
+    latencies = sorted(latencies)
+    server_seconds = {key.removesuffix('_usec') + '_seconds': server_timings[key] / 1e6 for key in _SERVER_TIMINGS if key.endswith('_usec')}
+    return {
+        'utilization': busy_seconds / elapsed if elapsed > 0 else 0.0,
+        'tasks': tasks,
+        'evaluations': evaluations,
+        'evaluations_per_second': evaluations / elapsed if elapsed > 0 else 0.0,
+        'queue_wait_p50': _percentile(queue_waits, 0.5),
+        'queue_wait_p95': _percentile(queue_waits, 0.95),
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p95': _percentile(latencies, 0.95),
+        'server': server_seconds | {
+            'simulated_ticks': server_timings['simulated_ticks'],
+            'ticks_per_second': server_timings['simulated_ticks'] / server_seconds['simulate_seconds'] if server_seconds['simulate_seconds'] > 0 else 0.0,
+        },
+    }
+
+def _percentile(sorted_values: list[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def _record_result(latency: float, response: dict):
+    # Results played outside of a TASExecutor worker are not recorded.
+    worker = _worker_metrics.get(None)
+    if worker is not None:
+        worker.metrics.record_result(worker, latency, response)
+
+def default_metrics() -> Metrics:
+    """
+    Create the metrics collector used by the scripts in this folder, configured through environment variables:
+
+    * TASMANIAC_METRICS_FILE: Path of a file to append metrics to as JSON lines. Metrics are not written to a file by default.
+    * TASMANIAC_METRICS_INTERVAL: How often to append metrics to the file, in seconds (default 10).
+    """
+
+    path = os.getenv("TASMANIAC_METRICS_FILE") or None
+    interval = float(os.getenv("TASMANIAC_METRICS_INTERVAL") or "10")
+    return Metrics(path, interval=interval)
+
+def write_atomic(path: str | Path, data: str | bytes):
+    """
+    Write data to a file so that the file either keeps its old contents or has the new contents, even if the script is killed while writing.
+    """
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f'{path.name}.tmp')
+    with open(temp_path, mode='wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+class Checkpoint:
+    """
+    State of a long running search, saved to a file so that the search can be resumed after the script is interrupted.
+    The state can be any picklable object. Only load checkpoints that were written by the scripts in this folder.
+    The state of a search on a recording should be a dict that includes `recording_state`, so that `load` can tell whether
+    the checkpoint still belongs to the recording.
+
+    `save` only writes the state if at least interval seconds have passed since it was last written, unless force is set,
+    so it can be called after every result. The first call always writes it.
+    """
+
+    def __init__(self, path: str | Path, interval: float = 60.0) -> None:
+        self.path = Path(path)
+        self.interval = interval
+        self._last_save = -math.inf
+
+    def load(self, level: int | None = None) -> object | None:
+        """
+        Return the saved state, or None if there is no checkpoint. If level is given, None is also returned if the checkpoint
+        was saved for another level, or if its recording was changed or removed since then (see `recording_state`).
+        """
+
+        if not self.path.exists():
+            return None
+        with open(self.path, mode='rb') as f:
+            state = pickle.load(f)
+        if level is not None and (state.get('level') != level or file_hash(state['inputs_file']) != state.get('inputs_hash')):
+            print(f"Ignoring checkpoint {self.path}, it does not match the recording {state['inputs_file']} of level {level}")
+            return None
+        return state
+
+    def due(self) -> bool:
+        """
+        Return True if `save` would write the state now without force.
+        """
+
+        return time.perf_counter() - self._last_save >= self.interval
+
+    def save(self, state: object, force: bool = False):
+        if not force and not self.due():
+            return
+        write_atomic(self.path, pickle.dumps(state))
+        self._last_save = time.perf_counter()
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+def recording_state(level: int, inputs_file: Path) -> dict:
+    """
+    Return the part of a checkpoint state that ties it to a level and the contents of its recording, see `Checkpoint.load`.
+    """
+
+    return {'level': level, 'inputs_file': inputs_file, 'inputs_hash': file_hash(inputs_file)}
+
+def file_hash(path: str | Path) -> str | None:
+    """
+    Return the SHA-256 hash of a file as a hex string, or None if the file does not exist.
+    """
+
+    try:
+        with open(path, mode='rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    except FileNotFoundError:
+        return None
+
+def default_checkpoint(name: str) -> Checkpoint:
+    """
+    Create a checkpoint for the scripts in this folder, stored as `checkpoints/<name>.pickle` and configured through environment variables:
+
+    * TASMANIAC_CHECKPOINT_INTERVAL: How often to save the checkpoint, in seconds (default 60).
     """
 
-    connection.send(json.dumps({'command': 'play_level', 'level': level, 'inputs': inputs, 'start_positions': start_positions}))
-    response = json.loads(connection.recv(decode=True))
+    interval = float(os.getenv("TASMANIAC_CHECKPOINT_INTERVAL") or "60")
+    return Checkpoint(Path('checkpoints') / f'{name}.pickle', interval=interval)
 
-    if response['status'] != 'executed':
+def _parse_result(response: dict) -> tuple[bool, int]:
+    if response['status'] not in ('executed', 'aborted'):
         raise AssertionError(f"TAS returned unexpected response: {response}")
     if response['duration_ticks'] <= 0:
         raise AssertionError(f"TAS returned suspicious duration: {response['duration_ticks']}")
+    if 'check' in response and not response['check']['match']:
+        raise AssertionError(f"TAS fast path result {response['check']} does not match full reload result {response}")
 
+    if 'telemetry' in response:
+        return response['level_completed'], response['duration_ticks'], response['telemetry']
     return response['level_completed'], response['duration_ticks']
 
 if __name__ == '__main__':
@@ -6,12 +6,21 @@ var _headless := !DisplayServer.window_can_draw()
 
 var _recordings_folder: String
 var _manager_scene: PackedScene
+var _manager_script: GDScript
 var _websocket_server_script: GDScript
 
 var _websocket_server_port = null
 
 var _delta_multiplier := 1.0
 
+var _snapshot_budget_mb := 256
+# Every n-th run that was resumed from a snapshot is played again from the start of the level to verify it, see websocket_server.play. 0 disables this.
+var _snapshot_verify_interval := 0
+
+# Lean mode creates the manager without its UI and skips all UI updates, see manager.gd.
+# Enabled automatically for a headless server, unless --no-lean is given.
+var _lean = null
+
 var _last_frame_usec := 0
 var _last_delay_usec := 0
 
@@ -36,9 +45,6 @@ func _initialize():
 	else:
 		_assert(false, "Expected 0 or 1 command line arguments, but got %s" % len(args))
 	
-	_manager_scene = load("res://tasmaniac/manager.tscn")
-	_assert(_manager_scene != null, "Failed to load tasmaniac/manager.tscn. Make sure that you have copied the entire tasmaniac folder to your install location.")
-	
 	for flag in flags:
 		if flag == "--server":
 			_websocket_server_port = 7111
@@ -46,9 +52,32 @@ func _initialize():
 			var port_string = flag.trim_prefix("--server=")
 			_assert(port_string.is_valid_int(), "Invalid server port: %s" % port_string)
 			_websocket_server_port = port_string.to_int()
+		elif flag.begins_with("--snapshot-budget="):
+			var budget_string = flag.trim_prefix("--snapshot-budget=")
+			_assert(budget_string.is_valid_int() and budget_string.to_int() >= 0, "Invalid snapshot budget: %s" % budget_string)
+			_snapshot_budget_mb = budget_string.to_int()
+		elif flag.begins_with("--snapshot-verify="):
+			var verify_string = flag.trim_prefix("--snapshot-verify=")
+			_assert(verify_string.is_valid_int() and verify_string.to_int() >= 0, "Invalid snapshot verification interval: %s" % verify_string)
+			_snapshot_verify_interval = verify_string.to_int()
+		elif flag == "--lean":
+			_lean = true
+		elif flag == "--no-lean":
+			_lean = false
 		else:
 			_assert(false, "Unrecognized command line flag: %s" % flag)
 	
+	if _lean == null:
+		_lean = _headless and _websocket_server_port != null
+	
+	if _lean:
+		print("[TASmaniac] Running in lean mode without UI")
+		_manager_script = load("res://tasmaniac/manager.gd")
+		_assert(_manager_script != null, "Failed to load tasmaniac/manager.gd. Make sure that you have copied the entire tasmaniac folder to your install location.")
+	else:
+		_manager_scene = load("res://tasmaniac/manager.tscn")
+		_assert(_manager_scene != null, "Failed to load tasmaniac/manager.tscn. Make sure that you have copied the entire tasmaniac folder to your install location.")
+	
 	if _websocket_server_port != null:
 		_websocket_server_script = load("res://tasmaniac/websocket_server.gd")
 		_assert(_websocket_server_script != null, "Failed to load tasmaniac/websocket_server.gd. Make sure that you have copied the entire tasmaniac folder to your install location.")
@@ -144,7 +173,17 @@ func _on_scene_load(scene: Node):
 		var menu_loader := scene.get_node("MenuLoader")
 		var global := root.get_node("Global")
 		
-		var manager := _manager_scene.instantiate()
+		var manager: Node
+		if _lean:
+			# Same settings as the root node of manager.tscn, without any of the UI nodes.
+			manager = Node.new()
+			manager.set_script(_manager_script)
+			manager.name = "TASmaniacManager"
+			manager.process_priority = -1
+			manager.process_physics_priority = -1
+			manager.lean = true
+		else:
+			manager = _manager_scene.instantiate()
 		manager.init(_recordings_folder, level_loader, menu_loader, global)
 		scene.add_child(manager)
 		
@@ -157,6 +196,9 @@ func _on_scene_load(scene: Node):
 # TODO: Process is in the middle of the game loop, so adding a delay here increases the input latency.
 # It would be good to add the delay somewhere else, but currently there seems to be no other suitable location.
 func _process(delta: float):
+	if _delta_multiplier == 0.0:
+		return
+	
 	var target_delta_usec := roundi(delta * _delta_multiplier * 1_000_000)
 	var new_frame_usec := Time.get_ticks_usec()
 	var new_delay_usec := maxi(0, target_delta_usec - (new_frame_usec - _last_frame_usec - _last_delay_usec))
@@ -1,6 +1,10 @@
 extends Node
 
 const FRAME_STOP := -1024
+# Frame of the sentinel event at the end of every schedule, see compile_inputs.
+const SCHEDULE_END := 0x7fffffff
+
+signal playback_aborted
 
 const ACTIONS := {
 	"W": &"up_l",
@@ -12,22 +16,26 @@ const ACTIONS := {
 }
 
 const collision_drawer_script := preload("res://tasmaniac/collision_drawer.gd")
+const snapshot_cache_script := preload("res://tasmaniac/snapshot_cache.gd")
 
-@onready var settings_container: Container = $SettingsContainer
-@onready var time_scale_input: Range = $SettingsContainer/TimeScaleInput
-@onready var input_file_input: OptionButton = $SettingsContainer/InputFileInput
-@onready var save_recording_button: Button = $SettingsContainer/SaveRecordingButton
-@onready var collision_shapes_toggle: Button = $SettingsContainer/CollisionShapesToggle
-@onready var timer_label: Label = $TimerLabel
-@onready var notification_label: Label = $NotificationLabel
-@onready var notification_label_timer: Timer = $NotificationLabel/Timer
-@onready var player_info: Container = $PlayerInfo
-@onready var coyote_labels: Array[Label] = [$PlayerInfo/CoyoteLeft, $PlayerInfo/CoyoteRight]
-@onready var alignment_labels: Array[Label] = [$PlayerInfo/AlignmentLeft, $PlayerInfo/AlignmentRight]
-@onready var position_labels: Array[Label] = [$PlayerInfo/PositionLeft, $PlayerInfo/PositionRight]
-@onready var velocity_labels: Array[Label] = [$PlayerInfo/VelocityLeft, $PlayerInfo/VelocityRight]
+# The UI nodes are null in lean mode, where the manager is created without manager.tscn.
+@onready var settings_container: Container = get_node_or_null(^"SettingsContainer")
+@onready var time_scale_input: Range = get_node_or_null(^"SettingsContainer/TimeScaleInput")
+@onready var input_file_input: OptionButton = get_node_or_null(^"SettingsContainer/InputFileInput")
+@onready var save_recording_button: Button = get_node_or_null(^"SettingsContainer/SaveRecordingButton")
+@onready var collision_shapes_toggle: Button = get_node_or_null(^"SettingsContainer/CollisionShapesToggle")
+@onready var timer_label: Label = get_node_or_null(^"TimerLabel")
+@onready var notification_label: Label = get_node_or_null(^"NotificationLabel")
+@onready var notification_label_timer: Timer = get_node_or_null(^"NotificationLabel/Timer")
+@onready var player_info: Container = get_node_or_null(^"PlayerInfo")
+@onready var coyote_labels: Array[Label] = [get_node_or_null(^"PlayerInfo/CoyoteLeft"), get_node_or_null(^"PlayerInfo/CoyoteRight")]
+@onready var alignment_labels: Array[Label] = [get_node_or_null(^"PlayerInfo/AlignmentLeft"), get_node_or_null(^"PlayerInfo/AlignmentRight")]
+@onready var position_labels: Array[Label] = [get_node_or_null(^"PlayerInfo/PositionLeft"), get_node_or_null(^"PlayerInfo/PositionRight")]
+@onready var velocity_labels: Array[Label] = [get_node_or_null(^"PlayerInfo/VelocityLeft"), get_node_or_null(^"PlayerInfo/VelocityRight")]
 
 var headless := !DisplayServer.window_can_draw()
+# In lean mode there is no UI, and all per-frame work that only updates the UI is skipped. Set by bootstrap.gd before the manager is added to the tree.
+var lean := false
 var default_tps := Engine.physics_ticks_per_second
 
 var recordings_folder: String
@@ -46,8 +54,41 @@ var playback := false
 var autoload := true
 
 var input_file: String = ""
+# Inputs of the current recording, as lines in the recording file format.
 var inputs: PackedStringArray = []
-var inputs_i := 0
+# Inputs for playback, compiled into (frame, mask) events, and the index of the next event to apply.
+var schedule := PackedInt32Array([SCHEDULE_END, 0])
+var schedule_i := 0
+var action_names: Array = ACTIONS.values()
+
+# Playback is aborted if the level has not been finished by this frame. Negative values disable the limit.
+var max_frame := -1
+
+var snapshots: RefCounted
+# Snapshots are taken every snapshot_interval frames during manual playback. 0 disables snapshots.
+var snapshot_interval := 0
+var snapshot_key := ""
+var resume_snapshot = null
+var resumed_from_frame := -1
+
+# Telemetry is recorded every telemetry_interval frames during manual playback, see record_telemetry. 0 disables telemetry.
+var telemetry_interval := 0
+# Samples of the current run, 11 floats each: the frame, then position (x, y), velocity (x, y) and remaining coyote time
+# of each player, with y pointing up like in the player info UI.
+var telemetry := PackedFloat32Array()
+# The last object that touched a player's damage area during the current run, as a best guess of what killed them.
+var telemetry_hazard := ""
+var telemetry_hazard_frame := -1
+var telemetry_hazard_player := -1
+var telemetry_damage_areas: Array[Area2D] = []
+
+# Scene paths of levels that have been loaded for manual playback, used to check if a level can be restarted quickly.
+var level_scene_paths := {}
+var pending_level := -1
+# Which path was used to load the level for the last manual playback: "fast_restart" or "full_reload".
+var load_path := ""
+# Time (from Time.get_ticks_usec) at which the last level finished loading, used for request timings.
+var level_loaded_usec := 0
 
 func init(recordings_folder: String, level_loader: Node, menu_loader: Node, global: Node):
 	self.recordings_folder = recordings_folder
@@ -60,13 +101,16 @@ func _ready():
 	level_loader._level_complete.connect(on_level_complete)
 	level_loader._level_unload.connect(on_level_unload)
 	
-	time_scale_input.value_changed.connect(update_time_scale)
-	save_recording_button.pressed.connect(func(): if recording and level_loaded and inputs: save_recording(true))
-	collision_shapes_toggle.toggled.connect(update_draw_collision_shapes)
-	
-	notification_label_timer.timeout.connect(func(): notification_label.visible = false)
+	if !lean:
+		time_scale_input.value_changed.connect(update_time_scale)
+		save_recording_button.pressed.connect(func(): if recording and level_loaded and inputs: save_recording(true))
+		collision_shapes_toggle.toggled.connect(update_draw_collision_shapes)
+		
+		notification_label_timer.timeout.connect(func(): notification_label.visible = false)
+		
+		$VersionLabel.text = "v" + global.version + " / " + get_tree()._VERSION
 	
-	$VersionLabel.text = "v" + global.version + " / " + get_tree()._VERSION
+	snapshots = snapshot_cache_script.new(get_tree()._snapshot_budget_mb * 1024 * 1024)
 
 func update_time_scale(value: float):
 	get_tree()._set_delta_multiplier(1.0 / value)
@@ -118,26 +162,162 @@ func update_draw_collision_shapes(enabled: bool):
 			collision_drawer.queue_free()
 
 func show_notification(text: String):
+	if lean:
+		return
 	notification_label.text = text
 	notification_label.visible = true
 	notification_label_timer.stop()
 	notification_label_timer.start()
 
-func start_manual_playback(level: int, level_inputs: PackedStringArray, level_start_positions):
-	input_file_input.select(-1)
+# If level_restart is "fast" and the requested level is currently loaded then the level is restarted using level_loader.restart_level().
+# Otherwise it is unloaded and loaded again through the menu loader.
+# If level_telemetry_interval is positive then telemetry is recorded for the run, see record_telemetry.
+func start_manual_playback(level: int, level_schedule: PackedInt32Array, level_start_positions, level_max_frame := -1, level_snapshot_interval := 0, level_restart := "full", level_telemetry_interval := 0):
+	if !lean:
+		input_file_input.select(-1)
 	recording = false
 	playback = true
 	autoload = false
 	
-	inputs = level_inputs
-	inputs_i = 0
+	schedule = level_schedule
+	schedule_i = 0
+	max_frame = level_max_frame
 	
-	level_loader.unload_level()
-	menu_loader.manage_load_level(level, 1, 0, 0)
+	# Runs can only be resumed from snapshots of runs with the same level and start positions.
+	snapshot_interval = level_snapshot_interval
+	snapshot_key = "%s %s" % [level, level_start_positions]
+	resumed_from_frame = -1
+	# Runs with telemetry are never resumed, because the samples before the snapshot would be missing.
+	resume_snapshot = snapshots.find(snapshot_key, schedule) if snapshot_interval > 0 and level_telemetry_interval == 0 else null
+	
+	telemetry_interval = level_telemetry_interval
+	telemetry = PackedFloat32Array()
+	telemetry_hazard = ""
+	telemetry_hazard_frame = -1
+	telemetry_hazard_player = -1
+	telemetry_damage_areas = []
+	
+	var level_instance: Node = level_loader.current_level_instance
+	if level_restart == "fast" and is_instance_valid(level_instance) and level_scene_paths.get(level) == level_instance.scene_file_path:
+		load_path = "fast_restart"
+		level_loader.restart_level()
+	else:
+		load_path = "full_reload"
+		pending_level = level
+		level_loader.unload_level()
+		menu_loader.manage_load_level(level, 1, 0, 0)
 	
 	if level_start_positions:
 		set_player_positions.call_deferred(level_start_positions)
 
+func abort_playback():
+	level_loaded = false
+	playback = false
+	max_frame = -1
+	
+	for key in ACTIONS:
+		Input.action_release(ACTIONS[key])
+	
+	if !headless:
+		print("[TASmaniac] Playback aborted at frame %s" % frame)
+	playback_aborted.emit()
+
+func has_input_at(target_frame: int) -> bool:
+	return schedule_i > 0 and schedule[schedule_i - 2] == target_frame
+
+# Compiles input lines like "123 +W -L" into a schedule of (frame, mask) events. Bits 0-5 of the mask press and bits 8-13
+# release the actions in ACTIONS order. Releases are applied before presses, so a line that uses the same key twice
+# is split into multiple events. The schedule ends with a sentinel event at SCHEDULE_END, so that playback only has to
+# compare the frame of the next event. Returns {"schedule": schedule} or {"error": message, "line": line number}.
+static func compile_inputs(lines: PackedStringArray) -> Dictionary:
+	var keys := ACTIONS.keys()
+	var compiled := PackedInt32Array()
+	var last_frame := 0
+	for line_i in len(lines):
+		var parts := lines[line_i].split(" ", false)
+		if parts.is_empty():
+			continue
+		if !parts[0].is_valid_int() or int(parts[0]) < last_frame or int(parts[0]) >= SCHEDULE_END:
+			return {"error": "invalid frame '%s'" % parts[0], "line": line_i + 1}
+		var line_frame := int(parts[0])
+		var mask := 0
+		for part in parts.slice(1):
+			var prefix := part.substr(0, 1)
+			var bit := keys.find(part.substr(1))
+			if bit == -1 or (prefix != "+" and prefix != "-"):
+				return {"error": "invalid input '%s'" % part, "line": line_i + 1}
+			if mask & (0x101 << bit):
+				compiled.append(line_frame)
+				compiled.append(mask)
+				mask = 0
+			mask |= 1 << bit if prefix == "+" else 0x100 << bit
+		compiled.append(line_frame)
+		compiled.append(mask)
+		last_frame = line_frame
+	compiled.append(SCHEDULE_END)
+	compiled.append(0)
+	return {"schedule": compiled}
+
+# Validates (frame, mask) events that are already in schedule format (e.g. from a binary request) and adds the sentinel.
+# Returns {"schedule": schedule} or {"error": message, "event": event index}.
+static func compile_events(events: PackedInt32Array) -> Dictionary:
+	var all_actions := (1 << len(ACTIONS)) - 1
+	var valid_bits := all_actions | (all_actions << 8)
+	var last_frame := 0
+	for i in range(0, len(events), 2):
+		if events[i] < last_frame or events[i] >= SCHEDULE_END:
+			return {"error": "invalid frame %s" % events[i], "event": i / 2}
+		if events[i + 1] & ~valid_bits:
+			return {"error": "invalid mask %s" % events[i + 1], "event": i / 2}
+		last_frame = events[i]
+	var compiled := events.duplicate()
+	compiled.append(SCHEDULE_END)
+	compiled.append(0)
+	return {"schedule": compiled}
+
+static func format_event(event_frame: int, mask: int) -> String:
+	var keys := ACTIONS.keys()
+	var parts := PackedStringArray([str(event_frame)])
+	for bit in len(keys):
+		if mask & (0x100 << bit):
+			parts.append("-" + keys[bit])
+	for bit in len(keys):
+		if mask & (1 << bit):
+			parts.append("+" + keys[bit])
+	return " ".join(parts)
+
+func snapshot_extras() -> Array[Node]:
+	return [level_loader, global]
+
+# Samples both players every telemetry_interval frames, and remembers the last object that touched a player's damage area.
+# The game does not report why a level was reloaded, so the touching object is only a best guess of the cause of death.
+func record_telemetry():
+	if frame % telemetry_interval == 0:
+		telemetry.append(frame)
+		for i in 2:
+			var chara: Node = global.player_charas[i]
+			var position: Vector2 = chara.global_position * Vector2(1, -1)
+			var velocity: Vector2 = chara.velocity * Vector2(1, -1)
+			telemetry.append_array([position.x, position.y, velocity.x, velocity.y, chara.coyote_timer.time_left])
+	
+	if telemetry_damage_areas.is_empty():
+		var damage_areas: Array[Area2D] = []
+		for i in 2:
+			var damage_area := global.player_charas[i].find_child("DamageArea", true, false) as Area2D
+			if damage_area == null:
+				return
+			damage_areas.append(damage_area)
+		telemetry_damage_areas = damage_areas
+	for i in 2:
+		var chara: Node = global.player_charas[i]
+		var damage_area: Area2D = telemetry_damage_areas[i]
+		for other in damage_area.get_overlapping_bodies() + damage_area.get_overlapping_areas():
+			if other != chara and !chara.is_ancestor_of(other):
+				telemetry_hazard = other.name
+				telemetry_hazard_frame = frame
+				telemetry_hazard_player = i
+				break
+
 func set_player_positions(positions):
 	for i in 2:
 		global.player_charas[i].global_position = positions[i] * Vector2(1, -1)
@@ -172,34 +352,20 @@ func save_recording(incomplete: bool):
 # TODO: This should be called even if the player has not moved, but currently it isn't.
 func on_level_load():
 	level_loaded = true
+	level_loaded_usec = Time.get_ticks_usec()
 	
-	if collision_shapes_toggle.button_pressed:
-		(func(): update_draw_collision_shapes(collision_shapes_toggle.button_pressed)).call_deferred()
+	if pending_level != -1:
+		level_scene_paths[pending_level] = level_loader.current_level_instance.scene_file_path
+		pending_level = -1
 	
-	if autoload and level_loader.get_level_number_string() != input_files_list_level:
-		input_files_list_level = level_loader.get_level_number_string()
-		
-		var selected := input_file_input.selected
-		input_file_input.clear()
-		input_file_input.add_item("Record new...")
-		
-		var dir := DirAccess.open(recordings_folder)
-		if DirAccess.get_open_error() == OK:
-			var prefix := "lvl%s" % input_files_list_level
-			var file_names := dir.get_files()
-			for file in file_names:
-				if file.begins_with(prefix) and file.ends_with(".txt"):
-					input_file_input.add_item(file)
-		elif DirAccess.get_open_error() != ERR_INVALID_PARAMETER:
-			alert("Failed to read list of recordings from recordings folder: " + error_string(DirAccess.get_open_error()))
+	if !lean:
+		if collision_shapes_toggle.button_pressed:
+			(func(): update_draw_collision_shapes(collision_shapes_toggle.button_pressed)).call_deferred()
 		
-		input_file_input.select(min(selected, input_file_input.item_count - 1, 1))
-	
-	update_input_file(input_file_input.selected)
+		update_input_files_list()
 	
 	if recording:
 		inputs = []
-		inputs_i = 0
 		
 		frame = FRAME_STOP
 	elif playback:
@@ -217,19 +383,53 @@ func on_level_load():
 			if file.get_error() != OK:
 				alert("Failed to read recording from file " + filename + ": " + error_string(file.get_error()))
 				return
-			inputs = contents.split("\n", false)
-			inputs_i = 0
+			var compiled := compile_inputs(contents.split("\n", false))
+			if compiled.has("error"):
+				alert("Failed to load recording from file %s: line %s: %s" % [filename, compiled["line"], compiled["error"]])
+				return
+			schedule = compiled["schedule"]
+			schedule_i = 0
 			
 			print("[TASmaniac] Loaded " + filename + " for playback")
 			show_notification("Loaded " + filename + " for playback")
 		
 		# Only start the clock if we have freshly loaded inputs.
-		if inputs and inputs_i == 0:
+		if len(schedule) > 2 and schedule_i == 0:
 			# This delay is necessary, because the game refuses to take inputs for the first idle frame after a new level is loaded
 			# (the first idle frame is frame -1, because frame -2 is the frame during which loading happens).
 			frame = -2
 		else:
 			frame = FRAME_STOP
+		
+		if resume_snapshot != null:
+			if snapshots.begin_restore(resume_snapshot, level_loader.current_level_instance, ACTIONS.values()):
+				schedule_i = resume_snapshot["schedule_i"]
+			else:
+				push_error("[TASmaniac] ERROR: Failed to restore snapshot at frame %s" % resume_snapshot["frame"])
+				snapshots.discard(resume_snapshot)
+				resume_snapshot = null
+
+func update_input_files_list():
+	if autoload and level_loader.get_level_number_string() != input_files_list_level:
+		input_files_list_level = level_loader.get_level_number_string()
+		
+		var selected := input_file_input.selected
+		input_file_input.clear()
+		input_file_input.add_item("Record new...")
+		
+		var dir := DirAccess.open(recordings_folder)
+		if DirAccess.get_open_error() == OK:
+			var prefix := "lvl%s" % input_files_list_level
+			var file_names := dir.get_files()
+			for file in file_names:
+				if file.begins_with(prefix) and file.ends_with(".txt"):
+					input_file_input.add_item(file)
+		elif DirAccess.get_open_error() != ERR_INVALID_PARAMETER:
+			alert("Failed to read list of recordings from recordings folder: " + error_string(DirAccess.get_open_error()))
+		
+		input_file_input.select(min(selected, input_file_input.item_count - 1, 1))
+	
+	update_input_file(input_file_input.selected)
 
 func on_level_complete():
 	level_loaded = false
@@ -243,13 +443,16 @@ func on_level_unload():
 	
 	input_files_list_level = ""
 	
+	if lean:
+		return
+	
 	var selected := input_file_input.selected
 	input_file_input.clear()
 	input_file_input.add_item("Record new...")
 	input_file_input.add_item("First matching recording")
 	input_file_input.select(min(selected, 1))
 
-func _process(delta: float):
+func update_labels():
 	if level_loaded or frame != FRAME_STOP:
 		var timer_frame := 0 if frame == FRAME_STOP else frame
 		timer_label.text = "%05.2f / %d" % [float(timer_frame) / default_tps, timer_frame]
@@ -265,6 +468,10 @@ func _process(delta: float):
 			velocity_labels[i].text = "%7.2v" % (global.player_charas[i].velocity * Vector2(1, -1))
 	else:
 		player_info.visible = false
+
+func _process(delta: float):
+	if !lean:
+		update_labels()
 	
 	if not level_loaded:
 		return
@@ -282,36 +489,42 @@ func _process(delta: float):
 				frame = 0
 			inputs.append(str(frame) + " " + " ".join(parts))
 	elif playback:
-		while inputs_i < len(inputs):
-			var parts := inputs[inputs_i].split(" ", false)
-			var target_frame := int(parts[0])
-			if target_frame > frame:
-				break
-			
+		while schedule[schedule_i] <= frame:
+			var mask := schedule[schedule_i + 1]
 			if !headless:
-				print("[TASmaniac] " + inputs[inputs_i])
-			for input in parts.slice(1):
-				var prefix := input.substr(0, 1)
-				var key := input.substr(1)
-				if key not in ACTIONS:
-					print("[TASmaniac] WARNING: invalid input " + input)
-					continue
-				if prefix == "+":
-					Input.action_press(ACTIONS[key])
-				elif prefix == "-":
-					Input.action_release(ACTIONS[key])
-				else:
-					print("[TASmaniac] WARNING: invalid input " + input)
-					continue
-			
-			inputs_i += 1
+				print("[TASmaniac] " + format_event(schedule[schedule_i], mask))
+			for bit in len(action_names):
+				if mask & (0x100 << bit):
+					Input.action_release(action_names[bit])
+			for bit in len(action_names):
+				if mask & (1 << bit):
+					Input.action_press(action_names[bit])
+			schedule_i += 2
 
 func _physics_process(delta: float):
 	if not level_loaded:
 		return
 	
+	if resume_snapshot != null:
+		if !snapshots.continue_restore(resume_snapshot, level_loader.current_level_instance, snapshot_extras()):
+			return
+		frame = resume_snapshot["frame"]
+		resumed_from_frame = frame
+		resume_snapshot = null
+	
 	if frame != FRAME_STOP:
+		# Snapshots are taken before the level processes the tick, see snapshot_cache.gd.
+		if playback and snapshot_interval > 0 and frame > 0 and frame % snapshot_interval == 0 and frame != resumed_from_frame and !has_input_at(frame):
+			snapshots.capture(snapshot_key, frame, schedule, schedule_i, level_loader.current_level_instance, snapshot_extras(), ACTIONS.values())
+		
+		if playback and telemetry_interval > 0 and frame >= 0:
+			record_telemetry()
+		
 		frame += 1
+		
+		# The manager runs before the level, so a level that would finish on max_frame still gets to finish.
+		if playback and max_frame >= 0 and frame > max_frame:
+			abort_playback()
 
 static func alert(message: String):
 	push_error("[TASmaniac] ERROR: " + message)
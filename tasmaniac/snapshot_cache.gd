@@ -0,0 +1,387 @@
+extends RefCounted
+
+# Snapshots of the level state in the middle of a run, used to resume runs that share a prefix of inputs
+# instead of replaying them from the start of the level.
+#
+# A snapshot is taken at the start of a physics tick (before the level has processed it) and contains:
+# * the script variables and a selection of built-in properties of every node in the level,
+# * the script variables of the level loader and the Global autoload,
+# * which input actions are held down.
+# Nodes that were spawned during the run (e.g. projectiles) are instantiated again when restoring,
+# and nodes that were freed during the run are freed again.
+#
+# The state of the physics server (e.g. contacts and the broadphase) is not captured, and resources are shared with the level
+# instead of copied, so a resumed run can in principle differ from a full replay. Use the server's --snapshot-verify flag
+# or restart='check' to verify that resumed runs give the same results for a level.
+#
+# Snapshots are only taken on ticks where no inputs were applied, because restoring the input state cannot
+# reproduce is_action_just_pressed. Restoring takes two ticks, during which the level does not process:
+# 1. When the level is loaded, the held actions are pressed, so that they are no longer "just pressed" when the level resumes.
+# 2. On the first tick the state is restored with signals blocked, so that the physics server can catch up with the new positions.
+# 3. On the second tick the state is restored again, signals are unblocked and the level continues from the snapshot.
+
+const MARKER := "__tasmaniac_snapshot__"
+
+# Built-in properties that change while a level is played. Everything else is assumed to stay at its initial value.
+const BUILTIN_PROPERTIES := {
+	&"Node": [&"process_mode"],
+	&"CanvasItem": [&"visible", &"modulate", &"self_modulate"],
+	&"Node2D": [&"position", &"rotation", &"scale", &"skew"],
+	&"CollisionObject2D": [&"collision_layer", &"collision_mask"],
+	&"CharacterBody2D": [&"velocity"],
+	&"RigidBody2D": [&"linear_velocity", &"angular_velocity", &"freeze", &"sleeping"],
+	&"Area2D": [&"monitoring", &"monitorable"],
+	&"CollisionShape2D": [&"disabled"],
+	&"CollisionPolygon2D": [&"disabled"],
+	&"RayCast2D": [&"enabled", &"target_position"],
+	&"PathFollow2D": [&"progress"],
+	&"Sprite2D": [&"frame", &"flip_h", &"flip_v"],
+	&"AnimatedSprite2D": [&"speed_scale", &"flip_h", &"flip_v"],
+	&"AnimationPlayer": [&"speed_scale"],
+	&"Timer": [&"wait_time", &"one_shot", &"paused"],
+}
+
+# Snapshot sizes are measured as the length of the serialized snapshot, see `capture`.
+var budget_bytes: int
+var used_bytes := 0
+
+# Snapshots grouped by level and start positions, see `capture`.
+var snapshots := {}
+var use_counter := 0
+
+var scene_cache := {}
+
+# Live nodes for each captured node path, for the snapshot that is currently being restored.
+var restored_nodes := {}
+var restored_process_mode := Node.PROCESS_MODE_INHERIT
+var restore_step := 0
+
+func _init(budget_bytes: int):
+	self.budget_bytes = budget_bytes
+
+func clear():
+	snapshots.clear()
+	used_bytes = 0
+
+func discard(snapshot: Dictionary):
+	for key in snapshots:
+		var index: int = snapshots[key].find(snapshot)
+		if index != -1:
+			used_bytes -= snapshot["size"]
+			snapshots[key].remove_at(index)
+			if snapshots[key].is_empty():
+				snapshots.erase(key)
+			return
+
+# Returns the latest snapshot for the given key that was taken with the same inputs as the given schedule, or null if there is none.
+func find(key: String, schedule: PackedInt32Array):
+	var best = null
+	for snapshot in snapshots.get(key, []):
+		if (best == null or snapshot["frame"] > best["frame"]) and matches(snapshot, schedule):
+			best = snapshot
+	if best != null:
+		use_counter += 1
+		best["last_used"] = use_counter
+	return best
+
+# Schedules always end with a sentinel event (see manager.compile_inputs), so the event after the prefix always exists.
+func matches(snapshot: Dictionary, schedule: PackedInt32Array) -> bool:
+	var count: int = snapshot["schedule_i"]
+	if len(schedule) <= count or schedule[count] <= snapshot["frame"]:
+		return false
+	return schedule.slice(0, count) == snapshot["prefix"]
+
+# Takes a snapshot of the level at the given frame, where schedule_i is the index of the next event in the schedule.
+# Runs with the same key can be resumed from each other's snapshots, so the key must identify the level and everything
+# apart from the inputs that affects the run (e.g. start positions).
+func capture(key: String, frame: int, schedule: PackedInt32Array, schedule_i: int, root: Node, extras: Array[Node], actions: Array):
+	var prefix := schedule.slice(0, schedule_i)
+	for snapshot in snapshots.get(key, []):
+		if snapshot["frame"] == frame and snapshot["prefix"] == prefix:
+			use_counter += 1
+			snapshot["last_used"] = use_counter
+			return
+
+	for tween in root.get_tree().get_processed_tweens():
+		if tween.is_valid() and tween.is_running():
+			return # Tweens cannot be captured, so the state would be incomplete
+
+	var nodes := []
+	for node in collect_nodes(root):
+		var entry := {
+			"path": String(root.get_path_to(node)),
+			"parent": "" if node == root else String(root.get_path_to(node.get_parent())),
+			"name": String(node.name),
+			"index": node.get_index(),
+			"scene": node.scene_file_path,
+			"class": node.get_class(),
+			"script": node.get_script(),
+			"properties": capture_properties(node, root),
+			"special": capture_special(node),
+		}
+		nodes.append(entry)
+
+	var extra_properties := []
+	for extra in extras:
+		extra_properties.append(capture_properties(extra, root, false))
+
+	var pressed_actions := []
+	for action in actions:
+		if Input.is_action_pressed(action):
+			pressed_actions.append(action)
+
+	use_counter += 1
+	var snapshot := {
+		"frame": frame,
+		"schedule_i": schedule_i,
+		"prefix": prefix,
+		"nodes": nodes,
+		"extras": extra_properties,
+		"pressed_actions": pressed_actions,
+		"last_used": use_counter,
+	}
+	# Objects (scripts and shared resources) are serialized as references, because that is how they are kept in the snapshot.
+	# Dictionaries and arrays take more memory than their serialized form, so the memory used is somewhat higher than the measured size.
+	var size := len(var_to_bytes(snapshot))
+	snapshot["size"] = size
+	if !snapshots.has(key):
+		snapshots[key] = []
+	snapshots[key].append(snapshot)
+	used_bytes += size
+
+	while used_bytes > budget_bytes:
+		evict_least_recently_used()
+
+func evict_least_recently_used():
+	var oldest_key = null
+	var oldest_index := -1
+	for key in snapshots:
+		var key_snapshots: Array = snapshots[key]
+		for i in len(key_snapshots):
+			if oldest_key == null or key_snapshots[i]["last_used"] < snapshots[oldest_key][oldest_index]["last_used"]:
+				oldest_key = key
+				oldest_index = i
+
+	used_bytes -= snapshots[oldest_key][oldest_index]["size"]
+	snapshots[oldest_key].remove_at(oldest_index)
+	if snapshots[oldest_key].is_empty():
+		snapshots.erase(oldest_key)
+
+# Step 1 of restoring, called when the level has been loaded.
+# Returns false if the snapshot cannot be restored, in which case the level is left as it was.
+func begin_restore(snapshot: Dictionary, root: Node, actions: Array) -> bool:
+	restored_nodes = {}
+	restore_step = 0
+
+	# Find or recreate all captured nodes. Parents are always captured before their children.
+	var created_nodes: Array[Node] = []
+	for entry in snapshot["nodes"]:
+		var node: Node
+		if entry["path"] == ".":
+			node = root
+		else:
+			var parent: Node = restored_nodes.get(entry["parent"])
+			node = parent.get_node_or_null(NodePath(entry["name"])) if parent != null else null
+			if node == null and parent != null:
+				node = instantiate(entry)
+				if node != null:
+					node.name = entry["name"]
+					parent.add_child(node)
+					created_nodes.append(node)
+			if node == null:
+				for created_node in created_nodes:
+					if is_instance_valid(created_node):
+						created_node.get_parent().remove_child(created_node)
+						created_node.queue_free()
+				restored_nodes = {}
+				return false
+		restored_nodes[entry["path"]] = node
+
+	restored_process_mode = root.process_mode
+	root.process_mode = Node.PROCESS_MODE_DISABLED
+
+	for action in actions:
+		if action in snapshot["pressed_actions"]:
+			Input.action_press(action)
+		else:
+			Input.action_release(action)
+
+	return true
+
+# Steps 2 and 3 of restoring, called on the first two physics ticks after the level has been loaded.
+# Returns true once the level is ready to continue from the snapshot.
+func continue_restore(snapshot: Dictionary, root: Node, extras: Array[Node]) -> bool:
+	restore_step += 1
+	var finishing := restore_step == 2
+
+	apply(snapshot, root, extras)
+	for node in collect_nodes(root):
+		node.set_block_signals(!finishing)
+
+	if finishing:
+		root.process_mode = restored_process_mode
+		restored_nodes = {}
+	return finishing
+
+func apply(snapshot: Dictionary, root: Node, extras: Array[Node]):
+	var entries: Array = snapshot["nodes"]
+
+	# Free nodes that did not exist when the snapshot was taken.
+	var restored_set := {}
+	for node in restored_nodes.values():
+		restored_set[node] = true
+	for node in collect_nodes(root):
+		if !restored_set.has(node) and is_instance_valid(node) and node.get_parent() != null:
+			node.get_parent().remove_child(node)
+			node.queue_free()
+
+	# Processing order depends on the order of children, so restore it as well.
+	for entry in entries:
+		var node: Node = restored_nodes[entry["path"]]
+		if entry["path"] != "." and is_instance_valid(node):
+			node.get_parent().move_child(node, mini(entry["index"], node.get_parent().get_child_count() - 1))
+
+	for entry in entries:
+		var node: Node = restored_nodes[entry["path"]]
+		if !is_instance_valid(node):
+			continue
+		var properties: Dictionary = entry["properties"]
+		for property in properties:
+			if node == root and property == &"process_mode":
+				continue
+			node.set(property, decode_value(properties[property], node.get(property), root))
+		apply_special(node, entry["special"])
+
+	for i in len(extras):
+		var properties: Dictionary = snapshot["extras"][i]
+		for property in properties:
+			extras[i].set(property, decode_value(properties[property], extras[i].get(property), root))
+
+func instantiate(entry: Dictionary) -> Node:
+	if entry["scene"] != "":
+		if !scene_cache.has(entry["scene"]):
+			scene_cache[entry["scene"]] = load(entry["scene"])
+		var scene: PackedScene = scene_cache[entry["scene"]]
+		return scene.instantiate() if scene != null else null
+	if !ClassDB.can_instantiate(entry["class"]):
+		return null
+	var node: Node = ClassDB.instantiate(entry["class"])
+	if entry["script"] != null:
+		node.set_script(entry["script"])
+	return node
+
+static func collect_nodes(root: Node) -> Array[Node]:
+	var out: Array[Node] = []
+	var stack: Array[Node] = [root]
+	while stack:
+		var node: Node = stack.pop_back()
+		if node.is_in_group("_collision_drawers"):
+			continue
+		out.append(node)
+		var children := node.get_children()
+		children.reverse()
+		stack.append_array(children)
+	return out
+
+static func capture_properties(node: Node, root: Node, builtin := true) -> Dictionary:
+	var properties := {}
+	if builtin:
+		for node_class in BUILTIN_PROPERTIES:
+			if node.is_class(node_class):
+				for property in BUILTIN_PROPERTIES[node_class]:
+					properties[property] = node.get(property)
+	for property in node.get_property_list():
+		if property["usage"] & PROPERTY_USAGE_SCRIPT_VARIABLE:
+			properties[StringName(property["name"])] = encode_value(node.get(property["name"]), root)
+	return properties
+
+static func capture_special(node: Node) -> Dictionary:
+	if node is Timer:
+		return {"stopped": node.is_stopped(), "time_left": node.time_left}
+	if node is AnimationPlayer:
+		return {
+			"animation": node.current_animation,
+			"position": node.current_animation_position if node.current_animation != "" else 0.0,
+			"playing": node.is_playing(),
+		}
+	if node is AnimatedSprite2D:
+		return {"animation": node.animation, "frame": node.frame, "progress": node.frame_progress, "playing": node.is_playing()}
+	return {}
+
+static func apply_special(node: Node, special: Dictionary):
+	if node is Timer:
+		if special["stopped"]:
+			node.stop()
+		else:
+			# start() overwrites wait_time, which is used for the following cycles of the timer.
+			var wait_time: float = node.wait_time
+			node.start(special["time_left"])
+			node.wait_time = wait_time
+	elif node is AnimationPlayer:
+		if special["animation"] != "":
+			node.play(special["animation"])
+			node.seek(special["position"], true)
+			if !special["playing"]:
+				node.pause()
+		else:
+			node.stop()
+	elif node is AnimatedSprite2D:
+		node.animation = special["animation"]
+		node.set_frame_and_progress(special["frame"], special["progress"])
+		if special["playing"]:
+			node.play(special["animation"])
+			node.set_frame_and_progress(special["frame"], special["progress"])
+		else:
+			node.pause()
+
+# Converts a value to a form that can be stored in a snapshot.
+# Node references are stored as paths, because the nodes are recreated when the level is reloaded.
+static func encode_value(value, root: Node):
+	if value is Object:
+		if !is_instance_valid(value):
+			return {MARKER: "freed"}
+		if value is Node:
+			if value == root or root.is_ancestor_of(value):
+				return {MARKER: "level", "path": String(root.get_path_to(value))}
+			if value.is_inside_tree():
+				return {MARKER: "absolute", "path": value.get_path()}
+			return {MARKER: "freed"}
+		return {MARKER: "object", "object": value} # Resources are shared between runs and are not copied
+	if value is Array:
+		return {MARKER: "array", "items": value.map(func(item): return encode_value(item, root))}
+	if value is Dictionary:
+		var keys := []
+		var values := []
+		for key in value:
+			keys.append(encode_value(key, root))
+			values.append(encode_value(value[key], root))
+		return {MARKER: "dictionary", "keys": keys, "values": values}
+	return value
+
+# Converts a value back from the form stored in a snapshot. The current value of the property is used as a template
+# for typed arrays and dictionaries.
+func decode_value(value, current, root: Node):
+	if value is not Dictionary or !value.has(MARKER):
+		return value
+	match value[MARKER]:
+		"freed":
+			return null
+		"level":
+			return restored_nodes.get(value["path"])
+		"absolute":
+			return root.get_tree().root.get_node_or_null(value["path"])
+		"object":
+			return value["object"]
+		"array":
+			var out: Array = current.duplicate() if current is Array else []
+			out.clear()
+			for item in value["items"]:
+				out.append(decode_value(item, null, root))
+			return out
+		"dictionary":
+			var out: Dictionary = current.duplicate() if current is Dictionary else {}
+			out.clear()
+			for i in len(value["keys"]):
+				out[decode_value(value["keys"][i], null, root)] = decode_value(value["values"][i], null, root)
+			return out
+	return value
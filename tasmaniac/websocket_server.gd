@@ -9,7 +9,22 @@ var tcp_server := TCPServer.new()
 var socket := WebSocketPeer.new()
 
 var busy := false
-signal level_finished(completed: bool)
+# Results are sent as binary messages if the current request was a binary message.
+var binary_responses := false
+# Time at which the current request was received and how long it took to parse, see add_parse_timing.
+var request_received_usec := 0
+var request_parse_usec := 0
+# Number of runs that were resumed from a snapshot, for picking the runs to verify, see play.
+var resumed_runs := 0
+signal level_finished(result: String)
+
+# Binary messages use little-endian 32-bit integers throughout, see decode_binary_message and send_response.
+const BINARY_COMMANDS := ["", "play_level", "play_levels"]
+const BINARY_RESTART_MODES := ["full", "fast", "check"]
+const BINARY_STATUSES := ["executed", "aborted", "finished"]
+const BINARY_HEADER_SIZE := 24
+const BINARY_RESULT_SIZE := 48
+const BINARY_TELEMETRY_HEADER_SIZE := 20
 
 func _init(port: int, manager: Node):
 	self.port = port
@@ -17,9 +32,10 @@ func _init(port: int, manager: Node):
 	
 	# Important: These connections must be made before the ones in manager, 
 	# otherwise frames are reset by the time these trigger.
-	manager.level_loader._level_load.connect(func(): level_finished.emit(false))
-	manager.level_loader._level_complete.connect(func(): level_finished.emit(true))
-	manager.level_loader._level_unload.connect(func(): level_finished.emit(false))
+	manager.level_loader._level_load.connect(func(): level_finished.emit("failed"))
+	manager.level_loader._level_complete.connect(func(): level_finished.emit("completed"))
+	manager.level_loader._level_unload.connect(func(): level_finished.emit("failed"))
+	manager.playback_aborted.connect(func(): level_finished.emit("aborted"))
 	
 	var error := tcp_server.listen(port, "0.0.0.0")
 	_assert(error == OK, "Failed to start WebSocket server on port %s: %s" % [port, error_string(error)])
@@ -36,48 +52,262 @@ func _process(_delta: float):
 	
 	if socket.get_ready_state() == WebSocketPeer.STATE_OPEN:
 		while socket.get_available_packet_count():
-			var message := socket.get_packet().get_string_from_ascii()
-			receive_message(message)
+			var packet := socket.get_packet()
+			if socket.was_string_packet():
+				receive_message(packet.get_string_from_ascii())
+			else:
+				receive_binary_message(packet)
 
 func _exit_tree():
 	socket.close()
 	tcp_server.stop()
 
 func receive_message(raw_message: String):
+	var received_usec := Time.get_ticks_usec()
 	var message = JSON.parse_string(raw_message)
 	if message is not Dictionary:
 		send_message({"status": "error", "message": "invalid message"})
 		return
+	# Ping is answered even while busy, so that clients can tell if a request is still running.
+	if message.get("command") == "ping":
+		send_message({"status": "pong", "busy": busy})
+		return
 	if busy:
 		send_message({"status": "error", "message": "server busy"})
 		return
+	binary_responses = false
+	request_received_usec = received_usec
 	match message["command"]:
 		"play_level":
 			busy = true
 			var response := await command_play_level(message)
 			busy = false
-			send_message(response)
+			send_response(response)
+		"play_levels":
+			busy = true
+			await command_play_levels(message)
+			busy = false
 		_:
 			send_message({"status": "error", "message": "unknown command: %s" % message["command"]})
 
+func receive_binary_message(packet: PackedByteArray):
+	if busy:
+		send_message({"status": "error", "message": "server busy"})
+		return
+	request_received_usec = Time.get_ticks_usec()
+	var message := decode_binary_message(packet)
+	if message.has("status"):
+		send_message(message)
+		return
+	request_parse_usec = Time.get_ticks_usec() - request_received_usec
+	binary_responses = true
+	busy = true
+	match message["command"]:
+		"play_level":
+			var response := await play(message["level"], message["candidates"][0])
+			add_parse_timing(response, 1)
+			send_response(response)
+		"play_levels":
+			await play_candidates(message["level"], message["candidates"])
+	busy = false
+
 func send_message(message: Dictionary):
 	var error := socket.send_text(JSON.stringify(message))
 	if error != OK:
 		push_error("[TASmaniac] ERROR: Failed to send message: %s" % error_string(error))
 
+# Sends a result in the same format as the request. Errors are always sent as JSON.
+# A binary result is 12 integers: index (-1 for play_level, the candidate count for the final "finished" message),
+# status (index in BINARY_STATUSES), level_completed, duration_ticks, resumed_from_tick (-1 if not resumed),
+# load_path (0 for a full reload, 1 for a fast restart), the restart check result (-1 if not checked, 0 for a mismatch, 1 for a match)
+# and the timings parse_usec, load_usec, simulate_usec, wall_usec and simulated_ticks (all 0 for the "finished" message).
+# Results with telemetry are followed by the telemetry interval, sample count, hazard_tick (-1 if none), hazard_player (-1 if none),
+# the length of the hazard name in bytes, the hazard name as UTF-8, and the samples as 11 floats each (see manager.telemetry).
+# In JSON results the samples are sent as the same floats, encoded as base64.
+func send_response(response: Dictionary):
+	if !binary_responses or response["status"] not in BINARY_STATUSES:
+		if response.has("telemetry"):
+			response["telemetry"]["samples"] = Marshalls.raw_to_base64(response["telemetry"]["samples"])
+		send_message(response)
+		return
+	
+	var finished: bool = response["status"] == "finished"
+	var check: int = -1 if !response.has("check") else int(response["check"]["match"])
+	var message := PackedByteArray()
+	message.resize(BINARY_RESULT_SIZE)
+	message.encode_s32(0, response["count"] if finished else response.get("index", -1))
+	message.encode_s32(4, BINARY_STATUSES.find(response["status"]))
+	message.encode_s32(8, 0 if finished else int(response["level_completed"]))
+	message.encode_s32(12, 0 if finished else response["duration_ticks"])
+	message.encode_s32(16, -1 if finished or response["resumed_from_tick"] == null else response["resumed_from_tick"])
+	message.encode_s32(20, 1 if !finished and response["load_path"] == "fast_restart" else 0)
+	message.encode_s32(24, check)
+	if !finished:
+		var timings: Dictionary = response["timings"]
+		message.encode_s32(28, timings["parse_usec"])
+		message.encode_s32(32, timings["load_usec"])
+		message.encode_s32(36, timings["simulate_usec"])
+		message.encode_s32(40, timings["wall_usec"])
+		message.encode_s32(44, timings["simulated_ticks"])
+	if response.has("telemetry"):
+		var telemetry: Dictionary = response["telemetry"]
+		var samples: PackedByteArray = telemetry["samples"]
+		var hazard: PackedByteArray = ("" if telemetry["hazard"] == null else telemetry["hazard"]).to_utf8_buffer()
+		var header := PackedByteArray()
+		header.resize(BINARY_TELEMETRY_HEADER_SIZE)
+		header.encode_s32(0, telemetry["interval"])
+		header.encode_s32(4, len(samples) / 44)
+		header.encode_s32(8, -1 if telemetry["hazard_tick"] == null else telemetry["hazard_tick"])
+		header.encode_s32(12, -1 if telemetry["hazard_player"] == null else telemetry["hazard_player"])
+		header.encode_s32(16, len(hazard))
+		message.append_array(header)
+		message.append_array(hazard)
+		message.append_array(samples)
+	var error := socket.send(message)
+	if error != OK:
+		push_error("[TASmaniac] ERROR: Failed to send message: %s" % error_string(error))
+
+# Decodes a binary play_level or play_levels request. The layout is:
+# - header: command (index in BINARY_COMMANDS), level, max_ticks (-1 for no limit), snapshot_interval, restart (index in BINARY_RESTART_MODES), candidate count
+# - for each candidate: flags (bit 0 set if start positions follow, bit 1 set if a telemetry interval follows), start positions as 4 doubles,
+#   telemetry interval, event count, events
+# The events are used directly as the playback schedule, see manager.compile_inputs.
+# Returns a dictionary with the command, level and parsed candidates, or an error response.
+func decode_binary_message(packet: PackedByteArray) -> Dictionary:
+	if len(packet) < BINARY_HEADER_SIZE:
+		return {"status": "error", "message": "invalid message"}
+	var command := packet.decode_s32(0)
+	var level := packet.decode_s32(4)
+	var max_ticks := packet.decode_s32(8)
+	var snapshot_interval := packet.decode_s32(12)
+	var restart := packet.decode_s32(16)
+	var count := packet.decode_s32(20)
+	if command != 1 and command != 2:
+		return {"status": "error", "message": "unknown command: %s" % command}
+	if max_ticks < -1:
+		return {"status": "error", "message": "invalid parameter 'max_ticks'"}
+	if snapshot_interval < 0:
+		return {"status": "error", "message": "invalid parameter 'snapshot_interval'"}
+	if restart < 0 or restart >= len(BINARY_RESTART_MODES):
+		return {"status": "error", "message": "invalid parameter 'restart'"}
+	if count < 0 or (command == 1 and count != 1):
+		return {"status": "error", "message": "missing or invalid parameter 'candidates'"}
+	
+	var candidates := []
+	var offset := BINARY_HEADER_SIZE
+	for i in count:
+		if offset + 4 > len(packet):
+			return {"status": "error", "message": "truncated message"}
+		var flags := packet.decode_s32(offset)
+		offset += 4
+		var start_positions = null
+		if flags & 1:
+			if offset + 32 > len(packet):
+				return {"status": "error", "message": "truncated message"}
+			start_positions = [
+				Vector2(packet.decode_double(offset), packet.decode_double(offset + 8)),
+				Vector2(packet.decode_double(offset + 16), packet.decode_double(offset + 24)),
+			]
+			offset += 32
+		var telemetry_interval := 0
+		if flags & 2:
+			if offset + 4 > len(packet):
+				return {"status": "error", "message": "truncated message"}
+			telemetry_interval = packet.decode_s32(offset)
+			offset += 4
+			if telemetry_interval < 0:
+				return {"status": "error", "message": "invalid parameter 'telemetry_interval'", "index": i}
+		if offset + 4 > len(packet):
+			return {"status": "error", "message": "truncated message"}
+		var event_count := packet.decode_s32(offset)
+		offset += 4
+		if event_count < 0 or offset + 8 * event_count > len(packet):
+			return {"status": "error", "message": "truncated message"}
+		var events := packet.slice(offset, offset + 8 * event_count).to_int32_array()
+		offset += 8 * event_count
+		
+		var compiled: Dictionary = manager.compile_events(events)
+		if compiled.has("error"):
+			return {"status": "error", "message": "invalid events in candidate %s: %s" % [i, compiled["error"]], "index": i, "event": compiled["event"]}
+		candidates.append({"schedule": compiled["schedule"], "start_positions": start_positions, "max_ticks": max_ticks, "snapshot_interval": snapshot_interval, "restart": BINARY_RESTART_MODES[restart], "telemetry_interval": telemetry_interval})
+	if offset != len(packet):
+		return {"status": "error", "message": "invalid message"}
+	
+	return {"command": BINARY_COMMANDS[command], "level": level, "candidates": candidates}
+
 func command_play_level(command: Dictionary) -> Dictionary:
-	if command["level"] is not float or command["level"] != int(command["level"]):
+	if command.get("level") is not float or command["level"] != int(command["level"]):
 		return {"status": "error", "message": "missing or invalid parameter 'level'"}
-	if command["inputs"] is not Array:
+	var candidate := parse_candidate(command)
+	if candidate.has("status"):
+		return candidate
+	request_parse_usec = Time.get_ticks_usec() - request_received_usec
+	
+	var response := await play(int(command["level"]), candidate)
+	add_parse_timing(response, 1)
+	return response
+
+# Plays multiple candidates back-to-back and sends the result for each one as soon as it is finished.
+# A final "finished" message is sent after the last result.
+func command_play_levels(command: Dictionary):
+	if command.get("level") is not float or command["level"] != int(command["level"]):
+		send_message({"status": "error", "message": "missing or invalid parameter 'level'"})
+		return
+	if command.get("candidates") is not Array:
+		send_message({"status": "error", "message": "missing or invalid parameter 'candidates'"})
+		return
+	var candidates := []
+	for i in len(command["candidates"]):
+		var raw_candidate = command["candidates"][i]
+		if raw_candidate is not Dictionary:
+			send_message({"status": "error", "message": "invalid candidate %s" % i, "index": i})
+			return
+		# Options given for the whole batch apply to all candidates that do not override them.
+		for option in ["max_ticks", "snapshot_interval", "restart", "telemetry_interval"]:
+			if !raw_candidate.has(option):
+				raw_candidate[option] = command.get(option)
+		var candidate := parse_candidate(raw_candidate)
+		if candidate.has("status"):
+			candidate["index"] = i
+			send_message(candidate)
+			return
+		candidates.append(candidate)
+	request_parse_usec = Time.get_ticks_usec() - request_received_usec
+	
+	await play_candidates(int(command["level"]), candidates)
+
+func play_candidates(level: int, candidates: Array):
+	for i in len(candidates):
+		if i > 0:
+			# The previous result is resolved from inside the level's signal handlers.
+			# Wait for the next frame so that the level is not reloaded in the middle of them.
+			await get_tree().process_frame
+		var response := await play(level, candidates[i])
+		add_parse_timing(response, len(candidates), i)
+		response["index"] = i
+		send_response(response)
+	
+	send_response({"status": "finished", "count": len(candidates)})
+
+# Validates the inputs and start positions of a single candidate.
+# Returns a dictionary with the parsed values or an error response.
+func parse_candidate(command: Dictionary) -> Dictionary:
+	if command.get("inputs") is not Array:
 		return {"status": "error", "message": "missing or invalid parameter 'inputs'"}
 	if command.get("start_positions") != null and command.get("start_positions") is not Array:
 		return {"status": "error", "message": "invalid parameter 'start_positions'"}
-	var level: int = command["level"]
-	var inputs: PackedStringArray = command["inputs"]
-	var start_positions = command["start_positions"]
-	for input in inputs:
-		if input.lstrip(" ").begins_with("-"):
-			return {"status": "error", "message": "invalid input '%s'" % input}
+	if command.get("max_ticks") != null and (command["max_ticks"] is not float or command["max_ticks"] != int(command["max_ticks"]) or command["max_ticks"] < 0):
+		return {"status": "error", "message": "invalid parameter 'max_ticks'"}
+	if command.get("snapshot_interval") != null and (command["snapshot_interval"] is not float or command["snapshot_interval"] != int(command["snapshot_interval"]) or command["snapshot_interval"] < 0):
+		return {"status": "error", "message": "invalid parameter 'snapshot_interval'"}
+	if command.get("telemetry_interval") != null and (command["telemetry_interval"] is not float or command["telemetry_interval"] != int(command["telemetry_interval"]) or command["telemetry_interval"] < 0):
+		return {"status": "error", "message": "invalid parameter 'telemetry_interval'"}
+	if command.get("restart") != null and command["restart"] not in ["full", "fast", "check"]:
+		return {"status": "error", "message": "invalid parameter 'restart'"}
+	var compiled: Dictionary = manager.compile_inputs(PackedStringArray(command["inputs"]))
+	if compiled.has("error"):
+		return {"status": "error", "message": "invalid inputs on line %s: %s" % [compiled["line"], compiled["error"]], "line": compiled["line"]}
+	var start_positions = command.get("start_positions")
 	if start_positions != null:
 		if len(start_positions) != 2:
 			return {"status": "error", "message": "expected 2 start positions, but got %s" % len(start_positions)}
@@ -87,17 +317,115 @@ func command_play_level(command: Dictionary) -> Dictionary:
 				return {"status": "error", "message": "invalid start position %s" % str(position)}
 			start_positions[i] = Vector2(position[0], position[1])
 	
+	var max_ticks: int = -1 if command.get("max_ticks") == null else int(command["max_ticks"])
+	var snapshot_interval: int = 0 if command.get("snapshot_interval") == null else int(command["snapshot_interval"])
+	var telemetry_interval: int = 0 if command.get("telemetry_interval") == null else int(command["telemetry_interval"])
+	
+	var restart: String = "full" if command.get("restart") == null else command["restart"]
+	
+	return {"schedule": compiled["schedule"], "start_positions": start_positions, "max_ticks": max_ticks, "snapshot_interval": snapshot_interval, "restart": restart, "telemetry_interval": telemetry_interval}
+
+func play(level: int, candidate: Dictionary) -> Dictionary:
+	var start_usec := Time.get_ticks_usec()
+	if candidate["restart"] == "check":
+		# Check mode: play the candidate using the fast paths (fast restart and snapshots) and then again using a full reload.
+		var fast_response := await play_once(level, candidate, "fast")
+		return await check_against_full_reload(level, candidate, fast_response, start_usec)
+	
+	var response := await play_once(level, candidate, candidate["restart"])
+	# Snapshot verification (--snapshot-verify=<n>): every n-th resumed run is played again from the start of the level,
+	# because snapshots do not capture everything (see snapshot_cache.gd). A mismatch is reported like in check mode.
+	var verify_interval: int = get_tree()._snapshot_verify_interval
+	if response["resumed_from_tick"] != null and verify_interval > 0:
+		resumed_runs += 1
+		if resumed_runs % verify_interval == 0:
+			return await check_against_full_reload(level, candidate, response, start_usec)
+	return response
+
+# Plays the candidate again using a full reload without snapshots and compares the result with fast_response, the result of
+# playing it using the fast paths. The result of the full reload is returned, with the comparison in "check" and the timings of both runs.
+# If the results differ and the fast run was resumed from a snapshot, all snapshots are discarded.
+func check_against_full_reload(level: int, candidate: Dictionary, fast_response: Dictionary, start_usec: int) -> Dictionary:
+	await get_tree().process_frame
+	var reference_candidate := candidate.duplicate()
+	reference_candidate["snapshot_interval"] = 0
+	var response := await play_once(level, reference_candidate, "full")
+	
+	var matches: bool = fast_response["status"] == response["status"] and fast_response["level_completed"] == response["level_completed"] and fast_response["duration_ticks"] == response["duration_ticks"]
+	if !matches:
+		push_error("[TASmaniac] ERROR: Fast path result %s does not match full reload result %s" % [fast_response, response])
+		if fast_response["resumed_from_tick"] != null:
+			manager.snapshots.clear()
+	fast_response.erase("status")
+	fast_response.erase("telemetry")
+	fast_response["match"] = matches
+	response["check"] = fast_response
+	var fast_timings: Dictionary = fast_response["timings"]
+	var reference_timings: Dictionary = response["timings"]
+	response["timings"] = make_timings(
+		fast_timings["load_usec"] + reference_timings["load_usec"],
+		fast_timings["simulate_usec"] + reference_timings["simulate_usec"],
+		Time.get_ticks_usec() - start_usec,
+		fast_timings["simulated_ticks"] + reference_timings["simulated_ticks"],
+	)
+	return response
+
+func play_once(level: int, candidate: Dictionary, restart: String) -> Dictionary:
 	var original_delta_multiplier = get_tree()._delta_multiplier
 	if headless:
 		get_tree()._set_delta_multiplier(0.0)
 	
-	manager.start_manual_playback(level, inputs, start_positions)
-	var completed: bool = await level_finished
+	var start_usec := Time.get_ticks_usec()
+	manager.start_manual_playback(level, candidate["schedule"], candidate["start_positions"], candidate["max_ticks"], candidate["snapshot_interval"], restart, candidate["telemetry_interval"])
+	var result: String = await level_finished
+	var end_usec := Time.get_ticks_usec()
+	# Runs that ended before the level finished loading spent all of their time loading.
+	var loaded_usec: int = manager.level_loaded_usec if manager.level_loaded_usec >= start_usec else end_usec
 	
 	if headless:
 		get_tree()._set_delta_multiplier(original_delta_multiplier)
 	
-	return {"status": "executed", "level_completed": completed, "duration_ticks": manager.frame}
+	var response := {
+		"status": "executed",
+		"level_completed": result == "completed",
+		"duration_ticks": manager.frame,
+		"resumed_from_tick": manager.resumed_from_frame if manager.resumed_from_frame >= 0 else null,
+		"load_path": manager.load_path,
+		"timings": make_timings(loaded_usec - start_usec, end_usec - loaded_usec, end_usec - start_usec, manager.frame - maxi(manager.resumed_from_frame, 0)),
+	}
+	if result == "aborted":
+		# Aborted runs report the frame at which they were stopped, which is always max_ticks + 1.
+		response["status"] = "aborted"
+	if candidate["telemetry_interval"] > 0:
+		# The hazard is only reported for failed runs, where it is the likely cause of death.
+		var died: bool = result == "failed" and manager.telemetry_hazard_frame >= 0
+		response["telemetry"] = {
+			"interval": candidate["telemetry_interval"],
+			"samples": manager.telemetry.to_byte_array(),
+			"hazard": manager.telemetry_hazard if died else null,
+			"hazard_tick": manager.telemetry_hazard_frame if died else null,
+			"hazard_player": manager.telemetry_hazard_player if died else null,
+		}
+	return response
+
+# Timings of a single response, in microseconds. Ticks restored from a snapshot are not counted as simulated.
+# The parse time is added once the response is finished, see add_parse_timing.
+func make_timings(load_usec: int, simulate_usec: int, wall_usec: int, simulated_ticks: int) -> Dictionary:
+	return {
+		"parse_usec": 0,
+		"load_usec": load_usec,
+		"simulate_usec": simulate_usec,
+		"wall_usec": wall_usec,
+		"simulated_ticks": simulated_ticks,
+		"ticks_per_second": simulated_ticks * 1e6 / simulate_usec if simulate_usec > 0 else 0.0,
+	}
+
+# Adds an even share of the time spent parsing the request to each of its count responses. The first response also gets the
+# remainder, so that the parse times of all responses add up to the time spent parsing the request.
+func add_parse_timing(response: Dictionary, count: int, index := 0):
+	var parse_usec := request_parse_usec / count + (request_parse_usec % count if index == 0 else 0)
+	response["timings"]["parse_usec"] = parse_usec
+	response["timings"]["wall_usec"] += parse_usec
 
 func _assert(condition: bool, message: String):
 	if !condition:
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+
+# The scripts are not installed as a package, so make them importable from the tests.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
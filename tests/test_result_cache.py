@@ -0,0 +1,112 @@
+import itertools
+import pytest
+import tas_server
+from tas_server import ResultCache, _cached_result
+
+
+INPUTS = ['10 +D', '20 +W', '25 -W']
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(tas_server, 'game_fingerprint', lambda: 'test')
+    # A clock that always moves forward, so that the order of last use never depends on the resolution of the system clock
+    monkeypatch.setattr(tas_server.time, 'time_ns', itertools.count().__next__)
+    cache = ResultCache(tmp_path / 'results.sqlite', max_entries=10)
+    yield cache
+    cache.close()
+
+
+def test_cached_result_full_run():
+    assert _cached_result(1, 100, None, None) == (True, 100)
+    assert _cached_result(1, 100, None, 100) == (True, 100)
+    assert _cached_result(0, 50, None, 100) == (False, 50)
+
+def test_cached_result_full_run_over_limit():
+    # A run that took longer than the requested limit is reported as aborted at the limit
+    assert _cached_result(1, 100, None, 99) == (False, 100)
+    assert _cached_result(0, 150, None, 99) == (False, 100)
+
+def test_cached_result_aborted_run():
+    # An aborted run only tells that the level takes longer than its limit, so it cannot answer requests with a higher or no limit
+    assert _cached_result(0, 101, 100, 100) == (False, 101)
+    assert _cached_result(0, 101, 100, 80) == (False, 81)
+    assert _cached_result(0, 101, 100, 120) is None
+    assert _cached_result(0, 101, 100, None) is None
+
+
+def test_get_put(cache):
+    assert cache.get(1, INPUTS) is None
+    cache.put(1, INPUTS, None, None, (True, 100))
+    assert cache.get(1, INPUTS) == (True, 100)
+    assert cache.get(1, INPUTS, max_ticks=99) == (False, 100)
+    assert cache.get(2, INPUTS) is None
+    assert cache.get(1, INPUTS, [(0.0, 0.0), (1.0, 1.0)]) is None
+    assert (cache.hits, cache.misses) == (2, 3)
+
+def test_normalized_inputs(cache):
+    cache.put(1, INPUTS, None, None, (True, 100))
+    assert cache.get(1, ['10 +D', '', '20 +W', '25 -W']) == (True, 100)
+    cache.put(1, ['10 +D +W'], None, None, (False, 30))
+    assert cache.get(1, ['10 +D', '10 +W']) == (False, 30)
+
+def test_telemetry_is_not_stored(cache):
+    cache.put(1, INPUTS, None, None, (True, 100, {'interval': 10, 'samples': []}))
+    assert cache.get(1, INPUTS) == (True, 100)
+
+def test_aborted_run_does_not_replace_full_run(cache):
+    cache.put(1, INPUTS, None, None, (True, 100))
+    cache.put(1, INPUTS, None, 50, (False, 51))
+    assert cache.get(1, INPUTS) == (True, 100)
+
+def test_aborted_run_is_replaced_by_later_limit(cache):
+    cache.put(1, INPUTS, None, 50, (False, 51))
+    assert cache.get(1, INPUTS, max_ticks=60) is None
+    cache.put(1, INPUTS, None, 60, (False, 61))
+    assert cache.get(1, INPUTS, max_ticks=60) == (False, 61)
+    cache.put(1, INPUTS, None, 55, (False, 56))
+    assert cache.get(1, INPUTS, max_ticks=60) == (False, 61)
+    cache.put(1, INPUTS, None, None, (True, 100))
+    assert cache.get(1, INPUTS) == (True, 100)
+
+def test_eviction_keeps_recently_used(cache):
+    # Eviction runs every 1000 stores and keeps the max_entries most recently used results
+    for i in range(999):
+        cache.put(1, [f'{i} +D'], None, None, (True, 100 + i))
+    assert cache.get(1, ['0 +D']) == (True, 100)
+    cache.put(1, ['999 +D'], None, None, (True, 1099))
+
+    (count,) = cache._db.execute('SELECT COUNT(*) FROM results').fetchone()
+    assert count == 10
+    assert cache.get(1, ['0 +D']) == (True, 100)
+    assert cache.get(1, ['1 +D']) is None
+    assert cache.get(1, ['990 +D']) is None
+    assert all(cache.get(1, [f'{i} +D']) == (True, 100 + i) for i in range(991, 1000))
+
+def test_unknown_fingerprint_bypasses_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(tas_server, 'game_fingerprint', lambda: None)
+    cache = ResultCache(tmp_path / 'results.sqlite')
+    cache.put(1, INPUTS, None, None, (True, 100))
+    assert cache.get(1, INPUTS) is None
+    (count,) = cache._db.execute('SELECT COUNT(*) FROM results').fetchone()
+    assert count == 0
+    cache.close()
+
+def test_fingerprint_changes_with_scripts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tas_server, '_SERVER_COMMAND', 'python stand_in_server.py')
+    (tmp_path / 'tasmaniac').mkdir()
+    (tmp_path / 'tasmaniac' / 'bootstrap.gd').write_text('const _VERSION = "v1"\n')
+    (tmp_path / 'stand_in_server.py').write_text('# stand-in\n')
+
+    fingerprint = tas_server.game_fingerprint.__wrapped__()
+    assert fingerprint is not None and fingerprint.startswith('v1/')
+    (tmp_path / 'tasmaniac' / 'manager.gd').write_text('extends Node\n')
+    assert tas_server.game_fingerprint.__wrapped__() != fingerprint
+    fingerprint = tas_server.game_fingerprint.__wrapped__()
+    (tmp_path / 'stand_in_server.py').write_text('# stand-in, changed\n')
+    assert tas_server.game_fingerprint.__wrapped__() != fingerprint
+
+    monkeypatch.setattr(tas_server, '_SERVER_COMMAND', None)
+    monkeypatch.setattr(tas_server, '_AMBIDEXTRO_PCK', str(tmp_path / 'missing.pck'))
+    assert tas_server.game_fingerprint.__wrapped__() is None
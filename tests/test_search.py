@@ -0,0 +1,134 @@
+import math
+import pytest
+import random
+import itertools
+from search import Evolution, RandomWalk, SimulatedAnnealing, VisitedBloomFilter, VisitedTable, offsets_hash
+
+
+BASE_OFFSETS = (10, 20, 30, 40)
+
+
+def test_random_walk_skipped_repeat_keeps_chance():
+    # A repeat of pending offsets is skipped and told right away, which must not use up the chance of the pending proposal
+    strategy = RandomWalk(BASE_OFFSETS, 100, 2, random.Random(0), iteration_candidates=1000)
+    offsets = strategy.propose()
+    strategy.change_chances[offsets].append(0.0)
+    strategy.tell(offsets, None)
+    assert strategy.change_chances[offsets] == [pytest.approx(0.36)]
+
+    strategy.rng.random = lambda: 0.3
+    strategy.tell(offsets, (True, 105))
+    assert strategy.last_duration == 105
+    assert strategy.change_chances == {}
+
+def test_random_walk_pruned_repeat_keeps_chance():
+    # Pruned candidates are also told right after they are proposed
+    strategy = RandomWalk(BASE_OFFSETS, 100, 2, random.Random(0), iteration_candidates=1000)
+    offsets = strategy.propose()
+    strategy.change_chances[offsets].append(0.0)
+    strategy.tell_pruned(offsets, 50)
+    assert strategy.change_chances[offsets] == [pytest.approx(0.36)]
+
+def test_random_walk_accepts_slower_candidate_by_chance():
+    strategy = RandomWalk(BASE_OFFSETS, 100, 2, random.Random(0), iteration_candidates=10)
+    offsets = strategy.propose()
+    # A slower candidate is only accepted if it is played to the end instead of being aborted at the best duration
+    assert strategy.max_ticks(0) is None
+    strategy.rng.random = lambda: 0.3
+    strategy.tell(offsets, (True, 120))
+    assert (strategy.last_offsets, strategy.last_duration) == (offsets, 120)
+    assert strategy.best_duration == 100
+
+def test_random_walk_cuts_off_when_chance_is_zero():
+    strategy = RandomWalk(BASE_OFFSETS, 100, 2, random.Random(0), iteration_candidates=10)
+    strategy.last_duration = 110
+    strategy.num_proposed = 90
+    strategy.propose()
+    assert strategy.max_ticks(0) == 110
+    assert strategy.max_ticks(20) == 120
+
+def test_random_walk_chances_do_not_leak():
+    strategy = RandomWalk(BASE_OFFSETS, 100, 2, random.Random(0))
+    for _ in range(200):
+        offsets = strategy.propose()
+        strategy.tell(offsets, None if offsets == BASE_OFFSETS else (False, 50))
+    assert strategy.change_chances == {}
+
+def test_annealing_plays_candidates_it_could_accept():
+    strategy = SimulatedAnnealing(BASE_OFFSETS, 100, 2, random.Random(0), initial_temperature=2.0)
+    max_ticks = strategy.max_ticks(0)
+    assert math.exp(-(max_ticks - 100) / strategy.temperature) <= strategy.min_accept_chance
+    assert math.exp(-(max_ticks - 1 - 100) / strategy.temperature) > strategy.min_accept_chance
+    strategy.temperature = 0.05
+    assert strategy.max_ticks(3) == 103
+
+def test_evolution_plays_candidates_until_population_is_full():
+    strategy = Evolution(BASE_OFFSETS, 100, 2, random.Random(0), population_size=2)
+    assert strategy.max_ticks(0) is None
+    strategy.tell((11, 20, 30, 40), (True, 120))
+    assert strategy.max_ticks(0) == 120
+    strategy.tell((12, 20, 30, 40), (True, 90))
+    assert strategy.max_ticks(0) == 100
+    assert strategy.max_ticks(20) == 110
+
+def test_visited_table_round_trip():
+    visited = VisitedTable()
+    for i in range(1000):
+        visited.add((i, -i))
+    loaded = VisitedTable.from_bytes(visited.to_bytes())
+    assert len(loaded) == 1000
+    assert all((i, -i) in loaded for i in range(1000))
+    assert (1000, -1000) not in loaded
+
+def test_visited_table_grows_up_to_max_bytes():
+    # The table starts with 1024 slots and doubles when it is 70% full
+    visited = VisitedTable(max_bytes=4 * 1024 * 8)
+    for i in range(int(visited.MAX_LOAD * 4096)):
+        visited.add((i,))
+    assert visited.nbytes == 4 * 1024 * 8
+    assert visited.num_resets == 0
+    assert all((i,) in visited for i in range(len(visited)))
+
+    # Doubling again would exceed max_bytes, so the table starts over at the same size
+    visited.add((-1,))
+    assert visited.nbytes == 4 * 1024 * 8
+    assert visited.num_resets == 1
+    assert len(visited) == 1
+    assert (-1,) in visited and (0,) not in visited
+
+def test_visited_table_same_slot_is_not_a_hit():
+    # Find offsets whose hashes start probing at the same slot of the initial table, but differ
+    slots = dict[int, tuple[int, ...]]()
+    for i in itertools.count():
+        offsets = (i,)
+        slot = offsets_hash(offsets) & 1023
+        if slot in slots:
+            break
+        slots[slot] = offsets
+    first, second = slots[slot], offsets
+    assert offsets_hash(first) != offsets_hash(second)
+
+    visited = VisitedTable()
+    visited.add(first)
+    assert second not in visited
+    visited.add(second)
+    assert first in visited and second in visited
+    assert len(visited) == 2
+
+def test_bloom_filter_round_trip():
+    visited = VisitedBloomFilter(max_bytes=4096, false_positive_rate=0.01)
+    for i in range(500):
+        visited.add((i, -i))
+    loaded = VisitedBloomFilter.from_bytes(visited.to_bytes(), false_positive_rate=0.01)
+    assert len(loaded) == 500
+    assert (loaded.capacity, loaded.num_hashes) == (visited.capacity, visited.num_hashes)
+    assert all((i, -i) in loaded for i in range(500))
+
+def test_bloom_filter_false_positive_rate():
+    visited = VisitedBloomFilter(max_bytes=16 * 1024, false_positive_rate=0.01)
+    for i in range(visited.capacity):
+        visited.add((i, 0))
+    assert visited.num_resets == 0
+    assert all((i, 0) in visited for i in range(visited.capacity))
+    false_positives = sum((i, 1) in visited for i in range(20_000))
+    assert 0.005 < false_positives / 20_000 < 0.02